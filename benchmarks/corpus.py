@@ -0,0 +1,361 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Generate synthetic APIs, of any size, to measure how protoc_docs scales.
+
+The generated files look like a real API's: messages (possibly nested),
+fields, enums and their values, all documented with markdown comments, and
+``SourceCodeInfo`` locations for each of them as ``protoc`` would report
+them. The same parameters and seed always generate the same corpus.
+
+Usage::
+
+    $ python -m benchmarks.corpus --messages 10000 --files 20 \\
+          --format request -o request.bin
+    $ python -m benchmarks.corpus --messages 10000 \\
+          --format descriptor-set -o descriptor_set.bin
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import random
+import sys
+
+from google.protobuf import descriptor_pb2 as desc
+from google.protobuf.compiler.plugin_pb2 import CodeGeneratorRequest
+
+
+_WORDS = (
+    'account', 'address', 'api', 'bucket', 'build', 'cluster', 'config',
+    'data', 'database', 'deadline', 'endpoint', 'entry', 'field', 'filter',
+    'group', 'instance', 'job', 'key', 'label', 'location', 'log', 'member',
+    'metric', 'node', 'operation', 'page', 'policy', 'project', 'quota',
+    'region', 'request', 'resource', 'response', 'result', 'role', 'schema',
+    'service', 'session', 'snapshot', 'state', 'table', 'task', 'token',
+    'topic', 'update', 'user', 'value', 'version', 'zone',
+)
+
+_FILLER = (
+    'the', 'a', 'of', 'to', 'is', 'for', 'in', 'this', 'that', 'which',
+    'must', 'may', 'be', 'when', 'if', 'not', 'are', 'by', 'with', 'each',
+)
+
+_SCALAR_TYPES = (
+    desc.FieldDescriptorProto.TYPE_STRING,
+    desc.FieldDescriptorProto.TYPE_INT64,
+    desc.FieldDescriptorProto.TYPE_INT32,
+    desc.FieldDescriptorProto.TYPE_BOOL,
+    desc.FieldDescriptorProto.TYPE_DOUBLE,
+    desc.FieldDescriptorProto.TYPE_BYTES,
+)
+
+# The field numbers which make up SourceCodeInfo paths.
+_FILE_MESSAGE_TYPE = desc.FileDescriptorProto.MESSAGE_TYPE_FIELD_NUMBER
+_FILE_ENUM_TYPE = desc.FileDescriptorProto.ENUM_TYPE_FIELD_NUMBER
+_MESSAGE_FIELD = desc.DescriptorProto.FIELD_FIELD_NUMBER
+_MESSAGE_NESTED_TYPE = desc.DescriptorProto.NESTED_TYPE_FIELD_NUMBER
+_ENUM_VALUE = desc.EnumDescriptorProto.VALUE_FIELD_NUMBER
+
+
+class CorpusGenerator(object):
+    """Generates a synthetic API.
+
+    Args:
+        seed (int): The seed of the random numbers.
+        files (int): The number of proto files.
+        messages (int): The total number of messages, including nested
+            ones, spread evenly over the files.
+        depth (int): How deeply messages are nested; ``1`` means that
+            there are no nested messages.
+        fields (int): The number of fields of each message.
+        enums (int): The number of top-level enums in each file.
+        comment_words (int): The average number of words in a comment.
+        markdown_density (float): The fraction of sentences which use
+            markdown (code, emphasis, links and lists), between 0 and 1.
+        package (str): The proto package of the files.
+    """
+
+    def __init__(self, seed=0, files=1, messages=10, depth=1, fields=5,
+                 enums=1, comment_words=16, markdown_density=0.3,
+                 package='example.v1'):
+        if files < 1 or messages < 0 or depth < 1:
+            raise ValueError('There must be at least one file, and the '
+                             'nesting depth must be at least 1.')
+        if not 0 <= markdown_density <= 1:
+            raise ValueError('The markdown density must be between 0 and 1; '
+                             'got %r' % markdown_density)
+        self.seed = seed
+        self.files = files
+        self.messages = messages
+        self.depth = depth
+        self.fields = fields
+        self.enums = enums
+        self.comment_words = comment_words
+        self.markdown_density = markdown_density
+        self.package = package
+
+    def file_descriptors(self):
+        """Iterate over the generated files.
+
+        Yields:
+            :class:`google.protobuf.descriptor_pb2.FileDescriptorProto`: Each
+                file, with its ``SourceCodeInfo``.
+        """
+        rng = random.Random(self.seed)
+        names = set()  # Names are unique across the package.
+        per_file, extra = divmod(self.messages, self.files)
+        for index in range(self.files):
+            count = per_file + (1 if index < extra else 0)
+            yield _FileBuilder(self, rng, index, names).build(count)
+
+    def request(self):
+        """Return a ``CodeGeneratorRequest`` for every generated file."""
+        request = CodeGeneratorRequest()
+        for proto_file in self.file_descriptors():
+            request.proto_file.add().CopyFrom(proto_file)
+            request.file_to_generate.append(proto_file.name)
+        return request
+
+    def descriptor_set(self):
+        """Return a ``FileDescriptorSet`` of every generated file."""
+        desc_set = desc.FileDescriptorSet()
+        for proto_file in self.file_descriptors():
+            desc_set.file.add().CopyFrom(proto_file)
+        return desc_set
+
+
+class _FileBuilder(object):
+    def __init__(self, generator, rng, index, names):
+        self.generator = generator
+        self.rng = rng
+        self.proto_file = desc.FileDescriptorProto(
+            name='%s/file_%d.proto' % (
+                generator.package.replace('.', '/'), index),
+            package=generator.package,
+            syntax='proto3',
+        )
+        self.locations = self.proto_file.source_code_info.location
+        self.line = 0
+        self.names = names
+        self.message_names = []
+        self.enum_names = []
+
+    def build(self, messages):
+        for index in range(self.generator.enums):
+            self._enum(self.proto_file.enum_type, (_FILE_ENUM_TYPE, index))
+
+        index = 0
+        while messages > 0:
+            messages -= self._message(
+                self.proto_file.message_type, (_FILE_MESSAGE_TYPE, index),
+                '.' + self.proto_file.package, self.generator.depth, messages,
+            )
+            index += 1
+        return self.proto_file
+
+    def _message(self, container, path, scope, depth, budget):
+        """Add a message (and up to ``depth - 1`` levels of nested
+        messages, within ``budget``), and return how many were added."""
+        message = container.add(name=self._type_name())
+        full_name = '%s.%s' % (scope, message.name)
+        self._locate(path)
+        added = 1
+
+        for index in range(self.generator.fields):
+            self._field(message, path + (_MESSAGE_FIELD, index), index)
+
+        if depth > 1 and added < budget:
+            added += self._message(
+                message.nested_type, path + (_MESSAGE_NESTED_TYPE, 0),
+                full_name, depth - 1, budget - added,
+            )
+
+        self.message_names.append(full_name)
+        return added
+
+    def _field(self, message, path, index):
+        name = '%s_%s' % (self.rng.choice(_WORDS), self.rng.choice(_WORDS))
+        if any(field.name == name for field in message.field):
+            name = '%s_%d' % (name, index)
+        field = message.field.add(
+            name=name,
+            number=index + 1,
+            label=desc.FieldDescriptorProto.LABEL_OPTIONAL,
+        )
+        if self.rng.random() < 0.1:
+            field.label = desc.FieldDescriptorProto.LABEL_REPEATED
+        kind = self.rng.random()
+        if kind < 0.15 and self.message_names:
+            field.type = desc.FieldDescriptorProto.TYPE_MESSAGE
+            field.type_name = self.rng.choice(self.message_names)
+        elif kind < 0.25 and self.enum_names:
+            field.type = desc.FieldDescriptorProto.TYPE_ENUM
+            field.type_name = self.rng.choice(self.enum_names)
+        else:
+            field.type = self.rng.choice(_SCALAR_TYPES)
+        self._locate(path)
+
+    def _enum(self, container, path):
+        enum = container.add(name=self._type_name())
+        self._locate(path)
+        prefix = '_'.join(_split_words(enum.name)).upper()
+        for index in range(self.rng.randint(3, 6)):
+            name = 'UNSPECIFIED' if index == 0 else self.rng.choice(_WORDS)
+            enum.value.add(name='%s_%s_%d' % (prefix, name.upper(), index),
+                           number=index)
+            self._locate(path + (_ENUM_VALUE, index))
+        self.enum_names.append('.%s.%s' % (self.proto_file.package,
+                                           enum.name))
+
+    def _type_name(self):
+        name = ''.join(w.capitalize() for w in self.rng.sample(_WORDS, 2))
+        if name in self.names:
+            # The suffix is different every time, so this is unique.
+            name += str(len(self.names))
+        self.names.add(name)
+        return name
+
+    def _locate(self, path):
+        """Add a documented location for the element at ``path``."""
+        rng = self.rng
+        location = self.locations.add(path=path)
+        if rng.random() < 0.1:
+            location.leading_detached_comments.append(self._comment())
+            self.line += location.leading_detached_comments[0].count('\n') + 1
+        location.leading_comments = self._comment()
+        self.line += location.leading_comments.count('\n')
+        if rng.random() < 0.05:
+            location.trailing_comments = self._comment(words=4)
+        location.span.extend([self.line, 2, 40])
+        self.line += 1
+
+    def _comment(self, words=None):
+        """Return a comment, formatted as protoc reports them."""
+        rng = self.rng
+        words = words or max(1, int(rng.gauss(self.generator.comment_words,
+                                              self.generator.comment_words / 3.)))
+        sentences = []
+        while words > 0:
+            length = min(words, rng.randint(4, 12))
+            words -= length
+            sentences.append(self._sentence(length))
+        if rng.random() < self.generator.markdown_density / 4:
+            sentences.append('\n' + '\n'.join(
+                '* %s' % self._sentence(rng.randint(2, 6))
+                for _ in range(rng.randint(2, 4))))
+
+        lines = []
+        for paragraph in ' '.join(sentences).split('\n'):
+            lines.extend(_wrap(paragraph, 76) or [''])
+        return ''.join(' %s\n' % line if line else '\n' for line in lines)
+
+    def _sentence(self, length):
+        rng = self.rng
+        words = [rng.choice(_WORDS if rng.random() < 0.4 else _FILLER)
+                 for _ in range(length)]
+        if rng.random() < self.generator.markdown_density:
+            index = rng.randrange(length)
+            words[index] = self._markup(words[index])
+        words[0] = words[0][0].upper() + words[0][1:]
+        return ' '.join(words) + '.'
+
+    def _markup(self, word):
+        kind = self.rng.randrange(6)
+        if kind == 0:
+            return '`%s`' % word
+        if kind == 1:
+            return '*%s*' % word
+        if kind == 2:
+            return '**%s**' % word
+        if kind == 3:
+            return '[%s](https://example.com/docs/%s)' % (word, word)
+        if kind == 4:
+            return '[%s](/apis/docs/%s)' % (word, word)
+        if self.message_names:
+            target = self.rng.choice(self.message_names)
+            return '[%s][%s]' % (target.rsplit('.', 1)[-1], target[1:])
+        return '`%s`' % word
+
+
+def _split_words(name):
+    words = []
+    for char in name:
+        if char.isupper() or not words:
+            words.append(char)
+        else:
+            words[-1] += char
+    return words
+
+
+def _wrap(text, width):
+    lines = []
+    line = ''
+    for word in text.split():
+        if line and len(line) + 1 + len(word) > width:
+            lines.append(line)
+            line = word
+        else:
+            line = '%s %s' % (line, word) if line else word
+    if line:
+        lines.append(line)
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.corpus',
+        description='Generate a synthetic API for benchmarking.',
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--files', type=int, default=1)
+    parser.add_argument('--messages', type=int, default=10)
+    parser.add_argument('--depth', type=int, default=1)
+    parser.add_argument('--fields', type=int, default=5)
+    parser.add_argument('--enums', type=int, default=1)
+    parser.add_argument('--comment-words', type=int, default=16)
+    parser.add_argument('--markdown-density', type=float, default=0.3)
+    parser.add_argument('--package', default='example.v1')
+    parser.add_argument('--format', choices=('request', 'descriptor-set'),
+                        default='request')
+    parser.add_argument('-o', '--output', default='-',
+                        help='The output file, or - for stdout.')
+    args = parser.parse_args(argv)
+
+    generator = CorpusGenerator(
+        seed=args.seed,
+        files=args.files,
+        messages=args.messages,
+        depth=args.depth,
+        fields=args.fields,
+        enums=args.enums,
+        comment_words=args.comment_words,
+        markdown_density=args.markdown_density,
+        package=args.package,
+    )
+    if args.format == 'request':
+        data = generator.request().SerializeToString()
+    else:
+        data = generator.descriptor_set().SerializeToString()
+
+    if args.output == '-':
+        getattr(sys.stdout, 'buffer', sys.stdout).write(data)
+    else:
+        with open(args.output, 'wb') as f:
+            f.write(data)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run the benchmarks, and compare them to a baseline.
+
+Usage::
+
+    $ python -m benchmarks.run                  # Compare to the baseline.
+    $ python -m benchmarks.run --save           # Record a new baseline.
+    $ python -m benchmarks.run --backend pandoc --scale 1
+    $ python -m benchmarks.run --messages 10 --messages 1000 --messages 100000
+
+By default, comments are "converted" by a stub backend which leaves them
+unchanged, so that only the time spent in Python is measured. The best of
+``--repeat`` runs of each benchmark is reported. The exit status is 1 if any
+benchmark is slower than the baseline by more than ``--threshold``.
+
+Timings are only comparable on the same machine; record a baseline (with
+``--save``) on the machine which runs the comparison.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+from protoc_docs.backends import get_backend
+
+from benchmarks import corpus
+from benchmarks import suite
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+
+
+def run(inputs, repeat, only=None, out=sys.stdout):
+    """Run the benchmarks.
+
+    Args:
+        inputs (list[benchmarks.suite.Inputs]): The inputs to run each
+            benchmark with.
+        repeat (int): The number of times to run each benchmark.
+        only (str): Optional. Only run benchmarks whose name contains this.
+        out (Any): Where progress is reported.
+
+    Returns:
+        dict: The best time of each benchmark, in seconds, by result name.
+    """
+    results = {}
+    for each in inputs:
+        for name, function in suite.BENCHMARKS:
+            if only and only not in name:
+                continue
+            prepare = function(each)
+            timings = []
+            for _ in range(repeat):
+                timed = prepare()
+                timings.append(_time(timed))
+            key = '%s[%s]' % (name, each.label)
+            results[key] = min(timings)
+            print('%-45s %10.2f ms' % (key, results[key] * 1000), file=out)
+    return results
+
+
+def _time(function):
+    # As timeit does, keep the garbage collector from adding noise.
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.time()
+        function()
+        return time.time() - start
+    finally:
+        gc.enable()
+
+
+def compare(results, baseline, threshold):
+    """Compare results to a baseline.
+
+    Args:
+        results (dict): The results, as returned by :func:`run`.
+        baseline (dict): Earlier results.
+        threshold (float): The fraction by which a benchmark may be slower
+            than the baseline before it is reported as a regression.
+
+    Returns:
+        list[tuple(str, float)]: The name and relative slowdown (``0.5``
+            meaning 50% slower) of every regressed benchmark.
+    """
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        slowdown = results[key] / baseline[key] - 1
+        if slowdown > threshold:
+            regressions.append((key, slowdown))
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, results, backend):
+    with open(path, 'w') as f:
+        json.dump({
+            'backend': backend.name,
+            'machine': platform.machine(),
+            'python': platform.python_version(),
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.run',
+        description='Run the protoc_docs benchmarks.',
+    )
+    parser.add_argument('--scale', type=int, action='append',
+                        help='Copies of the test fixtures to use as input; '
+                             'may be given more than once (default: 1, 20).')
+    parser.add_argument('--messages', type=int, action='append',
+                        help='Use a synthetic API with this many messages '
+                             '(see benchmarks.corpus) instead of the test '
+                             'fixtures; may be given more than once.')
+    parser.add_argument('--files', type=int, default=None,
+                        help='The number of files of the synthetic API '
+                             '(default: one per 500 messages).')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--backend', default=suite.StubBackend.name,
+                        help='The conversion backend (default: stub).')
+    parser.add_argument('--only', default=None,
+                        help='Only run benchmarks whose name contains this.')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='Save the results as the new baseline.')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Report benchmarks this much slower than the '
+                             'baseline (default: 0.25).')
+    args = parser.parse_args(argv)
+
+    if args.backend == suite.StubBackend.name:
+        backend = suite.StubBackend()
+    else:
+        backend = get_backend(args.backend)
+
+    if args.messages:
+        inputs = [suite.Inputs(backend=backend, corpus=corpus.CorpusGenerator(
+            seed=args.seed,
+            messages=messages,
+            files=args.files or max(1, messages // 500),
+        )) for messages in args.messages]
+    else:
+        inputs = [suite.Inputs(scale=scale, backend=backend)
+                  for scale in args.scale or [1, 20]]
+    results = run(inputs, args.repeat, args.only)
+
+    if args.save:
+        save_baseline(args.baseline, results, backend)
+        print('Saved baseline to %s' % args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        return 0
+    baseline = load_baseline(args.baseline)
+    if baseline.get('backend') != backend.name:
+        print('Not comparing: the baseline was recorded with the %r backend.'
+              % baseline.get('backend'))
+        return 0
+
+    regressions = compare(results, baseline['results'], args.threshold)
+    for key, slowdown in regressions:
+        print('REGRESSION %s: %+.0f%% against the baseline'
+              % (key, slowdown * 100))
+    if not regressions:
+        print('No regressions against %s.' % args.baseline)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,275 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The benchmarks, one per stage of the plugin and of the desc converter.
+
+Each benchmark is a function which takes the :class:`Inputs` and returns a
+``prepare`` function. Every repetition calls ``prepare`` (untimed), which
+returns the function which is timed.
+"""
+
+from __future__ import absolute_import
+
+import io
+import os
+
+from google.protobuf import descriptor_pb2 as desc
+from google.protobuf.compiler.plugin_pb2 import CodeGeneratorRequest
+
+from protoc_docs import framing
+from protoc_docs.bin import py_desc_converter
+from protoc_docs.bin import py_docstring
+from protoc_docs.parser import CodeGeneratorParser
+
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'tests', 'data')
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """Register a benchmark under the given name."""
+    def decorator(function):
+        BENCHMARKS.append((name, function))
+        return function
+    return decorator
+
+
+class StubBackend(object):
+    """A conversion backend which leaves texts unchanged.
+
+    Texts are still framed and split back, as ``pandoc``'s backend does, so
+    that only the cost of ``pandoc`` itself is left out.
+    """
+
+    name = 'stub'
+    version = 'stub'
+
+    def convert(self, texts, to, format, batch_token):
+        converted = framing.unframe(framing.frame(texts, batch_token),
+                                    batch_token, len(texts))
+        if converted is None:
+            return [None] * len(texts)
+        return converted
+
+
+class Inputs(object):
+    """The inputs to the benchmarks.
+
+    Unless a synthetic ``corpus`` is given, the test fixtures are repeated
+    ``scale`` times, each copy of the request under its own file names and
+    package.
+
+    Args:
+        scale (int): The number of copies of the fixtures.
+        backend (Any): The conversion backend to benchmark with.
+        corpus (:class:`benchmarks.corpus.CorpusGenerator`): Optional. The
+            generator of a synthetic API to use instead of the fixtures.
+    """
+
+    def __init__(self, scale=1, backend=None, corpus=None):
+        self.scale = scale
+        self.backend = StubBackend() if backend is None else backend
+        self.corpus = corpus
+        self._request = None
+        self._descriptor_set = None
+        self._comments = None
+        self._structures = None
+
+    @property
+    def label(self):
+        """str: A short description of the size of the inputs."""
+        if self.corpus is not None:
+            return 'messages=%d' % self.corpus.messages
+        return 'x%d' % self.scale
+
+    @property
+    def request(self):
+        """bytes: A serialized ``CodeGeneratorRequest``."""
+        if self._request is None and self.corpus is not None:
+            self._request = self.corpus.request().SerializeToString()
+        if self._request is None:
+            original = CodeGeneratorRequest.FromString(
+                _read('input_buffer'))
+            request = CodeGeneratorRequest()
+            for i in range(self.scale):
+                for proto_file in original.proto_file:
+                    copy = request.proto_file.add()
+                    copy.CopyFrom(proto_file)
+                    copy.name = '%d/%s' % (i, proto_file.name)
+                    copy.package = 'copy%d.%s' % (i, proto_file.package)
+                    request.file_to_generate.append(copy.name)
+            self._request = request.SerializeToString()
+        return self._request
+
+    @property
+    def descriptor_set(self):
+        """bytes: A serialized ``FileDescriptorSet``."""
+        if self._descriptor_set is None and self.corpus is not None:
+            self._descriptor_set = \
+                self.corpus.descriptor_set().SerializeToString()
+        if self._descriptor_set is None:
+            # Concatenated sets are a set of all of their files.
+            self._descriptor_set = _read('descriptor_set') * self.scale
+        return self._descriptor_set
+
+    @property
+    def comments(self):
+        """list[str]: The comments in the descriptor set, in order."""
+        if self._comments is None:
+            desc_set = desc.FileDescriptorSet.FromString(self.descriptor_set)
+            self._comments = []
+            for proto_file in desc_set.file:
+                for location in proto_file.source_code_info.location:
+                    self._comments.append(location.leading_comments)
+                    self._comments.append(location.trailing_comments)
+                    self._comments.extend(location.leading_detached_comments)
+        return self._comments
+
+    @property
+    def structures(self):
+        """list[MessageStructure]: The structures found in the request."""
+        if self._structures is None:
+            parser = self.parser()
+            self._structures = list({s for _, s in parser.find_docs()})
+        return self._structures
+
+    def parser(self):
+        return CodeGeneratorParser(
+            CodeGeneratorRequest.FromString(self.request))
+
+    def comments_converter(self):
+        return py_desc_converter.CommentsConverter(
+            cache=_NO_CACHE, backend=self.backend, jobs=1)
+
+
+@benchmark('parser.find_docs')
+def find_docs(inputs):
+    def prepare():
+        parser = inputs.parser()
+        return lambda: list(parser.find_docs())
+    return prepare
+
+
+@benchmark('code.get_meta_docstring')
+def get_meta_docstring(inputs):
+    structures = inputs.structures
+
+    def run():
+        for structure in structures:
+            structure.get_meta_docstring()
+    return lambda: run
+
+
+@benchmark('code.get_python_docstring')
+def get_python_docstring(inputs):
+    pairs = [(s, s.get_meta_docstring()) for s in inputs.structures]
+
+    def run():
+        for structure, meta_docstring in pairs:
+            structure.get_python_docstring(meta_docstring)
+    return lambda: run
+
+
+@benchmark('comments.put_comment')
+def put_comment(inputs):
+    comments = inputs.comments
+
+    def prepare():
+        converter = inputs.comments_converter()
+
+        def run():
+            for comment in comments:
+                converter.put_comment(comment)
+        return run
+    return prepare
+
+
+@benchmark('comments.convert')
+def convert(inputs):
+    def prepare():
+        converter = inputs.comments_converter()
+        for comment in inputs.comments:
+            converter.put_comment(comment)
+        return converter.convert
+    return prepare
+
+
+@benchmark('comments.get_next_comment')
+def get_next_comment(inputs):
+    count = len(inputs.comments)
+
+    def prepare():
+        converter = inputs.comments_converter()
+        for comment in inputs.comments:
+            converter.put_comment(comment)
+        converter.convert()
+
+        def run():
+            for _ in range(count):
+                converter.get_next_comment()
+        return run
+    return prepare
+
+
+@benchmark('py_docstring.main')
+def py_docstring_main(inputs):
+    def run():
+        py_docstring.main(
+            input_file=io.BytesIO(inputs.request),
+            output_file=io.BytesIO(),
+            cache=_NO_CACHE,
+            backend=inputs.backend,
+            jobs=1,
+        )
+    return lambda: run
+
+
+@benchmark('py_desc_converter.convert_desc')
+def convert_desc(inputs):
+    def run():
+        py_desc_converter.convert_desc_stream(
+            io.BytesIO(inputs.descriptor_set),
+            io.BytesIO(),
+            cache=_NO_CACHE,
+            backend=inputs.backend,
+            jobs=1,
+        )
+    return lambda: run
+
+
+class _NoCache(object):
+    """A cache which never has anything, so that the benchmarks do not
+    depend on ``PROTOC_DOCS_CACHE_DIR``."""
+
+    def key(self, text, format, to, version):
+        return None
+
+    def get(self, key):
+        return None
+
+    def put(self, key, value):
+        pass
+
+    def evict(self):
+        pass
+
+
+_NO_CACHE = _NoCache()
+
+
+def _read(name):
+    with io.open(os.path.join(DATA, name), 'rb') as f:
+        return f.read()
@@ -60,3 +60,95 @@ def pandoc_toolchain(platform, exec_compatible_with):
         toolchain = toolchain_info_name,
         toolchain_type = ":pandoc_toolchain_type",
     )
+
+#
+# Actions run by persistent workers
+#
+def _run_docs_worker(ctx, executable, inputs, outputs, arguments, mnemonic):
+    args = ctx.actions.args()
+    args.add_all(arguments)
+    args.use_param_file("@%s", use_always = True)
+    args.set_param_file_format("multiline")
+    ctx.actions.run(
+        executable = executable,
+        # Arguments before the parameter file are passed to the worker when
+        # it starts, rather than with each request.
+        arguments = ["--worker_protocol=json", args],
+        inputs = inputs,
+        outputs = outputs,
+        mnemonic = mnemonic,
+        execution_requirements = {
+            "supports-workers": "1",
+            "requires-worker-protocol": "json",
+        },
+        progress_message = "Converting the comments of %s" % inputs[0].short_path,
+    )
+
+def _docs_descriptor_set_impl(ctx):
+    arguments = [ctx.file.src.path, ctx.outputs.out.path]
+    for pattern in ctx.attr.include:
+        arguments += ["--include", pattern]
+    for pattern in ctx.attr.exclude:
+        arguments += ["--exclude", pattern]
+    if ctx.attr.drop_excluded:
+        arguments.append("--drop-excluded")
+    _run_docs_worker(
+        ctx,
+        executable = ctx.executable._converter,
+        inputs = [ctx.file.src],
+        outputs = [ctx.outputs.out],
+        arguments = arguments,
+        mnemonic = "ProtocDocsDescConverter",
+    )
+    return [DefaultInfo(files = depset(direct = [ctx.outputs.out]))]
+
+docs_descriptor_set = rule(
+    doc = "Converts the comments in a FileDescriptorSet to reStructuredText.",
+    attrs = {
+        "src": attr.label(allow_single_file = True, mandatory = True),
+        "out": attr.output(mandatory = True),
+        "include": attr.string_list(
+            doc = "Only convert the files whose name or package matches " +
+                  "one of these globs.",
+        ),
+        "exclude": attr.string_list(
+            doc = "Do not convert the files whose name or package matches " +
+                  "one of these globs, such as google/protobuf/*.",
+        ),
+        "drop_excluded": attr.bool(
+            doc = "Leave the files which are not converted out of the " +
+                  "output, instead of copying them as they are.",
+        ),
+        "_converter": attr.label(
+            default = "@protoc_docs_plugin//:docs_desc_converter",
+            cfg = "host",
+            executable = True,
+        ),
+    },
+    implementation = _docs_descriptor_set_impl,
+)
+
+def _docs_plugin_response_impl(ctx):
+    _run_docs_worker(
+        ctx,
+        executable = ctx.executable._plugin,
+        inputs = [ctx.file.request],
+        outputs = [ctx.outputs.out],
+        arguments = [ctx.file.request.path, ctx.outputs.out.path],
+        mnemonic = "ProtocDocsPlugin",
+    )
+    return [DefaultInfo(files = depset(direct = [ctx.outputs.out]))]
+
+docs_plugin_response = rule(
+    doc = "Runs the docstring plugin on a serialized CodeGeneratorRequest.",
+    attrs = {
+        "request": attr.label(allow_single_file = True, mandatory = True),
+        "out": attr.output(mandatory = True),
+        "_plugin": attr.label(
+            default = "@protoc_docs_plugin//:docs_plugin",
+            cfg = "host",
+            executable = True,
+        ),
+    },
+    implementation = _docs_plugin_response_impl,
+)
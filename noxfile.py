@@ -22,3 +22,11 @@ def unit(session):
     session.install('mock', 'pytest', 'pytest-cov', 'restructuredtext_lint')
     session.install('-e', '.')
     session.run('pytest', '--cov=protoc_docs')
+
+
+@nox.session(python='3.7')
+def benchmark(session):
+    """Run the benchmarks, and compare them to the recorded baseline."""
+
+    session.install('-e', '.')
+    session.run('python', '-m', 'benchmarks.run', *session.posargs)
@@ -0,0 +1,339 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Conversion backends used by :class:`protoc_docs.batch.BatchConverter`.
+
+A backend converts a list of texts from one markup format to another. Its
+``convert`` method returns a list of the same length, holding ``None`` for
+any text it was unable to convert.
+"""
+
+from __future__ import absolute_import
+
+import inspect
+import os
+import subprocess
+import threading
+
+import pypandoc
+
+from protoc_docs import discovery
+from protoc_docs import framing
+from protoc_docs import markdown
+from protoc_docs import server
+
+
+ENV_BACKEND = 'PROTOC_DOCS_BACKEND'
+ENV_TIMEOUT = 'PROTOC_DOCS_PANDOC_TIMEOUT'
+
+# pandoc names some formats differently than pypandoc does.
+_FORMATS = {'md': 'markdown'}
+
+
+class ConversionTimeout(Exception):
+    """Raised when ``pandoc`` does not convert a batch in time."""
+
+
+def _accepts(function, name):
+    try:
+        spec = inspect.getfullargspec(function)
+    except AttributeError:  # pragma: NO COVER
+        spec = inspect.getargspec(function)
+    return name in spec.args
+
+
+# The formats converted between are known to be valid, so that pypandoc need
+# not run pandoc twice more to list the formats it supports before every
+# conversion (which older versions of pypandoc do not offer to skip).
+_CONVERT_OPTIONS = (
+    {'verify_format': False}
+    if _accepts(pypandoc.convert_text, 'verify_format') else {})
+
+
+class PandocBackend(object):
+    """Converts texts by running ``pandoc`` once for the whole batch.
+
+    The texts are framed as one document with numbered sentinels made of the
+    batch token, and the result is split back into individual texts once the
+    sentinels are verified; see :mod:`protoc_docs.framing`.
+
+    Args:
+        path (str): Optional. The path of ``pandoc``. By default, it is found
+            by :func:`protoc_docs.discovery.find_pandoc`, or by pypandoc if
+            that finds none.
+        version (str): Optional. The version of ``pandoc``. By default, the
+            value of the ``PROTOC_DOCS_PANDOC_VERSION`` environment variable,
+            or the version :func:`protoc_docs.discovery.get_version` probes
+            (once per binary, not once per run).
+        environ (dict): Optional. The environment to read; defaults to
+            ``os.environ``.
+        timeout (float): Optional. How long (in seconds) ``pandoc`` may take
+            to convert a batch before it is killed. By default, the value of
+            the ``PROTOC_DOCS_PANDOC_TIMEOUT`` environment variable, or no
+            limit.
+    """
+
+    name = 'pandoc'
+
+    def __init__(self, path=None, version=None, environ=None, timeout=None):
+        environ = os.environ if environ is None else environ
+        self.path = discovery.find_pandoc(environ) if path is None else path
+        self._version = version or environ.get(discovery.ENV_PANDOC_VERSION)
+        self.timeout = _get_timeout(timeout, environ)
+
+    @property
+    def version(self):
+        """str: The version of ``pandoc``."""
+        if self._version is None:
+            if self.path is None:
+                self._version = pypandoc.get_pandoc_version()
+            else:
+                self._version = discovery.get_version(self.path)
+        return self._version
+
+    def convert(self, texts, to, format, batch_token):
+        """Convert the given texts.
+
+        Args:
+            texts (list[str]): The texts to convert. None of them may contain
+                the batch token.
+            to (str): The format to convert to.
+            format (str): The format to convert from.
+            batch_token (str): A plain-text token which ``pandoc`` leaves
+                untouched; see :mod:`protoc_docs.framing`.
+
+        Returns:
+            list[str]: The converted texts. If ``pandoc`` mangled the batch
+                so that it cannot be split back into the texts, every entry
+                is ``None``.
+
+        Raises:
+            ConversionTimeout: If ``pandoc`` took longer than the timeout.
+        """
+        source = framing.frame(texts, batch_token)
+        if self.timeout:
+            output = self._run(source, to, format)
+        else:
+            if self.path is not None:
+                discovery.use_pandoc(self.path, self._version)
+            output = pypandoc.convert_text(
+                source, to, format=format, **_CONVERT_OPTIONS)
+        converted = framing.unframe(output, batch_token, len(texts))
+        if converted is None:
+            return [None] * len(texts)
+        return converted
+
+    def _run(self, source, to, format):
+        # pypandoc offers no way to stop pandoc, so it is run directly, the
+        # way pypandoc runs it.
+        process = subprocess.Popen(
+            [
+                self.path or pypandoc.get_pandoc_path(),
+                '--from=' + _FORMATS.get(format, format),
+                '--to=' + _FORMATS.get(to, to),
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            process.kill()
+
+        timer = threading.Timer(self.timeout, expire)
+        timer.start()
+        try:
+            stdout, stderr = process.communicate(source.encode('utf-8'))
+        finally:
+            timer.cancel()
+        if expired.is_set():
+            raise ConversionTimeout(
+                'pandoc did not finish within %g seconds.' % self.timeout)
+        if process.returncode != 0:
+            raise RuntimeError(
+                'Pandoc died with exitcode "%d" during conversion: %s'
+                % (process.returncode, stderr.decode('utf-8', 'replace')))
+        return stdout.decode('utf-8', 'replace')
+
+
+class NativeBackend(object):
+    """Converts texts with :mod:`protoc_docs.markdown`.
+
+    Texts using markdown the built-in converter does not support are sent
+    to the ``fallback`` backend in a single batch.
+
+    Args:
+        fallback (Any): Optional. The backend for texts which cannot be
+            converted natively; defaults to a :class:`PandocBackend`.
+    """
+
+    name = 'native'
+
+    # Bump whenever the output of protoc_docs.markdown changes, so that
+    # cached conversions are invalidated.
+    VERSION = '3'
+
+    def __init__(self, fallback=None):
+        self.fallback = PandocBackend() if fallback is None else fallback
+
+    @property
+    def version(self):
+        """str: The version of the converter and of its fallback."""
+        return 'native-%s+%s' % (self.VERSION, self.fallback.version)
+
+    def convert(self, texts, to, format, batch_token):
+        """Convert the given texts.
+
+        See :meth:`PandocBackend.convert` for the arguments.
+        """
+        answer = [None] * len(texts)
+        if to == 'rst':
+            answer = [markdown.to_rst(text, format=format) for text in texts]
+
+        pending = [i for i, value in enumerate(answer) if value is None]
+        if pending:
+            converted = self.fallback.convert(
+                [texts[i] for i in pending], to, format, batch_token)
+            for index, value in zip(pending, converted):
+                answer[index] = value
+        return answer
+
+
+class ServerBackend(object):
+    """Converts texts with a long-lived ``pandoc server``.
+
+    This avoids paying ``pandoc``'s start-up cost on every run. Unless
+    ``url`` (or the ``PROTOC_DOCS_PANDOC_SERVER`` environment variable)
+    names a server, a shared one is started on first use and reused by
+    later runs; see :mod:`protoc_docs.server`.
+
+    If the server cannot be started or reached, this backend falls back to
+    the ``fallback`` backend for the rest of its life.
+
+    Args:
+        url (str): Optional. The base URL of a running pandoc server.
+        fallback (Any): Optional. The backend to use when the server is not
+            available; defaults to a :class:`PandocBackend`.
+        environ (dict): Optional. The environment to read; defaults to
+            ``os.environ``.
+    """
+
+    name = 'server'
+
+    def __init__(self, url=None, fallback=None, environ=None):
+        environ = os.environ if environ is None else environ
+        self.url = url or environ.get(server.ENV_URL)
+        self.fallback = PandocBackend() if fallback is None else fallback
+        self._client = None
+        self._failed = False
+
+    @property
+    def client(self):
+        """:class:`protoc_docs.server.ServerClient`: The client, or ``None``
+        if the server is not available."""
+        if self._client is None and not self._failed:
+            try:
+                url = self.url or server.ensure_server()
+            except (OSError, server.ServerError):
+                self._failed = True
+            else:
+                self._client = server.ServerClient(url)
+        return self._client
+
+    @property
+    def version(self):
+        """str: The version of the server's ``pandoc``."""
+        if self.client is not None:
+            try:
+                return 'server+%s' % self.client.version()
+            except server.ServerError:
+                self._fail()
+        return self.fallback.version
+
+    def convert(self, texts, to, format, batch_token):
+        """Convert the given texts.
+
+        See :meth:`PandocBackend.convert` for the arguments.
+        """
+        answer = [None] * len(texts)
+        if self.client is not None:
+            try:
+                answer = self.client.convert(
+                    texts,
+                    _FORMATS.get(to, to),
+                    _FORMATS.get(format, format),
+                )
+                # Unlike the CLI, the server does not end its output with a
+                # newline.
+                answer = [None if value is None else framing.normalize(value)
+                          for value in answer]
+            except server.ServerError:
+                self._fail()
+
+        pending = [i for i, value in enumerate(answer) if value is None]
+        if pending:
+            converted = self.fallback.convert(
+                [texts[i] for i in pending], to, format, batch_token)
+            for index, value in zip(pending, converted):
+                answer[index] = value
+        return answer
+
+    def _fail(self):
+        self._client = None
+        self._failed = True
+
+
+def _get_timeout(timeout, environ):
+    if timeout is None:
+        timeout = environ.get(ENV_TIMEOUT) or 0
+    timeout = float(timeout)
+    if timeout < 0:
+        raise ValueError('The pandoc timeout must not be negative; got %g'
+                         % timeout)
+    return timeout or None
+
+
+_BACKENDS = {
+    PandocBackend.name: PandocBackend,
+    NativeBackend.name: NativeBackend,
+    ServerBackend.name: ServerBackend,
+}
+
+
+def get_backend(name=None, environ=None):
+    """Return a new conversion backend.
+
+    Args:
+        name (str): Optional. The name of the backend. If not given, the
+            ``PROTOC_DOCS_BACKEND`` environment variable is used, and if
+            that is not set either, ``pandoc``.
+        environ (dict): Optional. The environment to read; defaults to
+            ``os.environ``.
+
+    Returns:
+        Any: The backend.
+
+    Raises:
+        ValueError: If there is no backend with the given name.
+    """
+    if name is None:
+        environ = os.environ if environ is None else environ
+        name = environ.get(ENV_BACKEND) or PandocBackend.name
+    try:
+        return _BACKENDS[name]()
+    except KeyError:
+        raise ValueError('Unknown conversion backend %r; expected one of %s'
+                         % (name, ', '.join(sorted(_BACKENDS))))
@@ -0,0 +1,463 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from protoc_docs import framing
+from protoc_docs import markdown
+from protoc_docs.backends import ConversionTimeout
+from protoc_docs.backends import get_backend
+from protoc_docs.instrumentation import Recorder
+
+
+ENV_JOBS = 'PROTOC_DOCS_JOBS'
+ENV_MAX_BATCH_SIZE = 'PROTOC_DOCS_MAX_BATCH_SIZE'
+ENV_BYPASS_PLAIN = 'PROTOC_DOCS_BYPASS_PLAIN'
+
+_LEADING_BLANK_LINES_RE = re.compile(r'\A(?:[ \t]*\n)+')
+_TRAILING_BLANK_LINES_RE = re.compile(r'(?:\n[ \t]*)+\Z')
+
+
+class BatchConverter(object):
+    """Converts a list of texts in a single batch.
+
+    The texts are handed to the conversion backend together. The default
+    ``pandoc`` backend frames them as one document with sentinels made of
+    ``batch_token`` (see :mod:`protoc_docs.framing`), runs ``pandoc`` once,
+    and splits the result back into individual texts; the token must
+    therefore be plain text which ``pandoc`` leaves untouched.
+
+    If the backend cannot convert a batch (for example because ``pandoc``
+    mangled a sentinel), the batch is bisected, and only the halves which
+    fail are converted again, until the texts at fault are found; those are
+    left unconverted. Texts which contain the batch token are converted on
+    their own. A batch which the backend gives up on because it took too
+    long (see :class:`protoc_docs.backends.ConversionTimeout`) is bisected
+    the same way, and each text which times out on its own is reported on
+    stderr.
+
+    If ``max_batch_size`` is set, the texts are sent to the backend in
+    batches of at most that many characters (a longer text is sent on its
+    own), which bounds the memory ``pandoc`` needs. Within that limit, the
+    size of the batches is learned from how fast the backend converts them;
+    see :class:`_BatchSizer`.
+
+    If ``bypass_plain`` is set, texts which are nothing but paragraphs of
+    plain text (see :func:`protoc_docs.markdown.is_plain`) are converted to
+    reStructuredText without the backend, since all ``pandoc`` would do is
+    rewrap them.
+
+    If a :class:`~protoc_docs.cache.ConversionCache` is given, only the texts
+    missing from the cache are sent to ``pandoc``, and their conversions are
+    stored for subsequent runs.
+
+    Args:
+        batch_token (str): The token the texts are framed with.
+        to (str): The format to convert to.
+        format (str): The format to convert from.
+        cache (:class:`protoc_docs.cache.ConversionCache`): Optional. A
+            cache of previous conversions.
+        backend (Any): Optional. The conversion backend (see
+            :mod:`protoc_docs.backends`); by default, the one named by the
+            ``PROTOC_DOCS_BACKEND`` environment variable.
+        jobs (int): Optional. The number of shards a large batch is split
+            into, each of which is converted in parallel. ``0`` means one
+            shard per available core. By default, the value of the
+            ``PROTOC_DOCS_JOBS`` environment variable (which may also be
+            ``auto``), or ``1``.
+        recorder (:class:`protoc_docs.instrumentation.Recorder`): Optional.
+            Where the number of texts and of conversion calls, and the time
+            spent in the backend, are recorded.
+        bypass_plain (bool): Optional. Whether plain texts are converted
+            without the backend, unless the ``PROTOC_DOCS_BYPASS_PLAIN``
+            environment variable is set to ``0``.
+        max_batch_size (int): Optional. The most characters of texts sent to
+            the backend at once; ``0`` means no limit. By default, the value
+            of the ``PROTOC_DOCS_MAX_BATCH_SIZE`` environment variable, or
+            ``0``.
+    """
+
+    # Batches are not split into shards smaller than this (in characters);
+    # below it, starting another pandoc process costs more than it saves.
+    MIN_SHARD_SIZE = 16 * 1024
+
+    # The size (in characters) of the first batches when the size is
+    # limited, and the smallest it is reduced to.
+    INITIAL_BATCH_SIZE = 64 * 1024
+    MIN_BATCH_SIZE = 4 * 1024
+
+    def __init__(self, batch_token, to='rst', format='commonmark', cache=None,
+                 backend=None, jobs=None, recorder=None, bypass_plain=False,
+                 max_batch_size=None):
+        self.batch_token = batch_token
+        self.to = to
+        self.format = format
+        self.cache = cache
+        self.backend = get_backend() if backend is None else backend
+        self.jobs = _get_jobs(jobs)
+        self.recorder = Recorder('batch') if recorder is None else recorder
+        self.bypass_plain = _get_bypass_plain(bypass_plain) and to == 'rst'
+        self.max_batch_size = _get_max_batch_size(max_batch_size)
+        self._sizer = None
+        if self.max_batch_size:
+            self._sizer = _BatchSizer(
+                self.max_batch_size,
+                initial=self.INITIAL_BATCH_SIZE,
+                minimum=self.MIN_BATCH_SIZE,
+            )
+        self._version = None
+
+    @property
+    def version(self):
+        """str: The version of the backend and of the framing, used to key
+        cache entries."""
+        if self._version is None:
+            self._version = '%s/%s' % (self.backend.version, framing.VERSION)
+        return self._version
+
+    def convert(self, texts):
+        """Convert the given texts.
+
+        Texts which only differ in their line endings, or in blank lines
+        before or after them, convert alike; each such group is only looked
+        up in the cache, and converted, once.
+
+        Args:
+            texts (list[str]): The texts to convert.
+
+        Returns:
+            list[str]: The converted texts, in the same order. Texts which
+                could not be converted are returned unchanged.
+        """
+        positions = {}
+        unique = []
+        indexes = []
+        for text in texts:
+            normalized = _normalize(text)
+            index = positions.get(normalized)
+            if index is None:
+                index = positions[normalized] = len(unique)
+                unique.append(normalized)
+            indexes.append(index)
+
+        self.recorder.add('texts', len(texts))
+        self.recorder.add('texts_duplicate', len(texts) - len(unique))
+        self.recorder.add('chars', sum(len(text) for text in texts))
+        self.recorder.add('chars_unique', sum(len(text) for text in unique))
+        converted = self._convert_unique(unique)
+
+        # If a text could not be converted, fall back to the unconverted
+        # text, as it was given.
+        return [text if converted[index] is None else converted[index]
+                for text, index in zip(texts, indexes)]
+
+    def _convert_unique(self, texts):
+        answer = [None] * len(texts)
+        keys = [None] * len(texts)
+        pending = []
+        bypassed = 0
+        for index, text in enumerate(texts):
+            if self.bypass_plain and markdown.is_plain(text, self.format):
+                answer[index] = markdown.to_rst(text, self.format)
+                if answer[index] is not None:
+                    bypassed += 1
+                    continue
+            if self.cache is not None:
+                keys[index] = self.cache.key(
+                    text, self.format, self.to, self.version)
+                answer[index] = self.cache.get(keys[index])
+            if answer[index] is None:
+                pending.append(index)
+
+        self.recorder.add('texts_bypassed', bypassed)
+        self.recorder.add('texts_cached', len(texts) - len(pending) - bypassed)
+        if not pending:
+            return answer
+
+        self.recorder.add('texts_converted', len(pending))
+        converted = self._convert_sharded([texts[i] for i in pending])
+
+        # Texts which could not be converted are not cached.
+        written = False
+        for index, value in zip(pending, converted):
+            if value is None:
+                self.recorder.add('texts_failed')
+                continue
+            answer[index] = value
+            if self.cache is not None:
+                self.cache.put(keys[index], value)
+                written = True
+
+        if written:
+            self.cache.evict()
+        return answer
+
+    def _convert_sharded(self, texts):
+        shards = _shard(texts, self.jobs, self.MIN_SHARD_SIZE)
+        if len(shards) == 1:
+            return self._convert_shard(texts)
+
+        # The heavy lifting happens in pandoc subprocesses, so threads are
+        # enough to keep every core busy.
+        pool = ThreadPool(len(shards))
+        try:
+            converted = pool.map(self._convert_shard, shards)
+        finally:
+            pool.close()
+            pool.join()
+        return [value for shard in converted for value in shard]
+
+    def _convert_shard(self, texts):
+        answer = [None] * len(texts)
+        framed = []
+        for index, text in enumerate(texts):
+            if framing.collides(text, self.batch_token):
+                # The text would break the framing of the whole batch.
+                self.recorder.add('texts_colliding')
+                answer[index] = self._convert_bisecting([text])[0]
+            else:
+                framed.append(index)
+        if framed:
+            converted = self._convert_limited([texts[i] for i in framed])
+            for index, value in zip(framed, converted):
+                answer[index] = value
+        return answer
+
+    def _convert_limited(self, texts):
+        if self._sizer is None:
+            return self._convert_bisecting(texts)
+
+        # The size is read again for every batch, as it is learned.
+        answer = []
+        while len(answer) < len(texts):
+            start = end = len(answer)
+            size = 0
+            limit = self._sizer.size
+            while end < len(texts) and (
+                    end == start or size + len(texts[end]) <= limit):
+                size += len(texts[end])
+                end += 1
+            answer.extend(self._convert_bisecting(texts[start:end],
+                                                  sizer=self._sizer))
+        return answer
+
+    def _convert_bisecting(self, texts, sizer=None):
+        # Only the batch as a whole tells the sizer anything; its halves
+        # are smaller because of the texts at fault, not because of the
+        # size.
+        converted = self._convert_batch(texts, sizer)
+        failed = [i for i, value in enumerate(converted) if value is None]
+        if not failed or len(texts) == 1:
+            return converted
+
+        self.recorder.add('batches_bisected')
+        if len(failed) == len(texts):
+            middle = len(texts) // 2
+            return (self._convert_bisecting(texts[:middle]) +
+                    self._convert_bisecting(texts[middle:]))
+
+        # Only some of the texts failed; try those again.
+        retried = self._convert_bisecting([texts[i] for i in failed])
+        for index, value in zip(failed, retried):
+            converted[index] = value
+        return converted
+
+    def _convert_batch(self, texts, sizer=None):
+        size = sum(len(text) for text in texts)
+        start = time.time()
+        try:
+            converted = self.backend.convert(
+                texts, self.to, self.format, self.batch_token)
+        except ConversionTimeout:
+            self.recorder.add('conversion_timeouts')
+            if sizer is not None:
+                sizer.timed_out(size)
+            _report_timeout(texts, time.time() - start)
+            return [None] * len(texts)
+        finally:
+            self.recorder.add('conversion_calls')
+            self.recorder.add('conversion_seconds', time.time() - start)
+        if sizer is not None:
+            sizer.record(size, time.time() - start)
+        return converted
+
+
+class _BatchSizer(object):
+    """Learns how many characters of texts to send to the backend at once.
+
+    Larger batches spread the cost of starting ``pandoc`` over more texts,
+    but ``pandoc`` needs memory in proportion to its input, and may become
+    slower per character as it does. Starting from ``initial``, the size
+    doubles after every batch, up to ``limit``, for as long as batches of
+    the new size are converted at least about as fast (in characters per
+    second) as those of the previous one; once they are not, the size goes
+    back to the previous one for good. A batch which times out halves the
+    size for good as well.
+
+    This is safe to use from several threads.
+
+    Args:
+        limit (int): The largest size.
+        initial (int): The size of the first batches.
+        minimum (int): The smallest size the size is reduced to.
+    """
+
+    # Batches of the new size converted at less than this fraction of the
+    # rate of the previous size are too large.
+    SLOWDOWN = 0.8
+
+    def __init__(self, limit, initial, minimum):
+        self.limit = limit
+        self.size = min(initial, limit)
+        self.minimum = min(minimum, limit)
+        self._rate = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, size, seconds):
+        """Learn from a batch the backend converted.
+
+        Args:
+            size (int): The size of the batch, in characters.
+            seconds (float): How long the backend took.
+        """
+        with self._lock:
+            # Once the size has settled, a slow batch is noise. Smaller
+            # batches (the last of a run) pay pandoc's start-up cost for
+            # less work, and say little about the size.
+            if self.size >= self.limit or size < self.size // 2:
+                return
+            rate = size / max(seconds, 1e-6)
+            if rate < self._rate * self.SLOWDOWN:
+                self._settle(self.size // 2)
+            else:
+                self._rate = rate
+                self.size = min(self.size * 2, self.limit)
+
+    def timed_out(self, size):
+        """Learn from a batch the backend did not convert in time.
+
+        Args:
+            size (int): The size of the batch, in characters.
+        """
+        with self._lock:
+            self._settle(min(self.size, size) // 2)
+
+    def _settle(self, size):
+        self.size = self.limit = max(size, self.minimum)
+
+
+def _normalize(text):
+    """Return the text without what cannot change its conversion: carriage
+    returns before newlines, and blank lines at the start and the end."""
+    text = _LEADING_BLANK_LINES_RE.sub('', text.replace('\r\n', '\n'))
+    return _TRAILING_BLANK_LINES_RE.sub('', text)
+
+
+def _get_jobs(jobs, environ=None):
+    if jobs is None:
+        environ = os.environ if environ is None else environ
+        jobs = environ.get(ENV_JOBS) or 1
+        if jobs == 'auto':
+            jobs = 0
+    jobs = int(jobs)
+    if jobs < 0:
+        raise ValueError('The number of jobs must not be negative; got %d'
+                         % jobs)
+    return jobs or _cpu_count()
+
+
+def _get_max_batch_size(max_batch_size, environ=None):
+    if max_batch_size is None:
+        environ = os.environ if environ is None else environ
+        max_batch_size = environ.get(ENV_MAX_BATCH_SIZE) or 0
+    max_batch_size = int(max_batch_size)
+    if max_batch_size < 0:
+        raise ValueError('The maximum batch size must not be negative; got %d'
+                         % max_batch_size)
+    return max_batch_size
+
+
+def _get_bypass_plain(bypass_plain, environ=None):
+    environ = os.environ if environ is None else environ
+    return bool(bypass_plain and int(environ.get(ENV_BYPASS_PLAIN) or 1))
+
+
+def _report_timeout(texts, seconds):
+    """Tell the user about texts the backend gave up on."""
+    size = sum(len(text) for text in texts)
+    if len(texts) > 1:
+        sys.stderr.write(
+            'protoc-docs: pandoc gave up after %.1f seconds converting %d '
+            'comments (%d characters); converting them in smaller batches.\n'
+            % (seconds, len(texts), size))
+        return
+    lines = texts[0].splitlines()
+    excerpt = ''.join('    %s\n' % line[:76] for line in lines[:3])
+    if len(lines) > 3:
+        excerpt += '    ...\n'
+    sys.stderr.write(
+        'protoc-docs: pandoc gave up after %.1f seconds converting this '
+        'comment (%d characters), which is left unconverted:\n%s'
+        % (seconds, size, excerpt))
+
+
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: NO COVER
+        return multiprocessing.cpu_count()
+
+
+def _shard(texts, count, min_size):
+    """Split texts into at most ``count`` contiguous, similarly sized shards.
+
+    Args:
+        texts (list[str]): The texts to split.
+        count (int): The maximum number of shards.
+        min_size (int): The minimum total length of a shard.
+
+    Returns:
+        list[list[str]]: The shards, in order.
+    """
+    total = sum(len(text) for text in texts)
+    count = max(1, min(count, len(texts), total // max(min_size, 1)))
+    if count == 1:
+        return [texts]
+
+    shards = []
+    shard = []
+    size = 0
+    remaining = total
+    for text in texts:
+        shard.append(text)
+        size += len(text)
+        # Aim for an equal share of what is left, so that one huge text does
+        # not leave the later shards empty.
+        if size >= remaining / float(count - len(shards)):
+            if len(shards) < count - 1:
+                shards.append(shard)
+                remaining -= size
+                shard = []
+                size = 0
+    if shard:
+        shards.append(shard)
+    return shards
@@ -12,13 +12,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
+import array
+import contextlib
+import filecmp
+import fnmatch
+import io
+import os
 import re
+import shutil
 import sys
 
-import pypandoc
-
 from google.protobuf import descriptor_pb2 as desc
 
+from protoc_docs import wire
+from protoc_docs.backends import get_backend
+from protoc_docs.batch import BatchConverter
+from protoc_docs.cache import ConversionCache
+from protoc_docs.instrumentation import CountingStream
+from protoc_docs.instrumentation import Recorder
+from protoc_docs.instrumentation import get_target
+
+
+ENV_MEMORY_BUDGET = 'PROTOC_DOCS_MEMORY_BUDGET'
+
+# The number of the ``file`` field of ``FileDescriptorSet``.
+_FILE_FIELD = desc.FileDescriptorSet.FILE_FIELD_NUMBER
+# The numbers of the ``name`` and ``package`` fields of
+# ``FileDescriptorProto``.
+_NAME_FIELD = desc.FileDescriptorProto.NAME_FIELD_NUMBER
+_PACKAGE_FIELD = desc.FileDescriptorProto.PACKAGE_FIELD_NUMBER
+
 
 class CommentsConverter(object):
     """Comments converter which converts comments in a batch by calling
@@ -30,6 +54,21 @@ class CommentsConverter(object):
     them (and skipping the others) using the unique batch token. After that
     ``pandoc`` is called for the batch only once and then the result is split by
     same batch token back into individual comments.
+
+    The comments are kept in a single text with an array of offsets into it,
+    rather than as one object each, so that the memory they take up (see
+    ``memory_footprint()``) is proportional to their size.
+
+    Args:
+        cache (:class:`protoc_docs.cache.ConversionCache`): Optional. A cache
+            of previous conversions; only comments missing from it are sent
+            to ``pandoc``.
+        backend (Any): Optional. The conversion backend; see
+            :mod:`protoc_docs.backends`.
+        jobs (int): Optional. The number of shards to convert in parallel;
+            see :class:`protoc_docs.batch.BatchConverter`.
+        recorder (:class:`protoc_docs.instrumentation.Recorder`): Optional.
+            Where the number of comments, and of conversions, is recorded.
     """
 
     _PROTO_LINK_RE = re.compile(
@@ -40,10 +79,20 @@ class CommentsConverter(object):
 
     _BATCH_TOKEN = "$#!"
 
-    def __init__(self):
-        self.raw_comments = {}
-        self.converted_comments = {}
+    def __init__(self, cache=None, backend=None, jobs=None, recorder=None):
+        # The comments are stored one after the other in a single text.
+        # Comment ``i`` spans ``_offsets[i]:_offsets[i + 1]`` of it, and bit
+        # ``i`` of ``_pending`` is set if it needs converting.
+        self._text = io.StringIO()
+        self._offsets = array.array('L', [0])
+        self._pending = bytearray()
+        self._size = 0
+        self._count = 0
         self._index = 0
+        self._cache = cache
+        self._backend = backend
+        self._jobs = jobs
+        self._recorder = Recorder('comments') if recorder is None else recorder
 
     def put_comment(self, comment):
         """Put a comment in a batch for future processing by ``pypandoc``.
@@ -59,18 +108,18 @@ class CommentsConverter(object):
         comment = self._replace_proto_link(comment)
         comment = self._replace_relative_link(comment)
 
-        token = comment
+        self._text.write(comment)
+        self._size += len(comment)
+        self._offsets.append(self._size)
+        if not self._count & 7:
+            self._pending.append(0)
 
         # Try to avoid conversion for comments without special characters in the
         # markdown
-        if any([i in token for i in '`[]*_']):
-            if self.converted_comments:
-                token = "\n%s%s" % (self._BATCH_TOKEN, token)
-            self.converted_comments[self._index] = token
-        else:
-            self.raw_comments[self._index] = token
+        if any([i in comment for i in '`[]*_']):
+            self._pending[self._count >> 3] |= 1 << (self._count & 7)
 
-        self._index += 1
+        self._count += 1
 
     def convert(self):
         """Converts the comments by calling `pypandoc` for a batch of comments and
@@ -79,24 +128,45 @@ class CommentsConverter(object):
         This method must be called only once after a last call to
         ``put_comment()`` and before a first call to ``get_next_comment()``.
         """
-
-        converted_doc = pypandoc.convert_text(
-            "".join(self.converted_comments.values()),
-            'rst',
-            format='commonmark'
-        )
-        converted = converted_doc.split(self._BATCH_TOKEN)
-
-        c_index = 0
-        index = 0
-        while c_index < len(converted):
-            while index in self.raw_comments:
-                index += 1
-            self.converted_comments[index] = self._insert_spaces(
-                converted[c_index])
-            index += 1
-            c_index += 1
-
+        text = self._text = self._text.getvalue()
+        offsets = self._offsets
+        indexes = [i for i in range(self._count) if self._is_pending(i)]
+
+        self._recorder.add('comments', self._count)
+        self._recorder.add('comments_bypassed', self._count - len(indexes))
+
+        converter = BatchConverter(self._BATCH_TOKEN, format='commonmark',
+                                   cache=self._cache, backend=self._backend,
+                                   jobs=self._jobs, recorder=self._recorder,
+                                   bypass_plain=True)
+        converted = converter.convert(
+            [text[offsets[i]:offsets[i + 1]] for i in indexes])
+
+        # Put the converted comments in the place of the originals, copying
+        # the runs of comments in between as they are, and shift the offsets
+        # after each by the difference in length.
+        if indexes:
+            store = io.StringIO()
+            position = 0
+            shifted = 0
+            delta = 0
+            for index, comment in zip(indexes, converted):
+                comment = self._insert_spaces(comment)
+                start, end = offsets[index], offsets[index + 1]
+                store.write(text[position:start])
+                store.write(comment)
+                position = end
+                for i in range(shifted, index + 1):
+                    offsets[i] += delta
+                shifted = index + 1
+                delta += len(comment) - (end - start)
+            store.write(text[position:])
+            for i in range(shifted, len(offsets)):
+                offsets[i] += delta
+            text = store.getvalue()
+
+        self._text = text
+        self._recorder.add('comments_store_bytes', self.memory_footprint())
         self._index = 0
 
     def get_next_comment(self):
@@ -110,13 +180,29 @@ class CommentsConverter(object):
         Returns:
             str: A converted comment
         """
+        offsets = self._offsets
+        index = self._index
+        self._index = index + 1
+        return self._text[offsets[index]:offsets[index + 1]]
+
+    def memory_footprint(self):
+        """Return the approximate number of bytes taken up by the comments.
+
+        Before ``convert()``, the text of the comments is counted as one
+        byte per character.
 
-        if self._index in self.raw_comments:
-            comment = self.raw_comments[self._index]
+        Returns:
+            int: The number of bytes.
+        """
+        if hasattr(self._text, 'getvalue'):
+            text = self._text.tell()
         else:
-            comment = self.converted_comments[self._index]
-        self._index += 1
-        return comment
+            text = sys.getsizeof(self._text)
+        return (text + self._offsets.itemsize * len(self._offsets) +
+                len(self._pending))
+
+    def _is_pending(self, index):
+        return self._pending[index >> 3] & (1 << (index & 7))
 
     def _replace_proto_link(self, comment):
         def _format(m):
@@ -159,7 +245,57 @@ class CommentsConverter(object):
         return ''.join(strs)
 
 
-def convert_desc(source_desc, dest_desc):
+class FileFilter(object):
+    """Selects the files of a descriptor set whose comments are converted.
+
+    A file is selected if its name or its package matches one of the
+    ``include`` globs (or there are none), and neither matches any of the
+    ``exclude`` globs; for example, ``google/protobuf/*`` matches the
+    well-known types by name, and ``google.api`` the files of that package.
+    The other files are written out untouched, without even being decoded,
+    or left out of the output altogether if ``drop`` is set.
+
+    Args:
+        include (Sequence[str]): Optional. The globs of the files to convert.
+        exclude (Sequence[str]): Optional. The globs of the files not to
+            convert.
+        drop (bool): Optional. Whether to leave the files which are not
+            selected out of the output.
+    """
+
+    def __init__(self, include=(), exclude=(), drop=False):
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.drop = drop
+
+    def selects(self, name, package=''):
+        """Return whether the file ``name``, of ``package``, is selected."""
+        keys = (name, package) if package else (name,)
+
+        def matches(patterns):
+            return any(fnmatch.fnmatchcase(key, pattern)
+                       for pattern in patterns for key in keys)
+
+        return ((not self.include or matches(self.include)) and
+                not matches(self.exclude))
+
+    def selects_serialized(self, data):
+        """Return whether a serialized ``FileDescriptorProto`` is selected,
+        reading only its name and package."""
+        name = package = ''
+        for number, wire_type, _, start, end in wire.iter_field_spans(data):
+            if wire_type != wire.LENGTH_DELIMITED:
+                continue
+            if number == _NAME_FIELD:
+                name = data[start:end].decode('utf-8')
+            elif number == _PACKAGE_FIELD:
+                package = data[start:end].decode('utf-8')
+        return self.selects(name, package)
+
+
+def convert_desc(source_desc, dest_desc, cache=None, backend=None,
+                 jobs=None, memory_budget=None, previous_source=None,
+                 previous_dest=None, file_filter=None):
     """Converts proto comments to restructuredtext format.
 
     Proto comments are expected to be in markdown format, and to possibly
@@ -170,40 +306,576 @@ def convert_desc(source_desc, dest_desc):
     in the descriptor set:
     - Replace proto links with literals (e.g. [Foo][bar.baz.Foo] -> `Foo`)
     - Resolve relative URLs to https://cloud.google.com
-    - Run pandoc to convert from markdown to restructuredtext"""
-
-    desc_set = desc.FileDescriptorSet()
-    with open(source_desc, 'rb') as f:
-        desc_set.ParseFromString(f.read())
-
-    cb = CommentsConverter()
-
-    for file_descriptor_proto in desc_set.file:
+    - Run pandoc to convert from markdown to restructuredtext
+
+    Conversions are cached across runs if ``cache`` is given, or if the
+    ``PROTOC_DOCS_CACHE_DIR`` environment variable is set. The conversion
+    backend (see :mod:`protoc_docs.backends`) is ``backend`` if given, or the
+    one named by the ``PROTOC_DOCS_BACKEND`` environment variable. Large
+    batches are split into ``jobs`` shards (by default, ``PROTOC_DOCS_JOBS``)
+    which are converted in parallel.
+
+    ``source_desc`` and ``dest_desc`` are paths; ``-`` stands for standard
+    input and standard output respectively. See :func:`convert_desc_stream`
+    for ``memory_budget``. If ``file_filter`` (a :class:`FileFilter`) is
+    given, only the comments of the files it selects are converted.
+
+    If ``previous_source`` and ``previous_dest`` are given, they are the
+    paths of an earlier input and of its output, and the conversion is
+    incremental: locations whose comments did not change since are copied
+    from the earlier output, and only the others are converted. The earlier
+    output must have been converted by the same backend, and with the same
+    ``file_filter``. If the input did
+    not change at all, or the output would be the same as what is already
+    in ``dest_desc``, ``dest_desc`` is not rewritten. If either earlier file
+    is missing or cannot be read (on a first run, for example), every
+    comment is converted.
+
+    Statistics about the run are written where the ``PROTOC_DOCS_STATS``
+    environment variable says; see :mod:`protoc_docs.instrumentation`."""
+    if (previous_source is None) != (previous_dest is None):
+        raise ValueError('The previous input and output must be given '
+                         'together.')
+    if previous_source is not None:
+        _convert_desc_incremental(source_desc, dest_desc, previous_source,
+                                  previous_dest, cache=cache,
+                                  backend=backend, jobs=jobs,
+                                  memory_budget=memory_budget,
+                                  file_filter=file_filter)
+        return
+
+    source = _open(source_desc, 'rb', sys.stdin)
+    try:
+        with _writing(dest_desc) as dest:
+            convert_desc_stream(source, dest, cache=cache, backend=backend,
+                                jobs=jobs, memory_budget=memory_budget,
+                                file_filter=file_filter)
+    finally:
+        if source_desc != '-':
+            source.close()
+
+
+def _convert_desc_incremental(source_desc, dest_desc, previous_source,
+                              previous_dest, **kwargs):
+    if source_desc != '-' and _same_contents(source_desc, previous_source):
+        previous_output = _open_previous(previous_dest)
+        if previous_output is not None:
+            # Nothing changed, so the earlier output is the output.
+            with previous_output:
+                if (dest_desc == '-' or
+                        not _same_contents(previous_dest, dest_desc)):
+                    with _writing(dest_desc) as dest:
+                        shutil.copyfileobj(previous_output, dest)
+            return
+
+    try:
+        previous = load_previous(previous_source, previous_dest,
+                                 file_filter=kwargs.get('file_filter'))
+    except (IOError, OSError):
+        # There is no earlier conversion to reuse (on a first run, for
+        # example), so convert everything.
+        previous = None
+    source = _open(source_desc, 'rb', sys.stdin)
+    try:
+        # The output is only known to be unchanged once it is complete.
+        with _writing(dest_desc, unless_unchanged=True) as dest:
+            convert_desc_stream(source, dest, previous=previous, **kwargs)
+    finally:
+        if source_desc != '-':
+            source.close()
+
+
+def _open_previous(path):
+    try:
+        return open(path, 'rb')
+    except (IOError, OSError):
+        return None
+
+
+def load_previous(previous_source, previous_dest, file_filter=None):
+    """Map the comments of an earlier conversion to their converted form.
+
+    Args:
+        previous_source (str): The path of an earlier input.
+        previous_dest (str): The path of its output.
+        file_filter (:class:`FileFilter`): Optional. The filter the earlier
+            input was converted with; only the files it selects are mapped.
+
+    Returns:
+        dict: The converted comments of each location, by its original
+            comments. Both are ``(leading, trailing, detached)`` tuples, where
+            ``detached`` is a tuple of the leading detached comments.
+
+    Raises:
+        IOError: If either file cannot be read.
+        ValueError: If ``previous_dest`` is not the output of
+            ``previous_source``.
+    """
+    previous = {}
+    with open(previous_source, 'rb') as source, \
+            open(previous_dest, 'rb') as dest:
+        converted_files = _iter_files(dest, file_filter)
+        for original in _iter_files(source, file_filter):
+            converted = next(converted_files, None)
+            if (converted is None or converted.name != original.name or
+                    len(converted.source_code_info.location) !=
+                    len(original.source_code_info.location)):
+                raise ValueError('%s is not the output of %s'
+                                 % (previous_dest, previous_source))
+            for before, after in zip(original.source_code_info.location,
+                                     converted.source_code_info.location):
+                previous.setdefault(_comments(before), _comments(after))
+        if next(converted_files, None) is not None:
+            raise ValueError('%s is not the output of %s'
+                             % (previous_dest, previous_source))
+    return previous
+
+
+def _iter_files(stream, file_filter=None):
+    """Iterate over the files in a serialized ``FileDescriptorSet`` which
+    ``file_filter`` selects."""
+    for number, wire_type, value in wire.iter_fields(stream):
+        if (number == _FILE_FIELD and wire_type == wire.LENGTH_DELIMITED and
+                (file_filter is None or
+                 file_filter.selects_serialized(value))):
+            yield desc.FileDescriptorProto.FromString(value)
+
+
+def _comments(location):
+    return (location.leading_comments, location.trailing_comments,
+            tuple(location.leading_detached_comments))
+
+
+def _same_contents(path, other_path):
+    """Return whether two files exist and have the same contents."""
+    return (os.path.exists(other_path) and
+            filecmp.cmp(path, other_path, shallow=False))
+
+
+def _same_stream_contents(stream, path, chunk_size=1024 * 1024):
+    """Return whether a file exists and has the same contents as a stream.
+
+    The stream is read to the end, or to where it first differs."""
+    if not os.path.exists(path):
+        return False
+    with open(path, 'rb') as f:
+        while True:
+            chunk = stream.read(chunk_size)
+            if chunk != f.read(chunk_size):
+                return False
+            if not chunk:
+                return True
+
+
+def convert_desc_stream(input_file, output_file, cache=None, backend=None,
+                        jobs=None, memory_budget=None, recorder=None,
+                        previous=None, file_filter=None):
+    """Converts proto comments in a serialized ``FileDescriptorSet``.
+
+    The set is read, converted and written a group of files at a time, so
+    that only one group is held in memory at once. Each group is converted
+    as a single batch. See :func:`convert_desc` for the transformations
+    performed and the other arguments.
+
+    Args:
+        input_file (Any): A binary file-like object (requires a ``read``
+            method) holding the serialized ``FileDescriptorSet``.
+        output_file (Any): A binary file-like object (requires a ``write``
+            method) which the converted set is written to.
+        memory_budget (int): Optional. The approximate number of bytes of
+            the serialized set in each group. By default, the value of the
+            ``PROTOC_DOCS_MEMORY_BUDGET`` environment variable, or no limit
+            (the whole set is converted as one group). Peak memory use is a
+            small multiple of this.
+        recorder (:class:`protoc_docs.instrumentation.Recorder`): Optional.
+            Where statistics about the run are recorded. If not given, they
+            are written where the ``PROTOC_DOCS_STATS`` environment variable
+            says.
+        previous (dict): Optional. The converted comments of an earlier
+            conversion, as returned by :func:`load_previous`. Locations
+            whose comments are found in it are not converted again.
+        file_filter (:class:`FileFilter`): Optional. Selects the files whose
+            comments are converted; by default, all of them.
+    """
+    if recorder is None:
+        recorder = Recorder('py_desc_converter')
+        target = get_target()
+    else:
+        target = None
+    input_file = CountingStream(input_file)
+    output_file = CountingStream(output_file)
+
+    if cache is None:
+        cache = ConversionCache.from_environ()
+    if backend is None:
+        backend = get_backend()
+    if memory_budget is None:
+        memory_budget = int(os.environ.get(ENV_MEMORY_BUDGET) or 0)
+    if memory_budget < 0:
+        raise ValueError('The memory budget must not be negative; got %d'
+                         % memory_budget)
+
+    # Anything other than the selected files (such as unknown fields) is
+    # written out as it is, in order.
+    group = []
+    size = 0
+    for number, wire_type, value, file_descriptor_proto in _read_fields(
+            input_file, recorder, file_filter):
+        size += len(value)
+        if file_descriptor_proto is not None:
+            # Only the decoded file is needed from now on.
+            value = None
+        group.append((number, wire_type, value, file_descriptor_proto))
+        if memory_budget and size >= memory_budget:
+            _convert_files(group, output_file, cache, backend, jobs,
+                           recorder, previous)
+            group = []
+            size = 0
+    _convert_files(group, output_file, cache, backend, jobs, recorder,
+                   previous)
+
+    recorder.add('bytes_in', input_file.count)
+    recorder.add('bytes_out', output_file.count)
+    recorder.write(target)
+
+
+def convert_descs(pairs, cache=None, backend=None, jobs=None,
+                  memory_budget=None, file_filter=None):
+    """Converts proto comments in several descriptor sets in one go.
+
+    The comments of all of the sets are converted together, so that each
+    distinct comment is converted once however many sets it appears in, and
+    the backend is called once rather than once per set. See
+    :func:`convert_desc` for the transformations performed and the other
+    arguments.
+
+    Statistics about the run are written where the ``PROTOC_DOCS_STATS``
+    environment variable says; see :mod:`protoc_docs.instrumentation`.
+
+    Args:
+        pairs (list[tuple(str, str)]): The path of each descriptor set, and
+            of the file its converted copy is written to.
+        memory_budget (int): Optional. The approximate number of bytes of
+            serialized sets to convert at once. Sets are read until the
+            budget is reached, and then converted and written together; a
+            set is never split. By default, the value of the
+            ``PROTOC_DOCS_MEMORY_BUDGET`` environment variable, or no limit
+            (every set is converted at once).
+        file_filter (:class:`FileFilter`): Optional. Selects the files whose
+            comments are converted; by default, all of them.
+    """
+    recorder = Recorder('py_desc_converter')
+    if cache is None:
+        cache = ConversionCache.from_environ()
+    if backend is None:
+        backend = get_backend()
+    if memory_budget is None:
+        memory_budget = int(os.environ.get(ENV_MEMORY_BUDGET) or 0)
+    if memory_budget < 0:
+        raise ValueError('The memory budget must not be negative; got %d'
+                         % memory_budget)
+
+    group = []
+    size = 0
+    for source_desc, dest_desc in pairs:
+        source = CountingStream(_open(source_desc, 'rb', sys.stdin))
+        try:
+            fields = []
+            for number, wire_type, value, file_descriptor_proto in \
+                    _read_fields(source, recorder, file_filter):
+                size += len(value)
+                if file_descriptor_proto is not None:
+                    # Only the decoded file is needed from now on.
+                    value = None
+                fields.append(
+                    (number, wire_type, value, file_descriptor_proto))
+        finally:
+            if source_desc != '-':
+                source.stream.close()
+        recorder.add('inputs')
+        recorder.add('bytes_in', source.count)
+        group.append((dest_desc, fields))
+        if memory_budget and size >= memory_budget:
+            _convert_sets(group, cache, backend, jobs, recorder)
+            group = []
+            size = 0
+    _convert_sets(group, cache, backend, jobs, recorder)
+
+    recorder.write(get_target())
+
+
+def _convert_sets(sets, cache, backend, jobs, recorder):
+    """Convert the comments in a group of descriptor sets, as read by
+    :func:`convert_descs`, and write them out."""
+    files = [file_descriptor_proto
+             for _, fields in sets
+             for _, _, _, file_descriptor_proto in fields
+             if file_descriptor_proto is not None]
+    if files:
+        with recorder.stage('convert'):
+            _convert_comments(files, cache, backend, jobs, recorder, None)
+
+    with recorder.stage('write'):
+        for dest_desc, fields in sets:
+            with _writing(dest_desc) as stream:
+                dest = CountingStream(stream)
+                _write_fields(dest, fields)
+            recorder.add('bytes_out', dest.count)
+
+
+def _write_fields(output_file, fields):
+    """Write out fields as read by :func:`_read_fields`, serializing the
+    files again."""
+    for number, wire_type, value, file_descriptor_proto in fields:
+        if file_descriptor_proto is not None:
+            value = file_descriptor_proto.SerializeToString()
+        wire.write_field(output_file, number, wire_type, value)
+
+
+def read_manifest(path):
+    """Read the pairs of descriptor sets to convert from a manifest.
+
+    Each line of the manifest holds the path of a descriptor set and the
+    path its converted copy is written to, separated by whitespace. Empty
+    lines, and lines starting with ``#``, are ignored.
+
+    Args:
+        path (str): The path of the manifest.
+
+    Returns:
+        list[tuple(str, str)]: The pairs of paths.
+
+    Raises:
+        ValueError: If a line does not hold exactly two paths.
+    """
+    pairs = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            paths = line.split()
+            if len(paths) != 2:
+                raise ValueError('%s:%d: expected a source and a destination, '
+                                 'got %r' % (path, number, line))
+            pairs.append(tuple(paths))
+    return pairs
+
+
+def _read_fields(input_file, recorder, file_filter=None):
+    """Iterate over the fields of a serialized ``FileDescriptorSet``,
+    decoding the files which ``file_filter`` selects.
+
+    The files it does not select are yielded like any other field, or not at
+    all if it drops them."""
+    fields = wire.iter_fields(input_file)
+    while True:
+        with recorder.stage('read'):
+            try:
+                number, wire_type, value = next(fields)
+            except StopIteration:
+                return
+            file_descriptor_proto = None
+            if number == _FILE_FIELD and wire_type == wire.LENGTH_DELIMITED:
+                if (file_filter is None or
+                        file_filter.selects_serialized(value)):
+                    file_descriptor_proto = \
+                        desc.FileDescriptorProto.FromString(value)
+                    recorder.add('files')
+                else:
+                    recorder.add('files_excluded')
+                    if file_filter.drop:
+                        continue
+        yield number, wire_type, value, file_descriptor_proto
+
+
+def _convert_files(fields, output_file, cache, backend, jobs, recorder,
+                   previous):
+    """Convert the comments in a group of fields, as read by
+    :func:`_read_fields`, and write them out."""
+    if not fields:
+        return
+
+    files = [file_descriptor_proto
+             for _, _, _, file_descriptor_proto in fields
+             if file_descriptor_proto is not None]
+    if files:
+        with recorder.stage('convert'):
+            _convert_comments(files, cache, backend, jobs, recorder, previous)
+
+    with recorder.stage('write'):
+        _write_fields(output_file, fields)
+        output_file.flush()
+
+
+def _convert_comments(files, cache, backend, jobs, recorder, previous):
+    """Convert the comments in a group of files in place."""
+    cb = CommentsConverter(cache=cache, backend=backend, jobs=jobs,
+                           recorder=recorder)
+
+    pending = []
+    reused = 0
+    for file_descriptor_proto in files:
         sc_info = file_descriptor_proto.source_code_info
         locations = sc_info.location if sc_info else []
         for location in locations:
+            if previous:
+                converted = previous.get(_comments(location))
+                if converted is not None:
+                    _set_comments(location, converted)
+                    reused += 1
+                    continue
+            pending.append(location)
             cb.put_comment(location.leading_comments)
             cb.put_comment(location.trailing_comments)
             for c in location.leading_detached_comments:
                 cb.put_comment(c)
 
+    if previous is not None:
+        recorder.add('locations_reused', reused)
     cb.convert()
 
-    for file_descriptor_proto in desc_set.file:
-        sc_info = file_descriptor_proto.source_code_info
-        locations = sc_info.location if sc_info else []
-        for location in locations:
-            location.leading_comments = cb.get_next_comment()
-            location.trailing_comments = cb.get_next_comment()
-            detached = []
-            for _ in location.leading_detached_comments:
-                detached.append(cb.get_next_comment())
-            del location.leading_detached_comments[:]
-            location.leading_detached_comments.extend(detached)
+    for location in pending:
+        leading = cb.get_next_comment()
+        trailing = cb.get_next_comment()
+        detached = tuple(cb.get_next_comment()
+                         for _ in location.leading_detached_comments)
+        _set_comments(location, (leading, trailing, detached))
 
-    with open(dest_desc, mode='wb') as f:
-        f.write(desc_set.SerializeToString())
+
+def _set_comments(location, comments):
+    leading, trailing, detached = comments
+    location.leading_comments = leading
+    location.trailing_comments = trailing
+    del location.leading_detached_comments[:]
+    location.leading_detached_comments.extend(detached)
+
+
+def _open(path, mode, std_stream):
+    if path == '-':
+        return getattr(std_stream, 'buffer', std_stream)
+    return open(path, mode)
+
+
+@contextlib.contextmanager
+def _writing(path, unless_unchanged=False):
+    """Open a file for writing, replacing it atomically once it is complete.
+
+    The file is written under a temporary name next to ``path``, and renamed
+    to ``path`` only if the ``with`` block completes; if it raises, or the
+    process is killed, ``path`` is left as it was and no partial output is
+    ever seen there. ``-`` stands for standard output, which is written to
+    directly.
+
+    Args:
+        path (str): The path of the file.
+        unless_unchanged (bool): Optional. If set, ``path`` is not replaced
+            (and so keeps its timestamp) when the new contents are the same
+            as its current ones.
+    """
+    if path == '-':
+        stream = _open(path, 'wb', sys.stdout)
+        yield stream
+        stream.flush()
+        return
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with io.open(tmp_path, 'w+b') as stream:
+            yield stream
+            unchanged = False
+            if unless_unchanged:
+                stream.seek(0)
+                unchanged = _same_stream_contents(stream, path)
+        if not unchanged:
+            os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def main(argv=None, cache=None, backend=None):
+    """Run the converter with the given command line arguments.
+
+    ``cache`` and ``backend`` are passed on to :func:`convert_desc`; a
+    persistent worker (see :mod:`protoc_docs.worker`) shares them between
+    runs.
+    """
+    parser = argparse.ArgumentParser(
+        description='Convert the comments in a FileDescriptorSet from '
+                    'markdown to reStructuredText.',
+    )
+    parser.add_argument(
+        'paths', nargs='*', metavar='SOURCE DEST',
+        help='A descriptor set (or - for stdin) and the output file (or - '
+             'for stdout). Several pairs may be given, and are converted '
+             'together.',
+    )
+    parser.add_argument(
+        '--manifest', action='append', default=[],
+        help='A file listing more pairs of descriptor sets and output files, '
+             'one pair per line.',
+    )
+    parser.add_argument(
+        '--memory-budget', type=int, default=None,
+        help='Convert the set in groups of files of about this many bytes, '
+             'instead of all at once.',
+    )
+    parser.add_argument(
+        '--include', action='append', default=[], metavar='GLOB',
+        help='Only convert the files whose name or package matches this '
+             'glob (or any of them, if given several times).',
+    )
+    parser.add_argument(
+        '--exclude', action='append', default=[], metavar='GLOB',
+        help='Do not convert the files whose name or package matches this '
+             'glob, such as google/protobuf/*.',
+    )
+    parser.add_argument(
+        '--drop-excluded', action='store_true',
+        help='Leave the files which are not converted out of the output, '
+             'instead of copying them as they are.',
+    )
+    parser.add_argument(
+        '--previous-source', default=None,
+        help='An earlier input; with --previous-dest, only convert the '
+             'comments which changed since.',
+    )
+    parser.add_argument(
+        '--previous-dest', default=None,
+        help='The output of --previous-source (may be the same as dest).',
+    )
+    args = parser.parse_args(argv)
+    if len(args.paths) % 2:
+        parser.error('every source needs a destination')
+    pairs = list(zip(args.paths[::2], args.paths[1::2]))
+    for manifest in args.manifest:
+        pairs.extend(read_manifest(manifest))
+    if not pairs:
+        parser.error('nothing to convert')
+    if (args.previous_source is None) != (args.previous_dest is None):
+        parser.error('--previous-source and --previous-dest must be given '
+                     'together')
+    file_filter = None
+    if args.include or args.exclude:
+        file_filter = FileFilter(args.include, args.exclude,
+                                 drop=args.drop_excluded)
+    elif args.drop_excluded:
+        parser.error('--drop-excluded needs --include or --exclude')
+
+    if len(pairs) == 1:
+        convert_desc(pairs[0][0], pairs[0][1], cache=cache, backend=backend,
+                     memory_budget=args.memory_budget,
+                     previous_source=args.previous_source,
+                     previous_dest=args.previous_dest,
+                     file_filter=file_filter)
+    elif args.previous_source is not None:
+        parser.error('--previous-source only applies to a single pair')
+    else:
+        convert_descs(pairs, cache=cache, backend=backend,
+                      memory_budget=args.memory_budget,
+                      file_filter=file_filter)
 
 
 if __name__ == '__main__':
-    convert_desc(sys.argv[1], sys.argv[2])
+    main()
@@ -14,16 +14,72 @@
 
 from __future__ import absolute_import, unicode_literals
 
+import argparse
+import collections
+import io
+import itertools
+import multiprocessing
+import operator
 import os
 import sys
+from multiprocessing.pool import ThreadPool
 
-from pypandoc import convert_text
+from protoc_docs import batch
+from protoc_docs.batch import BatchConverter
+from protoc_docs.cache import ConversionCache
+from protoc_docs.instrumentation import Recorder
+from protoc_docs.instrumentation import get_target
 from protoc_docs.parser import CodeGeneratorParser
+from protoc_docs.parser import decode_request
+from google.protobuf.compiler.plugin_pb2 import CodeGeneratorRequest
 from google.protobuf.compiler.plugin_pb2 import CodeGeneratorResponse
 
 
-def main(input_file=sys.stdin, output_file=sys.stdout):
-    """Parse a CodeGeneratorRequest and return a CodeGeneratorResponse."""
+ENV_CHUNK_SIZE = 'PROTOC_DOCS_CHUNK_SIZE'
+ENV_PROCESSES = 'PROTOC_DOCS_PROCESSES'
+
+# The number of chunks converted, or waiting to be rendered, at once when the
+# run is pipelined.
+CHUNKS_IN_FLIGHT = 2
+
+# The insertion of a docstring into the class scope of a message's class.
+_DOCSTRING_CONTENT = ',\n\'__doc__\': """%s""",'
+
+
+def main(input_file=sys.stdin, output_file=sys.stdout, cache=None,
+         backend=None, jobs=None, recorder=None, chunk_size=None,
+         processes=None):
+    """Parse a CodeGeneratorRequest and return a CodeGeneratorResponse.
+
+    Conversions are cached across runs if ``cache`` is given, or if the
+    ``PROTOC_DOCS_CACHE_DIR`` environment variable is set. The conversion
+    backend (see :mod:`protoc_docs.backends`) is ``backend`` if given, or the
+    one named by the ``PROTOC_DOCS_BACKEND`` environment variable. Large
+    batches are split into ``jobs`` shards (by default, ``PROTOC_DOCS_JOBS``)
+    which are converted in parallel.
+
+    If ``chunk_size`` (by default, ``PROTOC_DOCS_CHUNK_SIZE``) is set, the
+    run is pipelined: the files are converted in chunks of about that many
+    characters of comments, in the background, while the docs of the next
+    chunk are found and those of the previous one rendered. At most
+    ``CHUNKS_IN_FLIGHT`` chunks are waiting to be rendered at once.
+
+    If ``processes`` (by default, ``PROTOC_DOCS_PROCESSES``; ``0`` or
+    ``auto`` for one per core) is more than one, the docs of each file are
+    found, and rendered, by a pool of that many processes. Conversions still
+    happen in this process, in the same batches, and the response is the
+    same as when a single process does everything.
+
+    Statistics about the run are recorded in ``recorder`` if given, and
+    otherwise written where the ``stats`` plugin parameter or the
+    ``PROTOC_DOCS_STATS`` environment variable says; see
+    :mod:`protoc_docs.instrumentation`.
+    """
+    if recorder is None:
+        recorder = Recorder('py_docstring')
+        write_stats = True
+    else:
+        write_stats = False
 
     # Ensure we are getting a bytestream, and writing to a bytestream.
     if hasattr(input_file, 'buffer'):
@@ -31,52 +87,273 @@ def main(input_file=sys.stdin, output_file=sys.stdout):
     if hasattr(output_file, 'buffer'):
         output_file = output_file.buffer
 
-    # Instantiate a parser.
-    parser = CodeGeneratorParser.from_input_file(input_file)
+    # Only the files being generated are documented, so their dependencies
+    # are not even decoded.
+    with recorder.stage('parse_request'):
+        data = input_file.read()
+        request = decode_request(data, lazy=True)
+    recorder.add('bytes_in', len(data))
+    del data
+
+    _BATCH_TOKEN = "CD985272F78311"
 
-    # Find all the docs and amalgamate them together.
-    comment_data = {}
-    for filename, message_structure in parser.find_docs():
-        comment_data.setdefault(filename, set())
-        comment_data[filename].add(message_structure)
+    if cache is None:
+        cache = ConversionCache.from_environ()
+    chunk_size = _get_chunk_size(chunk_size)
+    processes = _get_processes(processes)
+    converter = BatchConverter(_BATCH_TOKEN, format='md', cache=cache,
+                               backend=backend, jobs=jobs, recorder=recorder,
+                               bypass_plain=True)
 
     # Iterate over the data that came back and parse it into a single,
     # coherent CodeGeneratorResponse.
-    answer = []
-    _BATCH_TOKEN = "CD985272F78311"
+    cgr = CodeGeneratorResponse()
+    filenames = []
+    renderers = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        chunks = _iter_chunks(_iter_files(request, renderers), chunk_size,
+                              recorder)
+        if not chunk_size:
+            for chunk in chunks:
+                filenames.extend(fn for fn, _ in chunk)
+                docstrings, meta_structs = _assemble(chunk, recorder)
+                with recorder.stage('convert'):
+                    docstrings = converter.convert(docstrings)
+                _render(cgr, docstrings, meta_structs, recorder, renderers)
+        else:
+            # Conversions run one chunk at a time in the background (which
+            # also keeps the cache to a single thread); pandoc does its work
+            # in a subprocess, so finding and rendering docs carries on
+            # meanwhile.
+            pool = ThreadPool(1)
+            in_flight = collections.deque()
+            try:
+                for chunk in chunks:
+                    filenames.extend(fn for fn, _ in chunk)
+                    docstrings, meta_structs = _assemble(chunk, recorder)
+                    in_flight.append((pool.apply_async(
+                        _convert, (converter, docstrings, recorder)),
+                        meta_structs))
+                    if len(in_flight) >= CHUNKS_IN_FLIGHT:
+                        result, meta_structs = in_flight.popleft()
+                        _render(cgr, result.get(), meta_structs, recorder,
+                                renderers)
+                while in_flight:
+                    result, meta_structs = in_flight.popleft()
+                    _render(cgr, result.get(), meta_structs, recorder,
+                            renderers)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        if renderers is not None:
+            renderers.close()
+            renderers.join()
+
+    for fn in sorted(_init_files(filenames)):
+        cgr.file.add(name=fn, content='')
+
+    with recorder.stage('serialize'):
+        output = cgr.SerializeToString()
+        output_file.write(output)
+    recorder.add('bytes_out', len(output))
+
+    if write_stats:
+        recorder.write(get_target(request.parameter))
+
+
+def _get_chunk_size(chunk_size, environ=None):
+    if chunk_size is None:
+        environ = os.environ if environ is None else environ
+        chunk_size = environ.get(ENV_CHUNK_SIZE) or 0
+    chunk_size = int(chunk_size)
+    if chunk_size < 0:
+        raise ValueError('The chunk size must not be negative; got %d'
+                         % chunk_size)
+    return chunk_size
+
+
+def _get_processes(processes, environ=None):
+    if processes is None:
+        environ = os.environ if environ is None else environ
+        processes = environ.get(ENV_PROCESSES) or 1
+        if processes == 'auto':
+            processes = 0
+    processes = int(processes)
+    if processes < 0:
+        raise ValueError('The number of processes must not be negative; '
+                         'got %d' % processes)
+    # Count the cores this process may run on, as PROTOC_DOCS_JOBS does.
+    return processes or batch._cpu_count()
+
+
+def _iter_files(request, pool=None):
+    """Find the docs of each file.
+
+    A message is only documented by the file it is declared in, so its
+    ``MessageStructure`` is complete once the parser moves on to the next
+    file.
+
+    Args:
+        request (:class:`google.protobuf.compiler.plugin_pb2.CodeGeneratorRequest`):
+            The request.
+        pool (:class:`multiprocessing.pool.Pool`): Optional. The processes
+            which find the docs of each file, in parallel.
+
+    Yields:
+        tuple(str, list): Each file with docs, in order, and its
+            ``MessageStructure`` objects, in the order they are declared.
+    """
+    if pool is None:
+        docs = CodeGeneratorParser(request).find_docs()
+        for filename, file_docs in itertools.groupby(
+                docs, key=operator.itemgetter(0)):
+            yield filename, _unique(struct for _, struct in file_docs)
+        return
+
+    files = (proto_file.SerializeToString()
+             for proto_file in request.proto_file
+             if proto_file.name in request.file_to_generate)
+    for filename, structs in pool.imap(_find_file_docs, files):
+        if structs:
+            yield filename, structs
+
+
+def _find_file_docs(data):
+    """Find the docs of a single serialized ``FileDescriptorProto``; run in
+    the processes of the pool given to :func:`_iter_files`."""
+    request = CodeGeneratorRequest()
+    proto_file = request.proto_file.add()
+    proto_file.MergeFromString(data)
+    request.file_to_generate.append(proto_file.name)
+    parser = CodeGeneratorParser(request)
+    return proto_file.name, _unique(
+        struct for _, struct in parser.find_docs())
+
+
+def _unique(structs):
+    """Return structures without repeats, in the order first seen."""
+    return list(collections.OrderedDict.fromkeys(structs))
+
+
+def _iter_chunks(files, chunk_size, recorder):
+    """Group the files into chunks.
+
+    Args:
+        files (Iterator[tuple(str, list)]): The files and their
+            ``MessageStructure`` objects, as yielded by :func:`_iter_files`.
+        chunk_size (int): The number of characters of comments after which a
+            chunk is complete; ``0`` for a single chunk.
+        recorder (:class:`protoc_docs.instrumentation.Recorder`): Where the
+            time spent finding docs is recorded.
+
+    Yields:
+        list[tuple(str, list)]: The chunks; lists of filenames and their
+            ``MessageStructure`` objects.
+    """
+    while True:
+        chunk = []
+        size = 0
+        with recorder.stage('find_docs'):
+            for filename, structs in files:
+                chunk.append((filename, structs))
+                if chunk_size:
+                    size += sum(len(docstring) for struct in structs
+                                for docstring in struct.get_docstrings())
+                    if size >= chunk_size:
+                        break
+        if not chunk:
+            return
+        yield chunk
+
+
+def _assemble(chunk, recorder):
+    # Every docstring of every message is converted as a text of its own, so
+    # that the batch's framing is verified for each of them.
+    with recorder.stage('batch_assembly'):
+        docstrings = []
+        meta_structs = []
+        for fn, structs in chunk:
+            name = fn.replace('.proto', '_pb2.py')
+            for struct in structs:
+                start = len(docstrings)
+                docstrings.extend(struct.get_docstrings())
+                meta_structs.append((name, struct, start, len(docstrings)))
+    recorder.add('messages', len(meta_structs))
+    return docstrings, meta_structs
+
+
+def _convert(converter, docstrings, recorder):
+    with recorder.stage('convert'):
+        return converter.convert(docstrings)
+
+
+def _render(cgr, docstrings, meta_structs, recorder, pool=None):
+    with recorder.stage('render'):
+        if pool is None:
+            # Render every docstring straight into the response's files,
+            # which the response then owns; building them separately would
+            # copy each of them.
+            for name, struct, start, end in meta_structs:
+                response_file = cgr.file.add()
+                response_file.name = name
+                response_file.insertion_point = 'class_scope:' + struct.name
+                response_file.content = _render_content(
+                    struct, docstrings[start:end])
+            return
+
+        # Each process renders the messages of a file, in order.
+        files = [
+            (name, [(struct, docstrings[start:end])
+                    for _, struct, start, end in group])
+            for name, group in itertools.groupby(
+                meta_structs, key=operator.itemgetter(0))
+        ]
+        for name, contents in zip(
+                (name for name, _ in files),
+                pool.imap(_render_file, (structs for _, structs in files))):
+            for insertion_point, content in contents:
+                cgr.file.add(name=name, insertion_point=insertion_point,
+                             content=content)
+
+
+def _render_file(structs):
+    """Render the docstrings of the messages of a file; run in the processes
+    of the pool given to :func:`_render`."""
+    return [('class_scope:' + struct.name, _render_content(struct, docstrings))
+            for struct, docstrings in structs]
+
+
+def _render_content(struct, docstrings):
+    return _DOCSTRING_CONTENT % (struct.render_python_docstring(docstrings),)
+
+
+def run(argv=None, cache=None, backend=None):
+    """Run the plugin on a request in a file, writing the response to a file.
+
+    This is how the plugin runs as a persistent worker (see
+    :mod:`protoc_docs.worker`), where stdin and stdout carry work requests
+    instead.
 
-    meta_docstrings = []
-    meta_structs = []
-    for fn, structs in comment_data.items():
-        for struct in structs:
-            if meta_docstrings:
-                meta_docstrings.append("\n%s" % _BATCH_TOKEN)
-            meta_docstrings.append(struct.get_meta_docstring())
-            meta_structs.append((fn, struct))
-
-    meta_docstring = convert_text("".join(meta_docstrings), 'rst', format='md')
-    meta_docstrings = meta_docstring.split("%s" % _BATCH_TOKEN)
-
-    index = 0
-    while index < len(meta_structs) and index < len(meta_docstrings):
-        fn = meta_structs[index][0]
-        struct = meta_structs[index][1]
-        answer.append(CodeGeneratorResponse.File(
-            name=fn.replace('.proto', '_pb2.py'),
-            insertion_point='class_scope:%s' % struct.name,
-            content=',\n\'__doc__\': """{docstring}""",'.format(
-                docstring=struct.get_python_docstring(meta_docstrings[index]),
-            ),
-        ))
-        index += 1
-
-    for fn in _init_files(comment_data.keys()):
-        answer.append(CodeGeneratorResponse.File(
-            name=fn,
-            content='',
-        ))
-    cgr = CodeGeneratorResponse(file=answer)
-    output_file.write(cgr.SerializeToString())
+    Args:
+        argv (list[str]): Optional. The path of a serialized
+            ``CodeGeneratorRequest``, and the path the
+            ``CodeGeneratorResponse`` is written to; by default,
+            ``sys.argv[1:]``.
+        cache (Any): Optional. See :func:`main`.
+        backend (Any): Optional. See :func:`main`.
+    """
+    parser = argparse.ArgumentParser(
+        description='Add docstrings to the Python code generated for a '
+                    'CodeGeneratorRequest.',
+    )
+    parser.add_argument('request', help='The serialized request.')
+    parser.add_argument('response', help='Where the response is written.')
+    args = parser.parse_args(argv)
+    with io.open(args.request, 'rb') as input_file:
+        with io.open(args.response, 'wb') as output_file:
+            main(input_file=input_file, output_file=output_file, cache=cache,
+                 backend=backend)
 
 
 def _init_files(fns=()):
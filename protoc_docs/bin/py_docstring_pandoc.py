@@ -1,8 +1,13 @@
 import os
+import sys
 
+from protoc_docs import worker
 from protoc_docs.bin import py_docstring
 
 if __name__ == '__main__':
     os.environ['PYPANDOC_PANDOC'] = os.path.join(
         os.path.abspath(__file__).rsplit("protoc_docs", 1)[0], "pandoc")
+    if sys.argv[1:]:
+        # Run by a Bazel action rather than by protoc; see docs_plugin.bzl.
+        sys.exit(worker.main(py_docstring.run))
     py_docstring.main()
@@ -0,0 +1,332 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import collections
+import errno
+import hashlib
+import io
+import os
+import random
+import tempfile
+
+
+class ConversionCache(object):
+    """A persistent, content-addressed cache of markup conversions.
+
+    Every entry is stored in its own file, named after a hash of the text
+    being converted together with the source and target formats and the
+    version of the converter. Entries are never modified once written, so
+    any number of processes (for example, parallel protoc or Bazel actions)
+    may share the same cache directory: writers create a temporary file and
+    atomically rename it into place, and readers treat a vanished or
+    unreadable entry as a miss.
+
+    When the total size of the cache exceeds ``max_size`` bytes, the least
+    recently used entries are evicted until the cache is back under its low
+    water mark. So that a run need not list the whole cache, the total size
+    is kept in a file, to which each run adds the size of what it wrote;
+    the cache is only listed when that total exceeds ``max_size`` (or is
+    missing), and on an occasional run, to correct the total for
+    concurrent runs whose additions were lost.
+
+    Args:
+        path (str): The directory holding the cache. It is created if it
+            does not exist.
+        max_size (int): The maximum size of the cache, in bytes.
+    """
+
+    ENV_DIR = 'PROTOC_DOCS_CACHE_DIR'
+    ENV_MAX_SIZE = 'PROTOC_DOCS_CACHE_MAX_SIZE'
+
+    DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+    # Fraction of ``max_size`` the cache is trimmed down to on eviction, so
+    # that every subsequent write does not trigger another full scan.
+    _LOW_WATER = 0.9
+
+    # The fraction of runs which list the cache even though its recorded
+    # size is under ``max_size``.
+    _RESCAN_RATE = 1.0 / 64
+
+    _TMP_PREFIX = '.tmp-'
+    _SIZE_NAME = '.size'
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._written = 0
+        _makedirs(path)
+
+    @classmethod
+    def from_environ(cls, environ=None):
+        """Return a cache configured from the environment, if any.
+
+        Args:
+            environ (dict): Optional. The environment to read; defaults to
+                ``os.environ``.
+
+        Returns:
+            ConversionCache: The cache, or ``None`` if
+                ``PROTOC_DOCS_CACHE_DIR`` is not set.
+        """
+        environ = os.environ if environ is None else environ
+        path = environ.get(cls.ENV_DIR)
+        if not path:
+            return None
+        max_size = int(environ.get(cls.ENV_MAX_SIZE, cls.DEFAULT_MAX_SIZE))
+        return cls(path, max_size=max_size)
+
+    @staticmethod
+    def key(text, format, to, version):
+        """Return the cache key for a conversion.
+
+        Args:
+            text (str): The text to be converted.
+            format (str): The markup format of ``text``.
+            to (str): The markup format ``text`` is converted to.
+            version (str): The version of the converter.
+
+        Returns:
+            str: A hex digest identifying the conversion.
+        """
+        digest = hashlib.sha256()
+        for part in (format, to, version, text):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached conversion for ``key``, or ``None``."""
+        path = self._entry_path(key)
+        try:
+            with io.open(path, 'r', encoding='utf-8', newline='') as f:
+                value = f.read()
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+
+        # Bump the modification time so that eviction is least recently
+        # used rather than least recently written.
+        try:
+            os.utime(path, None)
+        except OSError:  # pragma: NO COVER
+            pass  # Evicted concurrently; the value we read is still good.
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Store the conversion ``value`` under ``key``."""
+        path = self._entry_path(key)
+        directory = os.path.dirname(path)
+        _makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(prefix=self._TMP_PREFIX, dir=directory)
+        try:
+            with io.open(fd, 'w', encoding='utf-8', newline='') as f:
+                f.write(value)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):  # pragma: NO COVER
+            # Another process won the race for an identical entry, or the
+            # disk is full; either way the cache is only an optimization.
+            _remove(tmp_path)
+            return
+        self.writes += 1
+        self._written += len(value.encode('utf-8'))
+
+    def evict(self):
+        """Trim the cache to its low water mark if it exceeds ``max_size``.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        size_path = os.path.join(self.path, self._SIZE_NAME)
+        recorded = _read_size(size_path)
+        written, self._written = self._written, 0
+        if recorded is not None and random.random() >= self._RESCAN_RATE:
+            recorded += written
+            if recorded <= self.max_size:
+                self._write_size(size_path, recorded)
+                return 0
+
+        entries = []
+        total = 0
+        for directory, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                if directory == self.path and filename == self._SIZE_NAME:
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:  # pragma: NO COVER
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        removed = 0
+        if total > self.max_size:
+            target = self.max_size * self._LOW_WATER
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                if _remove(path):
+                    removed += 1
+                total -= size
+        self._write_size(size_path, total)
+        self.evictions += removed
+        return removed
+
+    def stats(self):
+        """Return the hit, miss, write and eviction counters.
+
+        Returns:
+            dict: A mapping of counter names to values.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'evictions': self.evictions,
+        }
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def _write_size(self, path, size):
+        fd, tmp_path = tempfile.mkstemp(prefix=self._TMP_PREFIX, dir=self.path)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('%d\n' % size)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):  # pragma: NO COVER
+            _remove(tmp_path)
+
+
+class MemoryCache(object):
+    """An in-memory, least recently used cache of markup conversions.
+
+    This suits long-lived processes (such as persistent workers) which
+    convert many batches. It may be layered over a :class:`ConversionCache`,
+    in which case entries missing from memory are looked up there, and new
+    entries are written to both.
+
+    Args:
+        max_size (int): The maximum total size of the cached conversions, in
+            characters.
+        fallback (ConversionCache): Optional. A persistent cache behind this
+            one.
+    """
+
+    DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+    key = staticmethod(ConversionCache.key)
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, fallback=None):
+        self.max_size = max_size
+        self.fallback = fallback
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the cached conversion for ``key``, or ``None``."""
+        value = self._entries.pop(key, None)
+        if value is not None:
+            # Re-insert, so that the entry is now the most recently used.
+            self._entries[key] = value
+            self.hits += 1
+            return value
+        self.misses += 1
+        if self.fallback is not None:
+            value = self.fallback.get(key)
+            if value is not None:
+                self._store(key, value)
+        return value
+
+    def put(self, key, value):
+        """Store the conversion ``value`` under ``key``."""
+        self._store(key, value)
+        self.writes += 1
+        if self.fallback is not None:
+            self.fallback.put(key, value)
+
+    def evict(self):
+        """Trim the persistent cache behind this one, if any.
+
+        The in-memory entries are trimmed as they are added.
+
+        Returns:
+            int: The number of persistent entries removed.
+        """
+        if self.fallback is None:
+            return 0
+        return self.fallback.evict()
+
+    def stats(self):
+        """Return the hit, miss, write and eviction counters.
+
+        Returns:
+            dict: A mapping of counter names to values.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'evictions': self.evictions,
+        }
+
+    def _store(self, key, value):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self._entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_size and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+
+def _read_size(path):
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        return False
+    return True
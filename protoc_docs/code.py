@@ -15,29 +15,55 @@
 from __future__ import absolute_import
 
 import collections
+import re
 import textwrap
 import sys
 
-class MessageStructure(object):
-    """A class representing the structure for a proto message.
+from protoc_docs import framing
+
+# Plain dicts keep insertion order (and are smaller) from Python 3.7 on.
+if sys.version_info >= (3, 7):
+    _OrderedDict = dict
+else:  # pragma: NO COVER
+    _OrderedDict = collections.OrderedDict
+
+# The wrappers used for docstrings, by indentation. Wrapping does not change
+# a wrapper, so they are shared by every structure.
+_WRAPPERS = dict(
+    (indent, textwrap.TextWrapper(initial_indent=' ' * indent,
+                                  subsequent_indent=' ' * indent))
+    for indent in (0, 8, 12)
+)
+
+# Whitespace which ``TextWrapper`` turns into spaces (or, for tabs, expands).
+_UNWRAPPED_WHITESPACE_RE = re.compile(r'[\t\x0b\x0c\r]')
+
+
+class MessageStructureRegistry(object):
+    """The ``MessageStructure`` objects found while parsing one request.
 
-    This class is its own registry; calling the with the same message name
-    will return the same object.
+    Asking the registry for the same message name returns the same object.
+    Each :class:`~protoc_docs.parser.CodeGeneratorParser` owns its own
+    registry, so nothing is shared between requests (or between threads
+    handling different requests), and everything is freed along with the
+    parser.
     """
-    _registry = {}
+    __slots__ = ('_structures',)
 
-    # A random sequence of alphanumerical characters used as a token to
-    # concatenate different docstrings together, then make a single pypandoc
-    # call and split the returned result again using the same token. This allows
-    # us to reduce an average number of calls to a child process (pypandoc
-    # starts a pandoc subprocess) from several hundreds to a single call per
-    # API. This execution reduces time by several orders of magnitude
-    # (from ~10 secs to fractions of a second per API).
-    _BATCH_TOKEN = "D55406F6B511E8"
+    def __init__(self):
+        self._structures = {}
 
-    @classmethod
-    def get_or_create(cls, name):
-        """Return a Message object.
+    def __len__(self):
+        return len(self._structures)
+
+    def __iter__(self):
+        return iter(self._structures.values())
+
+    def __contains__(self, name):
+        return name in self._structures
+
+    def get_or_create(self, name):
+        """Return the ``MessageStructure`` for a message.
 
         Args:
             name (str): The fully qualified name of the message (for example:
@@ -46,13 +72,38 @@ class MessageStructure(object):
         Returns:
             ``MessageStructure``: A ``MessageStructure`` object.
         """
-        cls._registry.setdefault(name, cls(name=name))
-        return cls._registry[name]
+        try:
+            return self._structures[name]
+        except KeyError:
+            structure = self._structures[name] = MessageStructure(name=name)
+            return structure
+
+    def clear(self):
+        """Forget every ``MessageStructure`` in the registry."""
+        self._structures.clear()
+
+
+class MessageStructure(object):
+    """A class representing the structure for a proto message.
+
+    Use :meth:`MessageStructureRegistry.get_or_create` to get the structure
+    for a message name.
+    """
+    __slots__ = ('name', 'docstring', 'members')
+
+    # A random sequence of alphanumerical characters used as a token to
+    # frame different docstrings together, then make a single pypandoc
+    # call and split the returned result again using the same token. This allows
+    # us to reduce an average number of calls to a child process (pypandoc
+    # starts a pandoc subprocess) from several hundreds to a single call per
+    # API. This execution reduces time by several orders of magnitude
+    # (from ~10 secs to fractions of a second per API).
+    _BATCH_TOKEN = "D55406F6B511E8"
 
     def __init__(self, name):
         self.name = name
         self.docstring = ''
-        self.members = collections.OrderedDict()
+        self.members = _OrderedDict()
 
     def __hash__(self):
         """Return a hash for this object based on its name.
@@ -63,79 +114,127 @@ class MessageStructure(object):
         return hash(self.name)
 
     def __repr__(self):
-        tw8 = textwrap.TextWrapper(
-            initial_indent=' ' * 8,
-            subsequent_indent=' ' * 8,
-        )
-        tw12 = textwrap.TextWrapper(
-            initial_indent=' ' * 12,
-            subsequent_indent=' ' * 12,
-        )
-
-        answer =  'MessageStructure {\n'
-        answer += '    name: {0}\n'.format(self.name)
-        answer += '    docstring:\n{0}\n'.format(
-            '\n'.join(tw8.wrap(self.docstring)),
-        )
+        parts = [
+            'MessageStructure {\n',
+            '    name: ', self.name, '\n',
+            '    docstring:\n', _fill(self.docstring, 8), '\n',
+        ]
         if len(self.members):
-            answer += '    members:\n'
+            parts.append('    members:\n')
         for k, v in self.members.items():
-            answer += '        {name}:\n{doc}\n'.format(
-                name=k,
-                doc='\n'.join(tw12.wrap(v)),
-            )
-        answer += '}\n'
-        return answer
+            parts.extend(('        ', k, ':\n', _fill(v, 12), '\n'))
+        parts.append('}\n')
+        return ''.join(parts)
 
-    def get_meta_docstring(self):
-        meta_docstring = ''
+    def get_docstrings(self):
+        """Return the texts making up the docstring: the message's own
+        docstring (if it has one), followed by the docstring of each member.
 
-        if self.docstring:
-            meta_docstring += self.docstring
+        Returns:
+            list[str]: The texts, in order.
+        """
+        docstrings = [self.docstring] if self.docstring else []
+        docstrings.extend(self.members.values())
+        return docstrings
 
-        # Concatenate members adding new line and a _BATCH_TOKEN between each
-        # member, such that the members list can be restored later (after
-        # formatting) by simply splitting the big string by the same
-        # _BATCH_TOKEN.
-        for k, v in self.members.items():
-            if meta_docstring:
-                meta_docstring += "\n%s" % MessageStructure._BATCH_TOKEN
-            meta_docstring += v
+    def get_meta_docstring(self):
+        """Return the texts making up the docstring as a single document.
+
+        The texts are framed with _BATCH_TOKEN (see
+        :mod:`protoc_docs.framing`), such that the document can be converted
+        as a whole and split back into the texts by
+        :meth:`get_python_docstring`.
 
-        return meta_docstring
+        Returns:
+            str: The document.
+        """
+        return framing.frame(self.get_docstrings(),
+                             MessageStructure._BATCH_TOKEN)
 
-    def get_python_docstring(self, docstring = None):
-        tw8 = textwrap.TextWrapper(
-            initial_indent=' ' * 8,
-            subsequent_indent=' ' * 8,
-        )
+    def get_python_docstring(self, docstring=None):
+        """Return the Python docstring for the message.
 
-        tw0 = textwrap.TextWrapper()
+        Args:
+            docstring (str): Optional. The (converted) document returned by
+                :meth:`get_meta_docstring`. If its framing did not survive
+                the conversion, the unconverted texts are used instead.
 
-        meta_docstring = docstring if docstring else self.get_meta_docstring()
+        Returns:
+            str: The docstring.
+        """
+        docstrings = self.get_docstrings()
+        if docstring:
+            # Reconstruct the docstrings list by splitting the meta docstring
+            # by the same _BATCH_TOKEN which was used to frame them.
+            converted = framing.unframe(
+                docstring, MessageStructure._BATCH_TOKEN, len(docstrings))
+            if converted is not None:
+                docstrings = converted
+        return self.render_python_docstring(docstrings)
+
+    def render_python_docstring(self, docstrings):
+        """Return the Python docstring for the message.
 
-        answer = ''
+        Args:
+            docstrings (list[str]): The (converted) texts returned by
+                :meth:`get_docstrings`, in the same order.
 
-        # Reconstruct the docstrings list by splitting the meta_docstring
-        # by same _BATCH_TOKEN which was used to concatenate them
-        meta_vals = meta_docstring.split(MessageStructure._BATCH_TOKEN)
-        meta_index = 0
+        Returns:
+            str: The docstring.
+        """
+        parts = []
+        docstrings = iter(docstrings)
         if self.docstring:
-            answer += '\n'.join(tw0.wrap(meta_vals[meta_index]))
-            meta_index += 1
+            parts.append(_fill(next(docstrings)))
             if len(self.members):
-                answer += '\n\n'
+                parts.append('\n\n')
         if len(self.members):
-            answer += 'Attributes:\n'
+            parts.append('Attributes:\n')
 
-        keys = list(self.members.keys())
-        keys_index = 0
-        while meta_index < len(meta_vals) and keys_index < len(keys):
-            v = meta_vals[meta_index]
-            k = keys[keys_index]
-            answer += '    %s:\n%s\n' %  (k, '\n'.join(tw8.wrap(v)))
-            meta_index += 1
-            keys_index += 1
+        for k, v in zip(self.members, docstrings):
+            parts.extend(('    ', k, ':\n', _fill(v, 8), '\n'))
 
         # Done.
-        return answer
+        return ''.join(parts)
+
+
+def _fill(text, indent=0):
+    """Wrap a text as ``TextWrapper`` does, indenting every line.
+
+    Text which is already wrapped within the width (as ``pandoc`` wraps its
+    output) comes out of ``TextWrapper`` as it went in, save for the
+    indentation, so it is only indented.
+
+    Args:
+        text (str): The text.
+        indent (int): The indentation; 0, 8 or 12.
+
+    Returns:
+        str: The wrapped lines, joined by newlines.
+    """
+    wrapper = _WRAPPERS[indent]
+    lines = text.rstrip('\n').split('\n')
+    if not _is_wrapped(lines, wrapper.width - indent, text):
+        return '\n'.join(wrapper.wrap(text))
+    if not indent:
+        return '\n'.join(lines)
+    prefix = wrapper.initial_indent
+    return prefix + ('\n' + prefix).join(lines)
+
+
+def _is_wrapped(lines, width, text):
+    """Return whether ``TextWrapper`` would leave lines as they are."""
+    if _UNWRAPPED_WHITESPACE_RE.search(text):
+        return False
+    for index, line in enumerate(lines):
+        if (not line or len(line) > width or
+                line[0] == ' ' or line[-1] == ' '):
+            return False
+        if index:
+            # The first word of the line must not have fit at the end of the
+            # previous one. Words holding hyphens may be broken up, so they
+            # are not looked into.
+            word = line.split(' ', 1)[0]
+            if '-' in word or len(lines[index - 1]) + 1 + len(word) <= width:
+                return False
+    return True
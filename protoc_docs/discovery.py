@@ -0,0 +1,216 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Finding ``pandoc`` without running it first.
+
+Left to itself, pypandoc finds ``pandoc`` by running every binary it knows
+of with ``--version``, in every process, before converting anything. Since a
+run of the plugin is short, and there is one for every ``protoc``
+invocation, :func:`find_pandoc` looks for the binary instead: the one named
+by ``PROTOC_DOCS_PANDOC`` (or by pypandoc's own ``PYPANDOC_PANDOC``), or else
+the newest of the binaries pypandoc would have considered. :func:`get_version`
+probes a binary's version once, and remembers it in a file only the current
+user can write to, keyed by the binary's path, size and modification time, so
+that later runs need not probe it again. :func:`use_pandoc` then hands the
+path and version to pypandoc.
+"""
+
+from __future__ import absolute_import
+
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+import pypandoc
+
+from protoc_docs import runtime
+
+
+ENV_PANDOC = 'PROTOC_DOCS_PANDOC'
+ENV_PANDOC_VERSION = 'PROTOC_DOCS_PANDOC_VERSION'
+
+# The variable pypandoc reads the path of ``pandoc`` from.
+ENV_PYPANDOC_PANDOC = 'PYPANDOC_PANDOC'
+
+# A version, as the first line of ``pandoc --version`` holds it.
+_VERSION_RE = re.compile(r'^\d+(\.\d+)+$')
+
+
+def find_pandoc(environ=None, cache_path=None):
+    """Return the path of the ``pandoc`` binary to use.
+
+    Like pypandoc, this prefers the newest of the first ``pandoc`` on the
+    ``PATH``, the one bundled with pypandoc, and the ones pypandoc installs;
+    but their versions are remembered (see :func:`get_version`) rather than
+    probed on every run.
+
+    Args:
+        environ (dict): Optional. The environment to read; defaults to
+            ``os.environ``.
+        cache_path (str): Optional. The file in which versions are
+            remembered between runs.
+
+    Returns:
+        str: The path, or ``None`` if no usable ``pandoc`` was found (and
+            none is named by the environment); pypandoc then looks for one
+            itself.
+    """
+    environ = os.environ if environ is None else environ
+    for name in (ENV_PANDOC, ENV_PYPANDOC_PANDOC):
+        if environ.get(name):
+            return os.path.expanduser(environ[name])
+
+    found, found_version = None, ()
+    for path in _candidates(environ):
+        try:
+            version = tuple(
+                int(part)
+                for part in get_version(path, cache_path=cache_path).split('.')
+            )
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            continue
+        if version > found_version:
+            found, found_version = path, version
+    return found
+
+
+def get_version(path, cache_path=None):
+    """Return the version of a ``pandoc`` binary.
+
+    Args:
+        path (str): The path of the binary.
+        cache_path (str): Optional. The file in which versions are
+            remembered between runs; see :func:`default_cache_path`.
+
+    Returns:
+        str: The version, as pypandoc reports it (for example, ``2.2.1``).
+    """
+    if cache_path is None:
+        try:
+            cache_path = default_cache_path()
+        except OSError:
+            return probe_version(path)
+    key = os.path.realpath(path)
+    status = os.stat(key)
+    stamp = [status.st_size, status.st_mtime]
+
+    versions = _read_versions(cache_path)
+    entry = versions.get(key)
+    if isinstance(entry, dict) and entry.get('stamp') == stamp:
+        return entry['version']
+
+    version = probe_version(path)
+    versions[key] = {'stamp': stamp, 'version': version}
+    _write_versions(cache_path, versions)
+    return version
+
+
+def probe_version(path):
+    """Run a ``pandoc`` binary to find out its version.
+
+    Raises:
+        ValueError: If the binary does not report a version.
+    """
+    output = subprocess.check_output([path, '--version'])
+    lines = output.decode('utf-8', 'replace').splitlines()
+    for token in (lines[0].split() if lines else ()):
+        if _VERSION_RE.match(token):
+            return token
+    raise ValueError('%s did not report its version.' % path)
+
+
+def default_cache_path():
+    """Return the file in which the versions of ``pandoc`` binaries are
+    remembered.
+
+    Raises:
+        OSError: If there is no private directory to keep it in; see
+            :func:`protoc_docs.runtime.private_dir`.
+    """
+    return os.path.join(runtime.private_dir(), 'pandoc-versions.json')
+
+
+def use_pandoc(path, version=None):
+    """Make pypandoc use a ``pandoc`` binary without looking for one, or
+    probing its version.
+
+    pypandoc has no API for this, so its own record of what it found is
+    filled in; a pypandoc keeping it elsewhere looks for ``pandoc`` as usual.
+
+    Args:
+        path (str): The path of the binary.
+        version (str): Optional. Its version.
+    """
+    for name, value in (('__pandoc_path', path), ('__version', version)):
+        if value is not None and hasattr(pypandoc, name):
+            setattr(pypandoc, name, value)
+
+
+def _candidates(environ):
+    paths = []
+    for directory in environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory, 'pandoc')
+        if _is_executable(path):
+            paths.append(path)
+            break
+    paths.extend(path for path in _installed_paths() if _is_executable(path))
+    return paths
+
+
+def _installed_paths():
+    # Where pypandoc looks for ``pandoc`` besides the ``PATH``: the copy
+    # bundled with it, and where it downloads one to.
+    return [
+        os.path.join(os.path.dirname(os.path.realpath(pypandoc.__file__)),
+                     'files', 'pandoc'),
+        os.path.expanduser(os.path.join('~', 'bin', 'pandoc')),
+        os.path.expanduser(os.path.join('~', '.bin', 'pandoc')),
+        os.path.join(sys.exec_prefix, 'bin', 'pandoc'),
+    ]
+
+
+def _is_executable(path):
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+
+def _read_versions(path):
+    # Anyone else able to write the file could make a binary seem to be of
+    # another version.
+    if not runtime.is_private(path):
+        return {}
+    try:
+        with io.open(path, encoding='utf-8') as f:
+            versions = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    return versions if isinstance(versions, dict) else {}
+
+
+def _write_versions(path, versions):
+    # The versions are only remembered to save time later, so failing to
+    # write them is not an error.
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    except (IOError, OSError):  # pragma: NO COVER
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(versions, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):  # pragma: NO COVER
+        os.remove(tmp_path)
@@ -0,0 +1,102 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Framing several texts as one document, so that they are converted at once.
+
+The texts are separated by numbered sentinel paragraphs: the batch token
+followed by the position of the text which follows. Each sentinel is a
+paragraph of its own, so a text's markup cannot run into its neighbours',
+and each text is converted as it would be on its own.
+
+After conversion, the sentinels must all be found, in order, each alone on
+an unindented line. If they are not (because the converter escaped or moved
+one, or a text's markup swallowed one, such as an unclosed code fence), the
+converted document cannot be split safely and :func:`unframe` says so,
+rather than returning misaligned texts.
+"""
+
+from __future__ import absolute_import
+
+# Bump whenever the way texts are framed changes the converted texts, so
+# that conversions cached under the old framing are not reused.
+VERSION = '2'
+
+
+def frame(texts, token):
+    """Join texts into one document, separated by sentinels.
+
+    Args:
+        texts (list[str]): The texts. None of them may contain ``token``;
+            see :func:`collides`.
+        token (str): The batch token.
+
+    Returns:
+        str: The document.
+    """
+    parts = []
+    for index, text in enumerate(texts):
+        if index:
+            parts.append('\n\n%s%d\n\n' % (token, index))
+        parts.append(text)
+    return ''.join(parts)
+
+
+def unframe(document, token, count):
+    """Split a converted document back into the converted texts.
+
+    Args:
+        document (str): The converted document.
+        token (str): The batch token the texts were framed with.
+        count (int): The number of texts.
+
+    Returns:
+        list[str]: The converted texts, each ending in a single newline (as
+            converting a text on its own does), or ``None`` if the sentinels
+            did not come through the conversion intact.
+    """
+    if count <= 1:
+        return [normalize(document)] * count
+
+    pieces = document.split(token)
+    if len(pieces) != count:
+        return None
+
+    answer = []
+    last = count - 1
+    for index, piece in enumerate(pieces):
+        if index:
+            # The piece starts with the number of the sentinel, which must
+            # be alone on its line.
+            label = str(index)
+            if (not piece.startswith(label) or
+                    piece[len(label):len(label) + 1] not in ('\n', '')):
+                return None
+            piece = piece[len(label):]
+        # The next sentinel must start a line.
+        if index < last and not piece.endswith('\n') and (index or piece):
+            return None
+        answer.append(normalize(piece))
+    return answer
+
+
+def collides(text, token):
+    """Return whether a text cannot be framed with a token, because it
+    contains the token."""
+    return token in text
+
+
+def normalize(text):
+    """Return a converted text ending in a single newline, as converting it
+    on its own with the ``pandoc`` CLI does."""
+    return text.strip('\n') + '\n'
@@ -0,0 +1,200 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-stage timing and resource statistics for a run.
+
+A :class:`Recorder` collects how long each stage of a run took (wall clock
+and CPU time), the peak memory use, and counters such as the number of
+comments and of conversion calls. When enabled, the statistics are written
+as JSON lines, one per stage and one for the whole run, either to a file or
+to stderr (stdout is ``protoc``'s channel).
+
+Statistics are enabled by the ``PROTOC_DOCS_STATS`` environment variable,
+or the ``stats`` plugin parameter (``--pydocstring_out=stats=PATH:DIR``),
+set to a file to append to, or ``-`` for stderr.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # pragma: NO COVER
+    resource = None
+
+try:
+    _process_time = time.process_time
+except AttributeError:  # pragma: NO COVER
+    _process_time = time.clock
+
+
+ENV_STATS = 'PROTOC_DOCS_STATS'
+
+# The plugin parameter naming where statistics are written.
+PARAMETER = 'stats'
+
+
+class Recorder(object):
+    """Collects the statistics of one run.
+
+    Args:
+        tool (str): The name of the program being run.
+    """
+
+    def __init__(self, tool):
+        self.tool = tool
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._start_cpu = _process_time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a stage of the run.
+
+        A stage may be entered more than once (for example, once for each
+        group of files); its times are added up.
+
+        Args:
+            name (str): The name of the stage.
+        """
+        start = time.time()
+        start_cpu = _process_time()
+        try:
+            yield
+        finally:
+            wall = time.time() - start
+            cpu = _process_time() - start_cpu
+            with self._lock:
+                stage = self.stages.setdefault(
+                    name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+                stage['calls'] += 1
+                stage['wall'] += wall
+                stage['cpu'] += cpu
+                stage['max_rss_kb'] = max_rss_kb()
+
+    def add(self, name, value=1):
+        """Add to a counter.
+
+        This is safe to call from several threads.
+
+        Args:
+            name (str): The name of the counter.
+            value (int): The amount to add.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def events(self):
+        """Return the statistics, as a list of JSON-serializable dicts.
+
+        There is one for each stage, in the order in which they first ran,
+        followed by one for the whole run.
+        """
+        answer = []
+        for name, stage in self.stages.items():
+            event = collections.OrderedDict(
+                [('tool', self.tool), ('event', 'stage'), ('stage', name)])
+            event.update(sorted(stage.items()))
+            answer.append(event)
+        answer.append(collections.OrderedDict([
+            ('tool', self.tool),
+            ('event', 'run'),
+            ('pid', os.getpid()),
+            ('wall', time.time() - self._start),
+            ('cpu', _process_time() - self._start_cpu),
+            ('max_rss_kb', max_rss_kb()),
+            ('counters', self.counters),
+        ]))
+        return answer
+
+    def write(self, target):
+        """Write the statistics as JSON lines.
+
+        Args:
+            target (str): The file to append to, or ``-`` for stderr. If
+                empty, nothing is written.
+        """
+        if not target:
+            return
+        lines = ''.join(json.dumps(e) + '\n' for e in self.events())
+        if target == '-':
+            sys.stderr.write(lines)
+            sys.stderr.flush()
+        else:
+            with open(target, 'a') as f:
+                f.write(lines)
+
+
+class CountingStream(object):
+    """Wraps a binary file-like object, counting the bytes read and written.
+
+    Args:
+        stream (Any): The file-like object.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.count += len(data)
+        return data
+
+    def write(self, data):
+        self.stream.write(data)
+        self.count += len(data)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def get_target(parameter=None, environ=None):
+    """Return where statistics should be written, if anywhere.
+
+    Args:
+        parameter (str): Optional. The plugin parameter, a comma-separated
+            list of ``key=value`` pairs; its ``stats`` value takes
+            precedence over the environment.
+        environ (dict): Optional. The environment to read; defaults to
+            ``os.environ``.
+
+    Returns:
+        str: A path, ``-`` for stderr, or ``None``.
+    """
+    for pair in (parameter or '').split(','):
+        key, _, value = pair.partition('=')
+        if key.strip() == PARAMETER and value.strip():
+            return value.strip()
+    environ = os.environ if environ is None else environ
+    return environ.get(ENV_STATS) or None
+
+
+def max_rss_kb():
+    """Return the peak resident set size of this process, in KiB."""
+    if resource is None:  # pragma: NO COVER
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # pragma: NO COVER
+        rss //= 1024  # macOS reports bytes, Linux KiB.
+    return rss
@@ -0,0 +1,350 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A pure-Python converter for the markdown found in proto comments.
+
+Proto comments overwhelmingly use a tiny subset of markdown: paragraphs,
+simple bullet and numbered lists, inline code, emphasis and links. This
+module converts that subset to reStructuredText the same way ``pandoc``
+does, without spawning a subprocess.
+
+The converter is deliberately conservative. Anything it does not fully
+understand (headings, code blocks, nested lists, reference links, HTML,
+escapes, and so on) makes :func:`to_rst` return ``None``, in which case the
+comment must be converted by ``pandoc`` instead. So do characters which
+``pandoc`` spaces or measures differently than this module: whitespace and
+control characters other than spaces and newlines, wide characters, and
+combining or invisible ones.
+"""
+
+from __future__ import absolute_import
+
+import re
+import textwrap
+import unicodedata
+
+
+# The formats understood by ``to_rst``. ``md`` is pypandoc's alias for
+# pandoc's own markdown dialect.
+FORMATS = ('commonmark', 'md', 'markdown')
+
+# pandoc wraps reStructuredText output at 72 columns by default.
+WIDTH = 72
+
+# Characters which are markup in every supported dialect (or in rst) when
+# they appear outside of a recognized construct.
+_UNSAFE = frozenset('\\`*[]<>&|')
+
+# Characters which pandoc's markdown (but not commonmark) gives meaning to:
+# smart quotes, tex math, super/subscripts, strikeout, citations and
+# attributes.
+_UNSAFE_PANDOC_MARKDOWN = _UNSAFE | frozenset('\'"$^~@{}')
+
+# pandoc's markdown joins these to the following word with a non-breaking
+# space (see pandoc's ``data/abbreviations``).
+_ABBREVIATIONS = frozenset([
+    'Mr.', 'Mrs.', 'Ms.', 'Capt.', 'Dr.', 'Prof.', 'Gen.', 'Gov.', 'e.g.',
+    'i.e.', 'Sgt.', 'St.', 'vol.', 'vs.', 'Sen.', 'Rep.', 'Pres.', 'Hon.',
+    'Rev.', 'Ph.D.', 'M.D.', 'M.A.', 'p.', 'pp.', 'ch.', 'sec.', 'cf.', 'cp.',
+])
+
+# Characters which may precede, and follow, inline markup in rst without
+# needing to be escaped.
+_OPENERS = frozenset(' \'"([{-/:')
+_CLOSERS = frozenset(' \'")]}-/:.,;!?')
+
+_CONTENT = r'[^\s*_`\[\]\\](?:[^*_`\[\]\\]*[^\s*_`\[\]\\])?'
+_INLINE_RE = re.compile(
+    r'`(?P<code>[^`]+)`'
+    r'|\*\*(?P<strong>' + _CONTENT + r')\*\*'
+    r'|\*(?P<emph>' + _CONTENT + r')\*'
+    r'|(?<![A-Za-z0-9])_(?P<uemph>' + _CONTENT + r')_(?![A-Za-z0-9])'
+    r'|\[(?P<text>[^\[\]]+)\]\((?P<uri>[^\s()<>`\\]+)\)'
+)
+
+_WORD_SEPARATOR_RE = re.compile(r'[ \n]+')
+
+# Plain text may only use the characters whose spacing and width this module
+# is sure to measure as pandoc does.
+_PRINTABLE_ASCII_RE = re.compile(r'[\n\x20-\x7e]*\Z')
+
+_BULLET_RE = re.compile(r'^(?P<marker>[-*]) {1,4}(?P<text>\S.*)$')
+_ORDERED_RE = re.compile(r'^(?P<number>\d)\. {1,4}(?P<text>\S.*)$')
+
+# Lines which start a block construct this module does not handle, in
+# either markdown or rst (headings, quotes, fences, tables, rules, other
+# list styles, definition lists, directives, comments, and so on).
+_BLOCK_START_RE = re.compile(
+    r'^(?:[#>|+=:%~]'
+    r'|```'
+    r'|\.\.'
+    r'|[-*_]{3,}\s*$'
+    r'|-\s*$'
+    r'|[-*] '
+    r'|(?:\d+|[A-Za-z]|[ivxlcdmIVXLCDM]+|#)[.)](?:\s|$)'
+    r'|\((?:\d+|[A-Za-z]|[ivxlcdmIVXLCDM]+|#|@)\)'
+    r'|-[-\w])'
+)
+
+
+def to_rst(text, format='commonmark'):
+    """Convert markdown to reStructuredText, if the markdown is simple enough.
+
+    Args:
+        text (str): The markdown to convert.
+        format (str): The markdown dialect; one of :data:`FORMATS`.
+
+    Returns:
+        str: The reStructuredText, formatted as ``pandoc`` would format it,
+            or ``None`` if ``text`` uses markdown this module cannot convert.
+    """
+    if format not in FORMATS:
+        return None
+    if _has_unsupported_chars(text):
+        return None
+    if '  \n' in text:
+        return None  # A hard line break.
+    unsafe = _UNSAFE if format == 'commonmark' else _UNSAFE_PANDOC_MARKDOWN
+    smart = format != 'commonmark'
+
+    blocks = []
+    ordinal = None
+    for lines in _split_blocks(text):
+        first = lines[0].lstrip(' ')
+        if len(lines[0]) - len(first) > 3:
+            return None  # An indented code block.
+
+        match = _BULLET_RE.match(first) or _ORDERED_RE.match(first)
+        if match is None:
+            ordinal = None
+            if _BLOCK_START_RE.match(first):
+                return None
+            block = _paragraph(lines, unsafe, smart)
+        else:
+            # Consecutive ordered list items separated by blank lines belong
+            # to the same (loose) list, so keep counting across blocks.
+            if 'number' in match.groupdict():
+                if ordinal is None:
+                    ordinal = int(match.group('number'))
+                marker = '%d.' % ordinal
+                ordinal += 1
+            else:
+                ordinal = None
+                marker = '-'
+            block = _list_item(marker, match.group('text'), lines[1:],
+                               unsafe, smart)
+        if block is None:
+            return None
+        blocks.append(block)
+
+    if not blocks:
+        return ''
+    return '\n\n'.join(blocks) + '\n'
+
+
+def is_plain(text, format='commonmark'):
+    """Return whether markdown is nothing but paragraphs of plain text.
+
+    Converting such text to reStructuredText changes nothing but its
+    whitespace (``pandoc`` collapses spaces and rewraps each paragraph), so
+    it need not be sent to ``pandoc``: :func:`to_rst` converts it the same
+    way. Only printable ASCII text (and newlines) is plain.
+
+    Args:
+        text (str): The markdown.
+        format (str): The markdown dialect; one of :data:`FORMATS`.
+
+    Returns:
+        bool: Whether the text is plain.
+    """
+    if format not in FORMATS:
+        return False
+    if not _PRINTABLE_ASCII_RE.match(text) or '  \n' in text:
+        return False
+    unsafe = _UNSAFE if format == 'commonmark' else _UNSAFE_PANDOC_MARKDOWN
+    smart = format != 'commonmark'
+
+    for lines in _split_blocks(text):
+        if lines[0][:4] == '    ':
+            return False  # An indented code block.
+        for line in lines:
+            if _BLOCK_START_RE.match(line.lstrip(' ')):
+                return False
+        if _plain(' '.join(lines), unsafe, smart) is None:
+            return False
+    return True
+
+
+def _split_blocks(text):
+    """Split text into lists of non-blank lines separated by blank lines."""
+    block = []
+    for line in text.split('\n'):
+        if line.strip():
+            block.append(line.rstrip())
+        elif block:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def _paragraph(lines, unsafe, smart):
+    for line in lines[1:]:
+        if _BLOCK_START_RE.match(line.lstrip(' ')):
+            return None
+    inline = _inline(' '.join(line.strip() for line in lines), unsafe, smart)
+    if inline is None:
+        return None
+    return _wrap(inline, '')
+
+
+def _list_item(marker, text, continuation, unsafe, smart):
+    if _BLOCK_START_RE.match(text):
+        return None  # A nested list (or another block) in the item.
+    for line in continuation:
+        if _BLOCK_START_RE.match(line.lstrip(' ')):
+            return None  # A nested list, or something worse.
+    words = [text] + [line.strip() for line in continuation]
+    inline = _inline(' '.join(words), unsafe, smart)
+    if inline is None:
+        return None
+    return _wrap(inline, marker + ' ')
+
+
+def _wrap(text, marker):
+    indent = ' ' * len(marker)
+    lines = textwrap.wrap(
+        text,
+        width=WIDTH,
+        initial_indent=marker,
+        subsequent_indent=indent,
+        break_long_words=False,
+        break_on_hyphens=False,
+    )
+
+    # Wrapping may move something which looks like block markup to the
+    # start of a line, which would change its meaning in rst.
+    for line in lines[1:]:
+        if _BLOCK_START_RE.match(line[len(indent):]):
+            return None
+    return '\n'.join(lines).replace('\0', ' ')
+
+
+def _inline(text, unsafe, smart):
+    """Convert inline markup, or return ``None`` if it is not supported.
+
+    Spaces which must not be broken by wrapping are returned as NUL
+    characters.
+    """
+    parts = []
+    index = 0
+    for match in _INLINE_RE.finditer(text):
+        start, end = match.span()
+        if start > 0 and text[start - 1] not in _OPENERS:
+            return None
+        if end < len(text) and text[end] not in _CLOSERS:
+            return None
+
+        parts.append(_plain(text[index:start], unsafe, smart))
+        groups = match.groupdict()
+        if groups['code'] is not None:
+            code = groups['code']
+            if code != code.strip():
+                return None
+            parts.append('``%s``' % code.replace(' ', '\0'))
+        elif groups['text'] is not None:
+            link_text = _plain(groups['text'], unsafe, smart)
+            uri = groups['uri']
+            if link_text is None or link_text == uri or _bad_uri(uri):
+                return None
+            parts.append('`%s\0<%s>`__' % (link_text, uri))
+        else:
+            emphasis = _plain(
+                groups['strong'] or groups['emph'] or groups['uemph'],
+                unsafe, smart,
+            )
+            if emphasis is None:
+                return None
+            mark = '**' if groups['strong'] else '*'
+            parts.append(mark + emphasis + mark)
+        index = end
+    parts.append(_plain(text[index:], unsafe, smart))
+
+    if None in parts:
+        return None
+    return ''.join(parts)
+
+
+def _plain(text, unsafe, smart):
+    """Return plain text with whitespace collapsed, or ``None`` if it has
+    characters which would be interpreted as markup."""
+    for index, char in enumerate(text):
+        if char in unsafe:
+            return None
+        if char == '_' and not _intraword(text, index):
+            return None
+    if smart and ('--' in text or '...' in text):
+        return None
+    words = _words(text)
+    if smart and any(word.lstrip('(') in _ABBREVIATIONS for word in words):
+        return None
+    if '::' in text:
+        return None  # A literal block marker in rst.
+
+    # Keep the collapsed text's leading and trailing space, if any; it
+    # separates it from the surrounding markup.
+    if not words:
+        return ' ' if text else ''
+    answer = ' '.join(words)
+    if text[0] in ' \n':
+        answer = ' ' + answer
+    if text[-1] in ' \n':
+        answer += ' '
+    return answer
+
+
+def _words(text):
+    # pandoc only breaks lines at spaces and newlines; any other whitespace
+    # is rejected by _has_unsupported_chars.
+    return [word for word in _WORD_SEPARATOR_RE.split(text) if word]
+
+
+def _has_unsupported_chars(text):
+    """Return whether text has characters which pandoc does not space or
+    measure like this module: whitespace and control characters other than
+    spaces and newlines (which pandoc keeps, but ``str.split`` collapses),
+    and characters which are not one column wide."""
+    for char in text:
+        if ' ' <= char <= '~' or char == '\n':
+            continue
+        if char < ' ' or char.isspace():
+            return True
+        if unicodedata.east_asian_width(char) in ('W', 'F'):
+            return True
+        if unicodedata.category(char) in ('Cc', 'Cf', 'Mn', 'Me'):
+            return True
+    return False
+
+
+def _intraword(text, index):
+    return (0 < index < len(text) - 1 and
+            text[index - 1].isalnum() and text[index + 1].isalnum())
+
+
+def _bad_uri(uri):
+    try:
+        uri.encode('ascii')
+    except UnicodeError:
+        return True
+    return '&' in uri and ';' in uri
@@ -16,10 +16,16 @@ from __future__ import absolute_import
 
 import textwrap
 
-from protoc_docs.code import MessageStructure
+from protoc_docs import wire
+from protoc_docs.code import MessageStructureRegistry
 from google.protobuf import descriptor_pb2
+from google.protobuf.message import Message
 from google.protobuf.compiler.plugin_pb2 import CodeGeneratorRequest
 
+_FILE_TO_GENERATE = CodeGeneratorRequest.FILE_TO_GENERATE_FIELD_NUMBER
+_PROTO_FILE = CodeGeneratorRequest.PROTO_FILE_FIELD_NUMBER
+_FILE_NAME = descriptor_pb2.FileDescriptorProto.NAME_FIELD_NUMBER
+
 
 class CodeGeneratorParser(object):
     """Class to read the code generator request and parse comments.
@@ -32,6 +38,10 @@ class CodeGeneratorParser(object):
         request (:class:`google.protobuf.compiler.plugin_pb2.CodeGeneratorRequest`):
             The CodeGeneratorRequest, as an instantiated protobuf object.
 
+    Attributes:
+        registry (:class:`protoc_docs.code.MessageStructureRegistry`): The
+            ``MessageStructure`` objects found in the request.
+
     Raises
         TypeError: If the argument is not a CodeGeneratorRequest.
     """
@@ -42,18 +52,21 @@ class CodeGeneratorParser(object):
             raise TypeError('Parser must be instantiated with a '
                             'CodeGeneratorRequest; got %s' % type_sent)
         self._request = request
+        self.registry = MessageStructureRegistry()
 
     @classmethod
-    def from_input_file(cls, input_file):
+    def from_input_file(cls, input_file, lazy=False):
         """Return a CodeGeneratorRequest from this protobuf stream.
 
         Args:
             input_file (Any): A file-like object (requires a ``read`` method).
+            lazy (bool): Optional. Whether to skip decoding the files which
+                are not being generated; see :func:`decode_request`.
 
         Returns:
             CodeGeneratorParser: A parser.
         """
-        return cls(CodeGeneratorRequest.FromString(input_file.read()))
+        return cls(decode_request(input_file.read(), lazy=lazy))
 
     def find_docs(self):
         """Find valid documentation in the proto and iterate over them.
@@ -83,6 +96,11 @@ class CodeGeneratorParser(object):
                 continue
             src = proto_file.source_code_info
 
+            # Elements are resolved once, the first time a comment within
+            # them is found, and remembered by path; so each location only
+            # needs to resolve what its parent has not already resolved.
+            index = {}
+
             # Iterate over each location in the source info.
             for loc in src.location:
                 # Sanity check: If there are no comments, then we do not
@@ -100,28 +118,120 @@ class CodeGeneratorParser(object):
                 if loc.path[0] != 4:
                     continue
 
-                # We have comments. We need to determine what the thing is
-                # that they are attached to.
-                filename = proto_file.name
+                # Determine what the comment is attached to. Paths with an odd
+                # number of elements point into the element (e.g. its
+                # options), and are attributed to the element itself.
+                path = tuple(loc.path)
+                element = self._lookup(
+                    proto_file,
+                    path if len(path) % 2 == 0 else path[:-1],
+                    index,
+                )
+
+                # Sanity check: If there is no target, skip. This happens
+                # (right now) for enums because there is no insertion point
+                # for them, and for comments on options.
+                if element is None:
+                    continue
+
+                # We have comments. Write them to the appropriate spot.
                 comment = textwrap.dedent('{leading}\n{trailing}'.format(
                     leading=loc.leading_comments,
                     trailing=loc.trailing_comments,
                 ))
-                message_structure = self.parse_path(
-                    docstring=comment,
-                    path=list(loc.path),
-                    struct=proto_file,
-                )
-
-                # Sanity check: If we got None back for the message_structure,
-                # skip. This happens (right now) for enums because there is
-                # no insertion point for them and no way to gracefully move
-                # on within that method.
-                if message_structure is None:
-                    continue
+                name, member = element[2]
+                message_structure = self.registry.get_or_create(name=name)
+                if member is None:
+                    message_structure.docstring = comment
+                else:
+                    message_structure.members[member] = comment
 
                 # Yield back what we need.
-                yield (filename, message_structure)
+                yield (proto_file.name, message_structure)
+
+    def _lookup(self, proto_file, path, index):
+        """Return the element of a file at the given path.
+
+        Lookups are memoized in ``index``, so that the elements shared by
+        many paths (such as a message and its fields) are only found once.
+
+        Args:
+            proto_file (:class:`google.protobuf.descriptor_pb2.FileDescriptorProto`):
+                The file being parsed.
+            path (tuple): The path; an even number of ints. See
+                descriptor.proto for complete documentation.
+            index (dict): The elements of ``proto_file`` found so far.
+
+        Returns:
+            tuple: A tuple of the element, the name of the
+                ``MessageStructure`` its own children belong to, and a
+                ``(name, member)`` tuple saying where comments on the
+                element are written (``member`` is ``None`` for
+                class-level documentation). ``None`` if comments on the
+                element cannot be documented.
+        """
+        try:
+            return index[path]
+        except KeyError:
+            pass
+
+        # The first two ints in the path represent what kind of thing
+        # the comment is attached to (message, enum, or service) and the
+        # order of declaration in its parent.
+        if len(path) > 2:
+            parent = self._lookup(proto_file, path[:-2], index)
+        elif len(path) == 2:
+            parent = (proto_file, None, None)
+        else:
+            parent = None
+
+        element = None
+        if parent is not None:
+            struct, name = parent[0], parent[1]
+            field = struct.DESCRIPTOR.fields_by_number.get(path[-2])
+
+            # Ignore anything other than a repeated field of named messages.
+            # In particular, ignore enums: there is no valid insertion point
+            # for them (see `parse_path`).
+            if (field is not None and field.message_type is not None and
+                    field.message_type.name != 'EnumDescriptorProto' and
+                    'name' in field.message_type.fields_by_name):
+                children = getattr(struct, field.name)
+                if (not isinstance(children, Message) and
+                        path[-1] < len(children)):
+                    child = children[path[-1]]
+                    if name is None:
+                        name = '{pkg}.{name}'.format(
+                            name=child.name,
+                            pkg=proto_file.package,
+                        )
+
+                    # Nested types are possible.
+                    #
+                    # In this case, we need to ensure that we do not lose
+                    # the outer layers of the nested type name; otherwise the
+                    # insertion point name will be wrong.
+                    child_name = name
+                    if not name.endswith(child.name):
+                        child_name = '{parent}.{child}'.format(
+                            child=child.name,
+                            parent=name,
+                        )
+                    element = (child, child_name,
+                               self._resolve(name, child.name))
+
+        index[path] = element
+        return element
+
+    def _resolve(self, name, child_name):
+        """Return the ``(name, member)`` a comment on ``child_name`` within
+        the message ``name`` belongs to."""
+        if name.endswith(child_name):
+            return (name, None)
+        if self._is_mixed_case(child_name):
+            return ('{parent}.{name}'.format(name=child_name, parent=name),
+                    None)
+        return (name, child_name)
 
     def parse_path(self, struct, path, docstring, message_structure=None):
         """Return the correct thing for a full path.
@@ -178,7 +288,7 @@ class CodeGeneratorParser(object):
 
         # If applicable, create the MessageStructure object for this.
         if not message_structure:
-            message_structure = MessageStructure.get_or_create(
+            message_structure = self.registry.get_or_create(
                 name='{pkg}.{name}'.format(
                     name=child.name,
                     pkg=struct.package,
@@ -194,7 +304,7 @@ class CodeGeneratorParser(object):
             # the outer layers of the nested type name; otherwise the
             # insertion point name will be wrong.
             if not message_structure.name.endswith(child.name):
-                message_structure = MessageStructure.get_or_create(
+                message_structure = self.registry.get_or_create(
                     name='{parent}.{child}'.format(
                         child=child.name,
                         parent=message_structure.name,
@@ -209,7 +319,7 @@ class CodeGeneratorParser(object):
         if message_structure.name.endswith(child.name):
             message_structure.docstring = docstring
         elif self._is_mixed_case(child.name):
-            message_structure = MessageStructure.get_or_create(
+            message_structure = self.registry.get_or_create(
                 name='{parent}.{name}'.format(
                     name=child.name,
                     parent=message_structure.name,
@@ -248,3 +358,64 @@ class CodeGeneratorParser(object):
         if string == string.upper():
             return False
         return True
+
+
+def decode_request(data, lazy=False):
+    """Decode a serialized ``CodeGeneratorRequest``.
+
+    ``protoc`` sends every transitive dependency of the files being
+    generated, source code info and all, and only the generated files are
+    ever documented. In lazy mode, the request is scanned on the wire
+    first, and only the ``proto_file`` entries named in ``file_to_generate``
+    are decoded; the others are skipped as raw bytes, and left out of the
+    request.
+
+    Args:
+        data (bytes): The serialized request.
+        lazy (bool): Optional. Whether to skip the dependencies.
+
+    Returns:
+        :class:`google.protobuf.compiler.plugin_pb2.CodeGeneratorRequest`:
+            The request.
+
+    Raises:
+        ValueError: If ``lazy`` and the request is malformed.
+    """
+    if not lazy:
+        return CodeGeneratorRequest.FromString(data)
+
+    spans = list(wire.iter_field_spans(data))
+    file_to_generate = set(
+        data[value_start:end].decode('utf-8')
+        for number, wire_type, _, value_start, end in spans
+        if number == _FILE_TO_GENERATE and wire_type == wire.LENGTH_DELIMITED
+    )
+
+    # Every other field is kept as it is, and the kept fields decoded at once.
+    kept = []
+    for number, wire_type, start, value_start, end in spans:
+        if (number == _PROTO_FILE and wire_type == wire.LENGTH_DELIMITED and
+                _file_name(data, value_start, end) not in file_to_generate):
+            continue
+        if kept and kept[-1][1] == start:
+            kept[-1] = (kept[-1][0], end)
+        else:
+            kept.append((start, end))
+    if len(kept) == 1 and kept[0] == (0, len(data)):
+        return CodeGeneratorRequest.FromString(data)
+    return CodeGeneratorRequest.FromString(
+        b''.join(data[start:end] for start, end in kept))
+
+
+def _file_name(data, start, end):
+    """Return the name of a serialized ``FileDescriptorProto``, without
+    decoding the rest of it, or ``None`` if it has none.
+
+    ``protoc`` writes the name once, as the first field, so this rarely
+    needs to look any further.
+    """
+    for number, wire_type, _, value_start, value_end in wire.iter_field_spans(
+            data, start, end):
+        if number == _FILE_NAME and wire_type == wire.LENGTH_DELIMITED:
+            return data[value_start:value_end].decode('utf-8')
+    return None
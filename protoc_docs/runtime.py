@@ -0,0 +1,99 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Files shared by the runs of one user.
+
+The pandoc server's state file and the remembered versions of ``pandoc``
+binaries outlive a run, and are trusted by later ones: a state file names
+the server whose output ends up in the generated docs, and the process
+:func:`protoc_docs.server.stop_server` signals. They are therefore kept in
+a directory only the current user can write to, rather than at predictable
+names in the world-writable temporary directory, and are only trusted if
+they belong to the current user and no one else can write to them.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import getpass
+import os
+import stat
+import tempfile
+
+
+ENV_RUNTIME_DIR = 'XDG_RUNTIME_DIR'
+
+
+def private_dir(environ=None):
+    """Return a directory only the current user can use, creating it if need
+    be.
+
+    This is a ``protoc-docs`` directory in ``$XDG_RUNTIME_DIR`` if that is
+    set (and private itself), or else a ``protoc-docs-<user>`` directory in
+    the temporary directory, created with mode 0700.
+
+    Args:
+        environ (dict): Optional. The environment to read; defaults to
+            ``os.environ``.
+
+    Returns:
+        str: The path of the directory.
+
+    Raises:
+        OSError: If the directory cannot be created, or exists but is not
+            private (someone else created it first, for example).
+    """
+    environ = os.environ if environ is None else environ
+    base = environ.get(ENV_RUNTIME_DIR)
+    if base and is_private(base, forbidden=stat.S_IRWXG | stat.S_IRWXO):
+        path = os.path.join(base, 'protoc-docs')
+    else:
+        path = os.path.join(tempfile.gettempdir(),
+                            'protoc-docs-%s' % _user())
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+    if not is_private(path, forbidden=stat.S_IRWXG | stat.S_IRWXO) or \
+            not os.path.isdir(path):
+        raise OSError(errno.EPERM, 'Not a private directory', path)
+    return path
+
+
+def is_private(path, forbidden=stat.S_IWGRP | stat.S_IWOTH):
+    """Return whether a file (not a symbolic link) belongs to the current
+    user, and gives no one else the ``forbidden`` permissions.
+
+    Args:
+        path (str): The path of the file.
+        forbidden (int): The permission bits no one else may have; by
+            default, those to write to the file.
+
+    Returns:
+        bool: Whether the file is private; ``False`` if it does not exist.
+    """
+    try:
+        status = os.lstat(path)
+    except OSError:
+        return False
+    if stat.S_ISLNK(status.st_mode) or status.st_mode & forbidden:
+        return False
+    return not hasattr(os, 'getuid') or status.st_uid == os.getuid()
+
+
+def _user():
+    if hasattr(os, 'getuid'):
+        return str(os.getuid())
+    return getpass.getuser()  # pragma: NO COVER
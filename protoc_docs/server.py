@@ -0,0 +1,475 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A long-lived ``pandoc server`` shared by consecutive runs.
+
+Starting ``pandoc`` costs far more than converting a typical API's comments,
+so instead of spawning it for every run, :func:`ensure_server` starts
+``pandoc server`` once, in the background, and every later run on the same
+machine reuses it through its HTTP JSON API.
+
+The server is owned by a small supervisor process (``python -m
+protoc_docs.server supervise``), which records the server's URL in a state
+file, in a directory only the current user can write to (see
+:func:`protoc_docs.runtime.private_dir`); a state file which does not
+belong to the current user, or which others can write to, is ignored.
+Clients touch the state file whenever they use the server; once it
+has not been touched for ``idle_timeout`` seconds, the supervisor shuts the
+server down and removes the state file. If the server fails to start, that
+is recorded next to the state file, and clients fall back to running
+``pandoc`` without trying again for five minutes.
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import errno
+import hashlib
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:  # pragma: NO COVER
+    from urllib2 import Request, urlopen
+
+import pypandoc
+
+from protoc_docs import discovery
+from protoc_docs import runtime
+
+
+ENV_URL = 'PROTOC_DOCS_PANDOC_SERVER'
+ENV_IDLE_TIMEOUT = 'PROTOC_DOCS_PANDOC_SERVER_IDLE_TIMEOUT'
+
+DEFAULT_IDLE_TIMEOUT = 300
+DEFAULT_START_TIMEOUT = 10
+
+# How often the supervisor checks on the server and the state file.
+_POLL_INTERVAL = 0.5
+
+# How long clients fall back to running pandoc, without trying to start the
+# server again, after it failed to start (in seconds).
+_RETRY_INTERVAL = 300
+
+
+class ServerError(Exception):
+    """Raised when the pandoc server cannot be started or reached."""
+
+
+class ServerClient(object):
+    """A client for the ``pandoc server`` HTTP JSON API.
+
+    Args:
+        url (str): The base URL of the server.
+        timeout (float): The timeout for each request, in seconds.
+    """
+
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def version(self):
+        """Return the version of ``pandoc`` running the server.
+
+        Raises:
+            ServerError: If the server cannot be reached.
+        """
+        return self._request('/version').decode('utf-8').strip()
+
+    def alive(self):
+        """Return True if the server responds, False otherwise."""
+        try:
+            self.version()
+        except ServerError:
+            return False
+        return True
+
+    def convert(self, texts, to, format):
+        """Convert a batch of texts with a single request.
+
+        Args:
+            texts (list[str]): The texts to convert.
+            to (str): The pandoc format to convert to.
+            format (str): The pandoc format to convert from.
+
+        Returns:
+            list[str]: The converted texts, with ``None`` for every text
+                the server failed to convert.
+
+        Raises:
+            ServerError: If the server cannot be reached, or its response
+                cannot be understood.
+        """
+        params = [{'text': text, 'from': format, 'to': to} for text in texts]
+        body = self._request('/batch', json.dumps(params).encode('utf-8'))
+        try:
+            results = json.loads(body.decode('utf-8'))
+        except ValueError as ex:
+            raise ServerError('Invalid response from pandoc server: %s' % ex)
+        if not isinstance(results, list) or len(results) != len(texts):
+            raise ServerError('Unexpected response from pandoc server.')
+        return [result.get('output') if isinstance(result, dict) else None
+                for result in results]
+
+    def _request(self, path, data=None):
+        request = Request(self.url + path, data=data)
+        if data is not None:
+            request.add_header('Content-Type', 'application/json')
+            request.add_header('Accept', 'application/json')
+        try:
+            response = urlopen(request, timeout=self.timeout)
+            try:
+                return response.read()
+            finally:
+                response.close()
+        except (IOError, OSError, socket.error) as ex:
+            # urllib's URLError and HTTPError are both IOErrors.
+            raise ServerError('pandoc server at %s failed: %s' % (self.url, ex))
+
+
+def default_command():
+    """Return the command which starts ``pandoc server``.
+
+    The ``{port}`` placeholder is replaced by the port to listen on.
+    """
+    return [discovery.find_pandoc() or pypandoc.get_pandoc_path(), 'server',
+            '--port', '{port}']
+
+
+def default_state_path(command):
+    """Return the state file shared by every client running ``command``.
+
+    Raises:
+        OSError: If there is no private directory to keep it in.
+    """
+    digest = hashlib.sha1(
+        '\0'.join(command).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(
+        runtime.private_dir(), 'pandoc-server-%s.json' % digest)
+
+
+def ensure_server(command=None, state_path=None, idle_timeout=None,
+                  start_timeout=DEFAULT_START_TIMEOUT):
+    """Return the URL of a running pandoc server, starting one if needed.
+
+    Args:
+        command (list[str]): Optional. The command which starts the server;
+            see :func:`default_command`.
+        state_path (str): Optional. The state file identifying the shared
+            server; see :func:`default_state_path`.
+        idle_timeout (float): Optional. How long a server started by this
+            call lives without being used, in seconds. Defaults to the
+            ``PROTOC_DOCS_PANDOC_SERVER_IDLE_TIMEOUT`` environment variable,
+            or five minutes.
+        start_timeout (float): How long to wait for the server to start.
+
+    Returns:
+        str: The base URL of the server.
+
+    Raises:
+        ServerError: If no server could be started, now or (with the same
+            state file) in the last five minutes.
+    """
+    command = default_command() if command is None else command
+    if state_path is None:
+        state_path = default_state_path(command)
+    if idle_timeout is None:
+        idle_timeout = float(os.environ.get(ENV_IDLE_TIMEOUT,
+                                            DEFAULT_IDLE_TIMEOUT))
+
+    url = _live_url(state_path)
+    if url:
+        return url
+
+    # A server which failed to start is likely to fail again, so do not
+    # make every run wait for it.
+    failure_path = _failure_path(state_path)
+    if _failed_recently(failure_path):
+        raise ServerError('pandoc server failed to start recently.')
+
+    # Only one client starts the server; the others wait for it to appear.
+    lock_path = state_path + '.lock'
+    if _acquire_lock(lock_path, stale_after=start_timeout):
+        try:
+            supervisor = _spawn_supervisor(command, state_path, idle_timeout,
+                                           start_timeout)
+            url = _wait_for_server(state_path, start_timeout,
+                                   supervisor=supervisor)
+            if url:
+                _remove(failure_path)
+            else:
+                _write_state(failure_path, {})
+        finally:
+            _remove(lock_path)
+    else:
+        url = _wait_for_server(state_path, start_timeout,
+                               failure_path=failure_path)
+
+    if not url:
+        raise ServerError('pandoc server failed to start.')
+    return url
+
+
+def touch(state_path):
+    """Record that the server identified by ``state_path`` is in use."""
+    try:
+        os.utime(state_path, None)
+    except OSError:
+        pass
+
+
+def stop_server(state_path):
+    """Stop the server identified by ``state_path``, if it is running.
+
+    Returns:
+        bool: True if a server was asked to stop.
+    """
+    state = _read_state(state_path)
+    if state is None:
+        return False
+    try:
+        os.kill(state['pid'], signal.SIGTERM)
+    except OSError:
+        _remove(state_path)
+        return False
+    return True
+
+
+def supervise(command, state_path, idle_timeout,
+              start_timeout=DEFAULT_START_TIMEOUT):
+    """Run the server until it is stopped or has been idle for too long.
+
+    This is the body of the supervisor process started by
+    :func:`ensure_server`.
+
+    Returns:
+        int: The exit status of the supervisor.
+    """
+    port = _free_port()
+    argv = [arg.replace('{port}', str(port)) for arg in command]
+    devnull = open(os.devnull, 'wb')
+    process = subprocess.Popen(argv, stdin=devnull, stdout=devnull,
+                               stderr=devnull)
+    client = ServerClient('http://127.0.0.1:%d' % port, timeout=1)
+
+    def _stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, _stop)
+
+    owner = False
+    try:
+        deadline = time.time() + start_timeout
+        while not client.alive():
+            if process.poll() is not None or time.time() > deadline:
+                return 1
+            if _accepts_connections(port) and not client.alive():
+                # The server listens, but cannot answer (pandoc built
+                # without the threaded runtime the server needs, say).
+                return 1
+            time.sleep(0.05)
+
+        _write_state(state_path, {'url': client.url, 'pid': os.getpid()})
+        owner = True
+        while process.poll() is None:
+            time.sleep(_POLL_INTERVAL)
+            state = _read_state(state_path)
+            if state is None or state.get('pid') != os.getpid():
+                owner = False
+                break  # Another supervisor took over.
+            try:
+                idle = time.time() - os.path.getmtime(state_path)
+            except OSError:
+                break
+            if idle > idle_timeout:
+                break
+        return 0
+    finally:
+        if process.poll() is None:
+            process.terminate()
+            process.wait()
+        if owner:
+            _remove(state_path)
+        devnull.close()
+
+
+def _live_url(state_path):
+    state = _read_state(state_path)
+    if state is None:
+        return None
+    if not ServerClient(state['url'], timeout=1).alive():
+        return None
+    touch(state_path)
+    return state['url']
+
+
+def _wait_for_server(state_path, timeout, supervisor=None,
+                     failure_path=None):
+    """Wait for the server to start, unless the supervisor starting it exits
+    (and is reaped) or, for clients which did not start it, the failure to
+    start it is recorded at ``failure_path``."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        url = _live_url(state_path)
+        if url:
+            return url
+        if supervisor is not None and supervisor.poll() is not None:
+            return _live_url(state_path)
+        if failure_path is not None and _failed_recently(failure_path):
+            return None
+        time.sleep(0.05)
+    return None
+
+
+def _failure_path(state_path):
+    return state_path + '.failed'
+
+
+def _failed_recently(path):
+    if not runtime.is_private(path):
+        return False
+    try:
+        return time.time() - os.path.getmtime(path) < _RETRY_INTERVAL
+    except OSError:  # pragma: NO COVER
+        return False
+
+
+def _spawn_supervisor(command, state_path, idle_timeout, start_timeout):
+    # Make sure the supervisor can import this package, wherever it lives.
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    argv = [
+        sys.executable, '-m', 'protoc_docs.server', 'supervise',
+        '--state', state_path,
+        '--idle-timeout', str(idle_timeout),
+        '--start-timeout', str(start_timeout),
+        '--',
+    ] + list(command)
+
+    # Detach the supervisor so that it outlives this process (and, under
+    # Bazel, the action which started it).
+    devnull = open(os.devnull, 'r+b')
+    try:
+        kwargs = {'preexec_fn': os.setsid} if hasattr(os, 'setsid') else {}
+        return subprocess.Popen(argv, stdin=devnull, stdout=devnull,
+                                stderr=devnull, close_fds=True, env=env,
+                                **kwargs)
+    finally:
+        devnull.close()
+
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def _accepts_connections(port):
+    try:
+        socket.create_connection(('127.0.0.1', port), timeout=1).close()
+    except (OSError, socket.error):
+        return False
+    return True
+
+
+def _acquire_lock(path, stale_after):
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+    # A client which died while starting the server leaves its lock behind.
+    try:
+        if time.time() - os.path.getmtime(path) > stale_after:
+            _remove(path)
+            return _acquire_lock(path, stale_after)
+    except OSError:
+        pass
+    return False
+
+
+def _read_state(path):
+    # Anyone else able to write the state file could point clients at a
+    # server of their own, or have stop_server signal any process.
+    if not runtime.is_private(path):
+        return None
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or 'url' not in state or 'pid' not in state:
+        return None
+    return state
+
+
+def _write_state(path, state):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp_path, path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m protoc_docs.server',
+        description='Manage the pandoc server shared by protoc_docs runs.',
+    )
+    subparsers = parser.add_subparsers(dest='action')
+    for action in ('start', 'stop', 'supervise'):
+        subparser = subparsers.add_parser(action)
+        subparser.add_argument('--state', default=None)
+        subparser.add_argument('--idle-timeout', type=float, default=None)
+        subparser.add_argument('--start-timeout', type=float,
+                               default=DEFAULT_START_TIMEOUT)
+        subparser.add_argument('command', nargs='*')
+    args = parser.parse_args(argv)
+
+    command = args.command or default_command()
+    state_path = args.state or default_state_path(command)
+    if args.action == 'supervise':
+        return supervise(command, state_path,
+                         args.idle_timeout or DEFAULT_IDLE_TIMEOUT,
+                         args.start_timeout)
+    if args.action == 'stop':
+        return 0 if stop_server(state_path) else 1
+    # Starting the server explicitly tries again even if it failed recently.
+    _remove(_failure_path(state_path))
+    print(ensure_server(command, state_path, args.idle_timeout,
+                        args.start_timeout))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reading and writing the top-level fields of a serialized protobuf message.
+
+A serialized message is just a sequence of records, each a field number and
+wire type followed by a value. Reading the records one at a time lets a
+large message (such as a ``FileDescriptorSet`` holding hundreds of files)
+be processed one field at a time, without decoding all of it at once.
+"""
+
+from __future__ import absolute_import
+
+import io
+
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+
+def iter_fields(stream):
+    """Iterate over the top-level fields of a serialized message.
+
+    Args:
+        stream (Any): A binary file-like object (requires a ``read`` method)
+            positioned at the start of the message.
+
+    Yields:
+        tuple(int, int, bytes): The field number, the wire type and the
+            value of each field, in order. For length-delimited fields the
+            value is the payload, without its length prefix; for the other
+            wire types it is the encoded value.
+
+    Raises:
+        ValueError: If the message is truncated or malformed.
+    """
+    while True:
+        key = _read_varint(stream, allow_eof=True)
+        if key is None:
+            return
+        number, wire_type = key >> 3, key & 7
+        if wire_type == VARINT:
+            value = encode_varint(_read_varint(stream))
+        elif wire_type == FIXED64:
+            value = _read_exactly(stream, 8)
+        elif wire_type == LENGTH_DELIMITED:
+            value = _read_exactly(stream, _read_varint(stream))
+        elif wire_type == FIXED32:
+            value = _read_exactly(stream, 4)
+        else:
+            raise ValueError('Unsupported wire type %d for field %d'
+                             % (wire_type, number))
+        yield number, wire_type, value
+
+
+def iter_field_spans(data, start=0, end=None):
+    """Iterate over the top-level fields of a serialized message in memory,
+    without copying their values.
+
+    Args:
+        data (bytes): The serialized message.
+        start (int): Optional. Where the message starts in ``data``.
+        end (int): Optional. Where the message ends in ``data``; by default,
+            the end of ``data``.
+
+    Yields:
+        tuple(int, int, int, int, int): The field number and the wire type of
+            each field, in order, followed by the offsets in ``data`` where
+            the field starts, where its value starts and where it ends. For
+            length-delimited fields the value is the payload, without its
+            length prefix.
+
+    Raises:
+        ValueError: If the message is truncated or malformed.
+    """
+    end = len(data) if end is None else end
+    position = start
+    while position < end:
+        field_start = position
+        key, position = _decode_varint_at(data, position, end)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == VARINT:
+            value_start = position
+            _, position = _decode_varint_at(data, position, end)
+        elif wire_type == LENGTH_DELIMITED:
+            size, value_start = _decode_varint_at(data, position, end)
+            position = value_start + size
+        elif wire_type in (FIXED64, FIXED32):
+            value_start = position
+            position += 8 if wire_type == FIXED64 else 4
+        else:
+            raise ValueError('Unsupported wire type %d for field %d'
+                             % (wire_type, number))
+        if position > end:
+            raise ValueError('Truncated message: expected %d more bytes.'
+                             % (position - end))
+        yield number, wire_type, field_start, value_start, position
+
+
+def write_field(stream, number, wire_type, value):
+    """Write a field, as yielded by :func:`iter_fields`, to a stream.
+
+    Args:
+        stream (Any): A binary file-like object (requires a ``write``
+            method).
+        number (int): The field number.
+        wire_type (int): The wire type.
+        value (bytes): The value; for length-delimited fields, the payload
+            without its length prefix.
+    """
+    stream.write(encode_varint(number << 3 | wire_type))
+    if wire_type == LENGTH_DELIMITED:
+        stream.write(encode_varint(len(value)))
+    stream.write(value)
+
+
+def read_delimited(stream):
+    """Read a length-prefixed message, as written by :func:`write_delimited`.
+
+    Args:
+        stream (Any): A binary file-like object (requires a ``read`` method).
+
+    Returns:
+        bytes: The serialized message, or ``None`` at the end of the stream.
+
+    Raises:
+        ValueError: If the message is truncated.
+    """
+    size = _read_varint(stream, allow_eof=True)
+    if size is None:
+        return None
+    return _read_exactly(stream, size)
+
+
+def write_delimited(stream, value):
+    """Write a serialized message, prefixed by its length.
+
+    Args:
+        stream (Any): A binary file-like object (requires a ``write``
+            method).
+        value (bytes): The serialized message.
+    """
+    stream.write(encode_varint(len(value)))
+    stream.write(value)
+
+
+def encode_varint(value):
+    """Return the varint encoding of a non-negative integer."""
+    answer = bytearray()
+    while value > 0x7f:
+        answer.append(value & 0x7f | 0x80)
+        value >>= 7
+    answer.append(value)
+    return bytes(answer)
+
+
+def decode_varint(value):
+    """Return the non-negative integer encoded by a varint.
+
+    Raises:
+        ValueError: If ``value`` is not a complete varint.
+    """
+    return _read_varint(io.BytesIO(value))
+
+
+def _decode_varint_at(data, position, end):
+    value = 0
+    shift = 0
+    while True:
+        if position >= end:
+            raise ValueError('Truncated message: incomplete varint.')
+        byte = ord(data[position:position + 1])
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+        if shift >= 64:
+            raise ValueError('Malformed message: varint is too long.')
+
+
+def _read_varint(stream, allow_eof=False):
+    value = 0
+    shift = 0
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            if allow_eof and shift == 0:
+                return None
+            raise ValueError('Truncated message: incomplete varint.')
+        byte = bytearray(byte)[0]
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value
+        shift += 7
+        if shift >= 64:
+            raise ValueError('Malformed message: varint is too long.')
+
+
+def _read_exactly(stream, size):
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = stream.read(remaining)
+        if not chunk:
+            raise ValueError('Truncated message: expected %d more bytes.'
+                             % remaining)
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
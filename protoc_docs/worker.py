@@ -0,0 +1,293 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Running the tools as Bazel persistent workers.
+
+Started with ``--persistent_worker``, a tool reads work requests from stdin
+and writes a work response to stdout for each, until stdin is closed. Every
+request is handled in the same process, with the same conversion backend and
+an in-memory cache of conversions, so that neither Python nor the backend
+start up again for each action.
+
+Requests and responses use Bazel's proto protocol, or its JSON protocol if
+the worker is started with ``--worker_protocol=json``. Without
+``--persistent_worker``, the tool runs once with its arguments, so that the
+same actions run when workers are disabled.
+
+See https://bazel.build/remote/persistent.
+"""
+
+from __future__ import absolute_import
+
+import io
+import json
+import sys
+import traceback
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from protoc_docs import wire
+from protoc_docs.backends import get_backend
+from protoc_docs.cache import ConversionCache
+from protoc_docs.cache import MemoryCache
+
+
+PERSISTENT_WORKER_FLAG = '--persistent_worker'
+PROTOCOL_FLAG = '--worker_protocol'
+
+PROTOCOLS = ('proto', 'json')
+
+# The field numbers of ``WorkRequest`` and ``WorkResponse``, from Bazel's
+# worker_protocol.proto.
+_REQUEST_ARGUMENTS = 1
+_REQUEST_ID = 3
+_REQUEST_CANCEL = 4
+_RESPONSE_EXIT_CODE = 1
+_RESPONSE_OUTPUT = 2
+_RESPONSE_ID = 3
+
+
+class StreamUnavailableError(IOError):
+    """Raised when a tool run by a worker reads data from stdin or writes it
+    to stdout, which carry the work requests and responses."""
+
+
+class Worker(object):
+    """Serves work requests by running a tool in this process.
+
+    Args:
+        tool (Callable): The tool's entry point. It is called with the
+            arguments of each request, and the ``cache`` and ``backend``
+            keyword arguments, and returns an exit status (``None`` for
+            success) or raises ``SystemExit``.
+        protocol (str): ``proto`` or ``json``.
+        cache (Any): Optional. The conversion cache shared by all requests.
+            By default, an in-memory cache, in front of the persistent cache
+            named by ``PROTOC_DOCS_CACHE_DIR`` if it is set.
+        backend (Any): Optional. The conversion backend shared by all
+            requests; see :mod:`protoc_docs.backends`.
+
+    Raises:
+        ValueError: If ``protocol`` is unknown.
+    """
+
+    def __init__(self, tool, protocol='proto', cache=None, backend=None):
+        if protocol not in PROTOCOLS:
+            raise ValueError('Unknown worker protocol %r; expected one of %s'
+                             % (protocol, ', '.join(PROTOCOLS)))
+        self.tool = tool
+        self.protocol = protocol
+        if cache is None:
+            cache = MemoryCache(fallback=ConversionCache.from_environ())
+        self.cache = cache
+        self.backend = get_backend() if backend is None else backend
+
+    def serve(self, input_file, output_file):
+        """Handle work requests until the input is closed.
+
+        Args:
+            input_file (Any): A binary file-like object the requests are read
+                from.
+            output_file (Any): A binary file-like object the responses are
+                written to.
+        """
+        read, write = {
+            'proto': (_read_proto, _write_proto),
+            'json': (_read_json, _write_json),
+        }[self.protocol]
+        while True:
+            request = read(input_file)
+            if request is None:
+                return
+            if request['cancel']:
+                # Requests are handled one at a time, so there is never one
+                # in progress to cancel.
+                continue
+            exit_code, output = self.handle(request['arguments'])
+            write(output_file, {
+                'exit_code': exit_code,
+                'output': output,
+                'request_id': request['request_id'],
+            })
+            output_file.flush()
+
+    def handle(self, arguments):
+        """Run the tool once.
+
+        Anything the tool prints is captured, so that it does not mix with
+        the responses on stdout. stdin and stdout cannot be used for data
+        (``-`` as a path, say): the tool fails with a
+        :class:`StreamUnavailableError` instead.
+
+        Args:
+            arguments (list[str]): The arguments of the request.
+
+        Returns:
+            tuple(int, str): The exit status, and what the tool printed.
+        """
+        output = _Output()
+        stdin, stdout, stderr = sys.stdin, sys.stdout, sys.stderr
+        sys.stdin = _Input()
+        sys.stdout = sys.stderr = output
+        try:
+            exit_code = _run(self.tool, expand_arguments(arguments),
+                             cache=self.cache, backend=self.backend)
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+        return exit_code, output.getvalue()
+
+
+class _Input(object):
+    """Stands in for stdin while a request is handled."""
+
+    def __getattr__(self, name):
+        raise StreamUnavailableError(
+            'stdin carries the work requests of a persistent worker; read '
+            'from a file instead of -')
+
+
+class _Output(StringIO):
+    """Captures what the tool prints while a request is handled, but not
+    binary data."""
+
+    @property
+    def buffer(self):
+        raise StreamUnavailableError(
+            'stdout carries the work responses of a persistent worker; '
+            'write to a file instead of -')
+
+
+def main(tool, argv=None):
+    """Run a tool as a persistent worker, or once.
+
+    Args:
+        tool (Callable): The tool's entry point; see :class:`Worker`.
+        argv (list[str]): Optional. The command line arguments; by default,
+            ``sys.argv[1:]``.
+
+    Returns:
+        int: The exit status.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    persistent = False
+    protocol = 'proto'
+    arguments = []
+    for arg in argv:
+        if arg == PERSISTENT_WORKER_FLAG:
+            persistent = True
+        elif arg.startswith(PROTOCOL_FLAG + '='):
+            protocol = arg.split('=', 1)[1]
+        else:
+            arguments.append(arg)
+
+    if not persistent:
+        return _run(tool, expand_arguments(arguments))
+
+    worker = Worker(tool, protocol=protocol)
+    worker.serve(getattr(sys.stdin, 'buffer', sys.stdin),
+                 getattr(sys.stdout, 'buffer', sys.stdout))
+    return 0
+
+
+def expand_arguments(arguments):
+    """Replace each ``@path`` argument by the lines of the file at ``path``,
+    as Bazel's multiline parameter files are written."""
+    answer = []
+    for arg in arguments:
+        if arg.startswith('@'):
+            with io.open(arg[1:], encoding='utf-8') as f:
+                answer.extend(line.rstrip('\r\n') for line in f)
+        else:
+            answer.append(arg)
+    return answer
+
+
+def _run(tool, arguments, **kwargs):
+    try:
+        exit_code = tool(arguments, **kwargs)
+    except StreamUnavailableError as ex:
+        sys.stderr.write('%s\n' % ex)
+        exit_code = 1
+    except SystemExit as ex:
+        exit_code = ex.code
+        if exit_code is not None and not isinstance(exit_code, int):
+            sys.stderr.write('%s\n' % exit_code)
+            exit_code = 1
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        exit_code = 1
+    return exit_code or 0
+
+
+def _read_proto(stream):
+    payload = wire.read_delimited(stream)
+    if payload is None:
+        return None
+    request = {'arguments': [], 'request_id': 0, 'cancel': False}
+    for number, wire_type, value in wire.iter_fields(io.BytesIO(payload)):
+        if number == _REQUEST_ARGUMENTS:
+            request['arguments'].append(value.decode('utf-8'))
+        elif number == _REQUEST_ID:
+            request['request_id'] = wire.decode_varint(value)
+        elif number == _REQUEST_CANCEL:
+            request['cancel'] = bool(wire.decode_varint(value))
+    return request
+
+
+def _write_proto(stream, response):
+    payload = io.BytesIO()
+    if response['exit_code']:
+        wire.write_field(payload, _RESPONSE_EXIT_CODE, wire.VARINT,
+                         wire.encode_varint(response['exit_code']))
+    if response['output']:
+        wire.write_field(payload, _RESPONSE_OUTPUT, wire.LENGTH_DELIMITED,
+                         response['output'].encode('utf-8'))
+    if response['request_id']:
+        wire.write_field(payload, _RESPONSE_ID, wire.VARINT,
+                         wire.encode_varint(response['request_id']))
+    wire.write_delimited(stream, payload.getvalue())
+
+
+def _read_json(stream):
+    # Each request is one JSON object, which may span several lines.
+    lines = []
+    while True:
+        line = stream.readline()
+        if not line:
+            if b''.join(lines).strip():
+                raise ValueError('Truncated work request: %r'
+                                 % b''.join(lines))
+            return None
+        lines.append(line)
+        try:
+            message = json.loads(b''.join(lines).decode('utf-8'))
+        except ValueError:
+            continue
+        return {
+            'arguments': message.get('arguments', []),
+            'request_id': message.get('requestId',
+                                      message.get('request_id', 0)),
+            'cancel': message.get('cancel', False),
+        }
+
+
+def _write_json(stream, response):
+    stream.write(json.dumps({
+        'exitCode': response['exit_code'],
+        'output': response['output'],
+        'requestId': response['request_id'],
+    }).encode('utf-8') + b'\n')
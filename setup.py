@@ -33,7 +33,7 @@ setuptools.setup(
         'protobuf >= 3.3.0',
         'pypandoc >= 1.4',
     ),
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=('benchmarks', 'tests')),
     entry_points={
         'console_scripts': [
             'protoc-gen-pydocstring = protoc_docs.bin.py_docstring:main',
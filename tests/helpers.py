@@ -0,0 +1,32 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test doubles shared by several test modules."""
+
+from __future__ import absolute_import
+
+
+class UpperBackend(object):
+    """A conversion backend which upper-cases texts, and records the size of
+    each batch it is given."""
+
+    name = 'upper'
+    version = 'upper'
+
+    def __init__(self):
+        self.calls = []
+
+    def convert(self, texts, to, format, batch_token):
+        self.calls.append(len(texts))
+        return [text.upper() for text in texts]
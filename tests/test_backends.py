@@ -0,0 +1,168 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import pypandoc
+import pytest
+
+from protoc_docs import backends
+from protoc_docs import discovery
+
+
+class PandocBackendTests(unittest.TestCase):
+    @mock.patch.object(discovery, 'find_pandoc', return_value=None)
+    @mock.patch.object(pypandoc, 'convert_text',
+                       return_value='A\n\nXYZ1\n\nB\n')
+    def test_convert(self, convert_text, find_pandoc):
+        backend = backends.PandocBackend()
+        assert backend.convert(['a', 'b'], 'rst', 'md', 'XYZ') == [
+            'A\n', 'B\n']
+        convert_text.assert_called_once_with('a\n\nXYZ1\n\nb', 'rst',
+                                             format='md', verify_format=False)
+
+    @mock.patch.object(pypandoc, 'convert_text', return_value='AB')
+    def test_convert_misaligned(self, convert_text):
+        backend = backends.PandocBackend()
+        assert backend.convert(['a', 'b'], 'rst', 'md', 'XYZ') == [None, None]
+
+    @mock.patch.object(discovery, 'find_pandoc', return_value=None)
+    @mock.patch.object(pypandoc, 'get_pandoc_version', return_value='2.2.1')
+    def test_version(self, get_pandoc_version, find_pandoc):
+        backend = backends.PandocBackend()
+        assert backend.version == '2.2.1'
+        assert backend.version == '2.2.1'
+        get_pandoc_version.assert_called_once_with()
+
+    @mock.patch.object(discovery, 'get_version', return_value='2.2.1')
+    def test_version_discovered(self, get_version):
+        backend = backends.PandocBackend(environ={
+            discovery.ENV_PANDOC: '/opt/pandoc'})
+        assert backend.path == '/opt/pandoc'
+        assert backend.version == '2.2.1'
+        assert backend.version == '2.2.1'
+        get_version.assert_called_once_with('/opt/pandoc')
+
+        backend = backends.PandocBackend(environ={
+            discovery.ENV_PANDOC: '/opt/pandoc',
+            discovery.ENV_PANDOC_VERSION: '2.9'})
+        assert backend.version == '2.9'
+        assert backends.PandocBackend('/opt/pandoc', '3.1').version == '3.1'
+        get_version.assert_called_once_with('/opt/pandoc')
+
+    @mock.patch.object(discovery, 'use_pandoc')
+    @mock.patch.object(pypandoc, 'convert_text', return_value='A\n')
+    def test_convert_discovered(self, convert_text, use_pandoc):
+        backend = backends.PandocBackend('/opt/pandoc', '2.2.1')
+        assert backend.convert(['a'], 'rst', 'md', 'XYZ') == ['A\n']
+        use_pandoc.assert_called_once_with('/opt/pandoc', '2.2.1')
+
+
+class PandocTimeoutTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.pandoc = os.path.join(self.path, 'pandoc')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _backend(self, script, timeout=10):
+        with open(self.pandoc, 'w') as f:
+            f.write('#!/bin/sh\n' + script)
+        os.chmod(self.pandoc, 0o755)
+        return backends.PandocBackend(self.pandoc, '2.2.1', timeout=timeout)
+
+    @mock.patch.object(pypandoc, 'convert_text')
+    def test_convert(self, convert_text):
+        backend = self._backend(
+            '[ "$*" = "--from=markdown --to=rst" ] && tr a-z A-Z')
+        assert backend.convert(['a', 'b'], 'rst', 'md', 'XYZ') == [
+            'A\n', 'B\n']
+        convert_text.assert_not_called()
+
+    def test_convert_timed_out(self):
+        backend = self._backend('exec sleep 10', timeout=0.1)
+        with pytest.raises(backends.ConversionTimeout):
+            backend.convert(['a'], 'rst', 'md', 'XYZ')
+
+    def test_convert_failed(self):
+        backend = self._backend('echo oops >&2; exit 3')
+        with pytest.raises(RuntimeError) as info:
+            backend.convert(['a'], 'rst', 'md', 'XYZ')
+        assert 'oops' in str(info.value)
+
+    def test_timeout(self):
+        environ = {backends.ENV_TIMEOUT: '2.5'}
+        assert backends.PandocBackend('pandoc', environ={}).timeout is None
+        assert backends.PandocBackend(
+            'pandoc', environ=environ).timeout == 2.5
+        assert backends.PandocBackend(
+            'pandoc', environ=environ, timeout=1).timeout == 1
+        with pytest.raises(ValueError):
+            backends.PandocBackend('pandoc', timeout=-1)
+
+
+class NativeBackendTests(unittest.TestCase):
+    def test_convert_falls_back(self):
+        fallback = mock.Mock(spec=backends.PandocBackend)
+        fallback.convert.return_value = ['HEADING']
+        backend = backends.NativeBackend(fallback=fallback)
+
+        converted = backend.convert(['`a`', '# Heading'], 'rst', 'md', 'XYZ')
+        assert converted == ['``a``\n', 'HEADING']
+        fallback.convert.assert_called_once_with(
+            ['# Heading'], 'rst', 'md', 'XYZ')
+
+    def test_convert_natively(self):
+        fallback = mock.Mock(spec=backends.PandocBackend)
+        backend = backends.NativeBackend(fallback=fallback)
+        assert backend.convert(['*a*'], 'rst', 'commonmark', 'XYZ') == ['*a*\n']
+        fallback.convert.assert_not_called()
+
+    def test_convert_other_formats(self):
+        fallback = mock.Mock(spec=backends.PandocBackend)
+        fallback.convert.return_value = ['<em>a</em>']
+        backend = backends.NativeBackend(fallback=fallback)
+        assert backend.convert(['*a*'], 'html', 'md', 'XYZ') == ['<em>a</em>']
+
+    def test_version(self):
+        fallback = mock.Mock(spec=backends.PandocBackend)
+        fallback.version = '2.2.1'
+        backend = backends.NativeBackend(fallback=fallback)
+        assert backend.version == 'native-3+2.2.1'
+
+
+class GetBackendTests(unittest.TestCase):
+    def test_default(self):
+        assert isinstance(backends.get_backend(environ={}),
+                          backends.PandocBackend)
+
+    def test_environ(self):
+        backend = backends.get_backend(
+            environ={'PROTOC_DOCS_BACKEND': 'native'})
+        assert isinstance(backend, backends.NativeBackend)
+
+    def test_name(self):
+        assert isinstance(backends.get_backend('native'),
+                          backends.NativeBackend)
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            backends.get_backend('bogus')
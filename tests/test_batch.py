@@ -0,0 +1,424 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+import pypandoc
+import pytest
+
+from protoc_docs import batch
+from protoc_docs import discovery
+from protoc_docs import framing
+from protoc_docs.backends import ConversionTimeout
+from protoc_docs.backends import PandocBackend
+from protoc_docs.batch import BatchConverter
+from protoc_docs.cache import ConversionCache
+from protoc_docs.instrumentation import Recorder
+
+
+def _fake_convert_text(source, to, format, **kwargs):
+    return source.upper()
+
+
+def _mangling_convert_text(source, to, format, **kwargs):
+    # Escape the sentinels in any batch holding emphasis.
+    if '*' in source:
+        source = source.replace('XYZ', 'XY\\Z')
+    return source.upper()
+
+
+class _ShyBackend(object):
+    """Only converts texts ending in '!' on their own."""
+    version = 'test'
+
+    def __init__(self):
+        self.calls = []
+
+    def convert(self, texts, to, format, batch_token):
+        self.calls.append(list(texts))
+        return [None if len(texts) > 1 and text.endswith('!') else text.upper()
+                for text in texts]
+
+
+class _FailingBackend(object):
+    version = 'test'
+
+    def convert(self, texts, to, format, batch_token):
+        return [None] * len(texts)
+
+
+class BatchConverterTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    @mock.patch.object(pypandoc, 'convert_text', side_effect=_fake_convert_text)
+    def test_convert_single_call(self, convert_text):
+        converter = BatchConverter('XYZ')
+        assert converter.convert(['a', 'b', 'c']) == ['A\n', 'B\n', 'C\n']
+        convert_text.assert_called_once_with(
+            'a\n\nXYZ1\n\nb\n\nXYZ2\n\nc', 'rst', format='commonmark',
+            verify_format=False)
+
+    @mock.patch.object(pypandoc, 'convert_text')
+    def test_convert_nothing(self, convert_text):
+        assert BatchConverter('XYZ').convert([]) == []
+        convert_text.assert_not_called()
+
+    @mock.patch.object(pypandoc, 'convert_text',
+                       side_effect=_mangling_convert_text)
+    def test_convert_bisected(self, convert_text):
+        recorder = Recorder('test')
+        converter = BatchConverter('XYZ', recorder=recorder)
+        assert converter.convert(['a', 'b', '*bad*', 'c']) == [
+            'A\n', 'B\n', '*BAD*\n', 'C\n']
+
+        # Only the half holding the text at fault was bisected further.
+        assert [c[0][0] for c in convert_text.call_args_list] == [
+            'a\n\nXYZ1\n\nb\n\nXYZ2\n\n*bad*\n\nXYZ3\n\nc',
+            'a\n\nXYZ1\n\nb',
+            '*bad*\n\nXYZ1\n\nc',
+            '*bad*',
+            'c',
+        ]
+        assert recorder.counters['batches_bisected'] == 2
+
+    def test_convert_unconvertible(self):
+        cache = ConversionCache(self.path)
+        recorder = Recorder('test')
+        converter = BatchConverter('XYZ', cache=cache, recorder=recorder,
+                                   backend=_FailingBackend())
+        assert converter.convert(['a', 'b']) == ['a', 'b']
+        assert cache.writes == 0
+        assert recorder.counters['texts_failed'] == 2
+        assert recorder.counters['conversion_calls'] == 3
+
+    @mock.patch.object(pypandoc, 'convert_text', side_effect=_fake_convert_text)
+    def test_convert_colliding(self, convert_text):
+        recorder = Recorder('test')
+        converter = BatchConverter('XYZ', recorder=recorder)
+        assert converter.convert(['a', 'an XYZ', 'b']) == [
+            'A\n', 'AN XYZ\n', 'B\n']
+        assert [c[0][0] for c in convert_text.call_args_list] == [
+            'an XYZ', 'a\n\nXYZ1\n\nb']
+        assert recorder.counters['texts_colliding'] == 1
+
+        convert_text.reset_mock()
+        assert converter.convert(['XYZ']) == ['XYZ\n']
+        convert_text.assert_called_once_with('XYZ', 'rst', format='commonmark',
+                                             verify_format=False)
+
+    def test_convert_partly_failed(self):
+        backend = _ShyBackend()
+        converter = BatchConverter('XYZ', backend=backend)
+        assert converter.convert(['a', 'b!', 'c', 'd!']) == [
+            'A', 'B!', 'C', 'D!']
+        assert backend.calls == [['a', 'b!', 'c', 'd!'], ['b!', 'd!'],
+                                 ['b!'], ['d!']]
+
+    @mock.patch.object(pypandoc, 'get_pandoc_version', return_value='2.2.1')
+    @mock.patch.object(pypandoc, 'convert_text', side_effect=_fake_convert_text)
+    def test_convert_cached(self, convert_text, get_pandoc_version):
+        cache = ConversionCache(self.path)
+        first = BatchConverter('XYZ', cache=cache).convert(['a', 'b'])
+        assert cache.stats()['misses'] == 2
+
+        # Only the new text should be sent to pandoc on the second run.
+        convert_text.reset_mock()
+        second = BatchConverter('XYZ', cache=cache).convert(['a', 'b', 'c'])
+        convert_text.assert_called_once_with('c', 'rst', format='commonmark',
+                                             verify_format=False)
+        assert second[:2] == first
+        assert second[2] == 'C\n'
+        assert cache.stats()['hits'] == 2
+
+    @mock.patch.object(pypandoc, 'convert_text', side_effect=_fake_convert_text)
+    def test_convert_fully_cached(self, convert_text):
+        cache = ConversionCache(self.path)
+        converter = BatchConverter('XYZ', cache=cache)
+        converter._version = '2.2.1'
+        converter.convert(['a'])
+        convert_text.reset_mock()
+        assert converter.convert(['a']) == ['A\n']
+        convert_text.assert_not_called()
+
+    @mock.patch.object(pypandoc, 'convert_text', side_effect=_fake_convert_text)
+    def test_convert_duplicates(self, convert_text):
+        recorder = Recorder('test')
+        converter = BatchConverter('XYZ', recorder=recorder)
+        assert converter.convert(['a', 'b', 'a', 'c', 'b']) == [
+            'A\n', 'B\n', 'A\n', 'C\n', 'B\n']
+        convert_text.assert_called_once_with(
+            'a\n\nXYZ1\n\nb\n\nXYZ2\n\nc', 'rst', format='commonmark',
+            verify_format=False)
+        assert recorder.counters['texts'] == 5
+        assert recorder.counters['texts_duplicate'] == 2
+
+    @mock.patch.object(pypandoc, 'convert_text', side_effect=_fake_convert_text)
+    def test_convert_normalized_duplicates(self, convert_text):
+        recorder = Recorder('test')
+        converter = BatchConverter('XYZ', recorder=recorder)
+        texts = [' a\n', '\n \n a\n\n', ' a\r\n', ' a\n b\n', ' a\r\n b\r\n']
+        assert converter.convert(texts) == [
+            ' A\n', ' A\n', ' A\n', ' A\n B\n', ' A\n B\n']
+        convert_text.assert_called_once_with(
+            ' a\n\nXYZ1\n\n a\n b', 'rst', format='commonmark',
+            verify_format=False)
+        assert recorder.counters['texts_duplicate'] == 3
+        assert recorder.counters['chars'] == sum(len(t) for t in texts)
+        assert recorder.counters['chars_unique'] == 7
+
+    @mock.patch.object(pypandoc, 'convert_text', side_effect=_fake_convert_text)
+    def test_convert_bypass_plain(self, convert_text):
+        cache = ConversionCache(self.path)
+        recorder = Recorder('test')
+        converter = BatchConverter('XYZ', cache=cache, recorder=recorder,
+                                   bypass_plain=True)
+        converter._version = '2.2.1'
+        assert converter.convert([' plain\n text', '*a*', 'snake_case']) == [
+            'plain text\n', '*A*\n', 'snake_case\n']
+        convert_text.assert_called_once_with('*a*', 'rst', format='commonmark',
+                                             verify_format=False)
+        assert recorder.counters['texts_bypassed'] == 2
+        assert recorder.counters['texts_cached'] == 0
+        assert cache.stats()['misses'] == 1
+
+    def test_convert_bypass_plain_non_ascii(self):
+        # pandoc measures and spaces non-ASCII text differently.
+        converter = BatchConverter('XYZ', bypass_plain=True,
+                                   backend=_FailingBackend())
+        assert converter.convert([u'Caf\xe9  bar']) == [u'Caf\xe9  bar']
+
+    def test_bypass_plain(self):
+        assert batch._get_bypass_plain(True, environ={}) is True
+        assert batch._get_bypass_plain(False, environ={}) is False
+        assert batch._get_bypass_plain(
+            True, environ={'PROTOC_DOCS_BYPASS_PLAIN': '1'}) is True
+        assert batch._get_bypass_plain(
+            True, environ={'PROTOC_DOCS_BYPASS_PLAIN': '0'}) is False
+        with mock.patch.dict(os.environ, {'PROTOC_DOCS_BYPASS_PLAIN': '0'}):
+            assert not BatchConverter('XYZ', bypass_plain=True).bypass_plain
+
+    def test_convert_bypass_plain_only_to_rst(self):
+        converter = BatchConverter('XYZ', to='html', bypass_plain=True,
+                                   backend=_FailingBackend())
+        assert not converter.bypass_plain
+        assert converter.convert(['plain']) == ['plain']
+
+    @mock.patch.object(pypandoc, 'convert_text', side_effect=_fake_convert_text)
+    def test_convert_bypass_plain_not_converted(self, convert_text):
+        # Wrapping would move what looks like a list marker to the start of
+        # a line, so the native conversion gives up.
+        text = 'wordy ' * 12 + '1. more'
+        converter = BatchConverter('XYZ', bypass_plain=True)
+        assert converter.convert([text]) == [text.upper() + '\n']
+
+    def test_convert_failed_duplicates(self):
+        converter = BatchConverter('XYZ', backend=_FailingBackend())
+        assert converter.convert(['a\n', '\na']) == ['a\n', '\na']
+
+    def test_normalize(self):
+        assert batch._normalize('\n  \n\t\n  a\n\n  b  \n \n') == '  a\n\n  b  '
+        assert batch._normalize('a\r\nb\r\n\r\n') == 'a\nb'
+        assert batch._normalize('    a') == '    a'
+        assert batch._normalize('') == ''
+
+    def test_convert_recorded(self):
+        cache = ConversionCache(self.path)
+        cache.put(cache.key('a', 'commonmark', 'rst', '2.2.1'), 'A')
+        recorder = Recorder('test')
+        converter = BatchConverter('XYZ', cache=cache, recorder=recorder,
+                                   backend=_FailingBackend())
+        converter._version = '2.2.1'
+        converter.convert(['a', 'b', 'c'])
+        assert recorder.counters['texts'] == 3
+        assert recorder.counters['texts_cached'] == 1
+        assert recorder.counters['texts_converted'] == 2
+        assert recorder.counters['texts_failed'] == 2
+        assert recorder.counters['conversion_calls'] == 3
+        assert recorder.counters['conversion_seconds'] >= 0
+
+    @mock.patch.object(discovery, 'find_pandoc', return_value=None)
+    @mock.patch.object(pypandoc, 'get_pandoc_version', return_value='2.2.1')
+    def test_version(self, get_pandoc_version, find_pandoc):
+        converter = BatchConverter('XYZ', backend=PandocBackend())
+        assert converter.version == '2.2.1/%s' % framing.VERSION
+
+
+class _RecordingBackend(object):
+    version = 'test'
+
+    def __init__(self):
+        self.calls = []
+        self.threads = set()
+
+    def convert(self, texts, to, format, batch_token):
+        self.calls.append(list(texts))
+        self.threads.add(threading.current_thread().name)
+        return [text.upper() for text in texts]
+
+
+class ShardingTests(unittest.TestCase):
+    def test_sharded_convert_keeps_order(self):
+        backend = _RecordingBackend()
+        converter = BatchConverter('XYZ', backend=backend, jobs=4)
+        converter.MIN_SHARD_SIZE = 1
+        texts = ['text %d' % i for i in range(10)]
+
+        assert converter.convert(texts) == [text.upper() for text in texts]
+        assert len(backend.calls) == 4
+        assert [t for call in backend.calls for t in call] == texts
+
+    def test_small_batch_not_sharded(self):
+        backend = _RecordingBackend()
+        converter = BatchConverter('XYZ', backend=backend, jobs=4)
+        converter.convert(['a', 'b', 'c'])
+        assert backend.calls == [['a', 'b', 'c']]
+
+    @mock.patch.object(pypandoc, 'convert_text', side_effect=_fake_convert_text)
+    def test_sharded_pandoc(self, convert_text):
+        converter = BatchConverter('XYZ', backend=PandocBackend(), jobs=2)
+        converter.MIN_SHARD_SIZE = 1
+        assert converter.convert(['a', 'b', 'c', 'd']) == [
+            'A\n', 'B\n', 'C\n', 'D\n']
+        assert convert_text.call_count == 2
+
+    def test_shard_balanced(self):
+        texts = ['x' * 10] * 10
+        shards = batch._shard(texts, 3, 1)
+        assert [len(shard) for shard in shards] == [4, 3, 3]
+
+    def test_shard_large_text(self):
+        texts = ['x' * 100] + ['x'] * 10
+        shards = batch._shard(texts, 3, 1)
+        assert len(shards) == 3
+        assert shards[0] == ['x' * 100]
+        assert sum(shards, []) == texts
+
+    def test_shard_min_size(self):
+        shards = batch._shard(['x' * 10] * 10, 4, 50)
+        assert [len(shard) for shard in shards] == [5, 5]
+
+    def test_jobs(self):
+        assert batch._get_jobs(3) == 3
+        assert batch._get_jobs(None, environ={}) == 1
+        assert batch._get_jobs(None, environ={'PROTOC_DOCS_JOBS': '2'}) == 2
+        assert batch._get_jobs(0) == batch._cpu_count()
+        assert batch._get_jobs(None, environ={'PROTOC_DOCS_JOBS': 'auto'}) \
+            == batch._cpu_count()
+        with pytest.raises(ValueError):
+            batch._get_jobs(-1)
+
+
+class _SlowBackend(_RecordingBackend):
+    """Times out on every batch holding a text starting with 'slow'."""
+
+    def convert(self, texts, to, format, batch_token):
+        self.calls.append(list(texts))
+        if any(text.startswith('slow') for text in texts):
+            raise ConversionTimeout()
+        return [text.upper() for text in texts]
+
+
+@mock.patch.object(batch._BatchSizer, 'SLOWDOWN', 0)
+@mock.patch.object(BatchConverter, 'MIN_BATCH_SIZE', 1)
+@mock.patch.object(BatchConverter, 'INITIAL_BATCH_SIZE', 2)
+class BatchSizeTests(unittest.TestCase):
+    def test_convert_limited(self):
+        backend = _RecordingBackend()
+        converter = BatchConverter('XYZ', backend=backend, max_batch_size=4)
+        texts = ['a', 'b', 'c', 'd', 'e', 'fffff', 'g']
+        assert converter.convert(texts) == [text.upper() for text in texts]
+
+        # The size doubled after the first batch, up to the limit; a text
+        # larger than the limit was converted on its own.
+        assert backend.calls == [
+            ['a', 'b'], ['c', 'd', 'e'], ['fffff'], ['g']]
+
+    def test_convert_unlimited(self):
+        backend = _RecordingBackend()
+        converter = BatchConverter('XYZ', backend=backend, max_batch_size=0)
+        converter.convert(['a', 'b', 'c', 'd', 'e'])
+        assert backend.calls == [['a', 'b', 'c', 'd', 'e']]
+
+    @mock.patch('sys.stderr', new_callable=io.StringIO)
+    def test_convert_timed_out(self, stderr):
+        backend = _SlowBackend()
+        recorder = Recorder('test')
+        converter = BatchConverter('XYZ', backend=backend, recorder=recorder)
+        slow = 'slow\n' + '\n'.join(str(i) for i in range(5))
+        assert converter.convert(['a', slow, 'b']) == ['A', slow, 'B']
+
+        assert backend.calls == [
+            ['a', slow, 'b'], ['a'], [slow, 'b'], [slow], ['b']]
+        assert recorder.counters['conversion_timeouts'] == 3
+        report = stderr.getvalue()
+        assert '3 comments (%d characters)' % (len(slow) + 2) in report
+        assert 'converting this comment (%d characters)' % len(slow) in report
+        assert '    slow\n    0\n    1\n    ...\n' in report
+        assert '    2\n' not in report
+
+    @mock.patch('sys.stderr', new_callable=io.StringIO)
+    def test_convert_timed_out_shrinks(self, stderr):
+        backend = _SlowBackend()
+        converter = BatchConverter('XYZ', backend=backend, max_batch_size=8)
+        converter.convert(['a', 'b', 'slow', 'c', 'd', 'e', 'f'])
+        assert converter._sizer.size == converter._sizer.limit == 2
+        assert backend.calls == [
+            ['a', 'b'], ['slow'], ['c', 'd'], ['e', 'f']]
+
+    def test_sizer(self):
+        sizer = batch._BatchSizer(100, initial=10, minimum=5)
+        sizer.record(10, 1.0)
+        assert sizer.size == 20
+
+        # Smaller batches are ignored, however slow.
+        sizer.record(9, 10.0)
+        assert sizer.size == 20
+
+        sizer.SLOWDOWN = 0.8
+        sizer.record(20, 1.0)
+        assert sizer.size == 40
+        sizer.record(40, 2.4)
+        assert sizer.size == 80
+        sizer.record(80, 10.0)
+        assert sizer.size == sizer.limit == 40
+
+        # Once settled, slow batches are ignored; timeouts are not.
+        sizer.record(40, 100.0)
+        assert sizer.size == 40
+        sizer.timed_out(1)
+        assert sizer.size == sizer.limit == 5
+
+    def test_sizer_small_limit(self):
+        sizer = batch._BatchSizer(3, initial=10, minimum=5)
+        assert sizer.size == sizer.minimum == 3
+
+    def test_max_batch_size(self):
+        assert batch._get_max_batch_size(3) == 3
+        assert batch._get_max_batch_size(None, environ={}) == 0
+        assert batch._get_max_batch_size(
+            None, environ={'PROTOC_DOCS_MAX_BATCH_SIZE': '1024'}) == 1024
+        with pytest.raises(ValueError):
+            batch._get_max_batch_size(-1)
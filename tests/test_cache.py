@@ -0,0 +1,184 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from protoc_docs.cache import ConversionCache
+from protoc_docs.cache import MemoryCache
+
+
+class ConversionCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_key_depends_on_all_parts(self):
+        key = ConversionCache.key('*foo*', 'md', 'rst', '2.2.1')
+        assert key == ConversionCache.key('*foo*', 'md', 'rst', '2.2.1')
+        assert key != ConversionCache.key('*bar*', 'md', 'rst', '2.2.1')
+        assert key != ConversionCache.key('*foo*', 'commonmark', 'rst', '2.2.1')
+        assert key != ConversionCache.key('*foo*', 'md', 'html', '2.2.1')
+        assert key != ConversionCache.key('*foo*', 'md', 'rst', '2.7.3')
+
+    def test_get_put(self):
+        cache = ConversionCache(self.path)
+        key = cache.key('*foo*', 'md', 'rst', '2.2.1')
+        assert cache.get(key) is None
+        cache.put(key, u'*foo*\né')
+        assert cache.get(key) == u'*foo*\né'
+        assert cache.stats() == {
+            'hits': 1, 'misses': 1, 'writes': 1, 'evictions': 0,
+        }
+
+    def test_shared_between_instances(self):
+        key = ConversionCache.key('*foo*', 'md', 'rst', '2.2.1')
+        ConversionCache(self.path).put(key, 'foo')
+        assert ConversionCache(self.path).get(key) == 'foo'
+
+    def test_evict_least_recently_used(self):
+        cache = ConversionCache(self.path, max_size=25)
+        keys = [cache.key(str(i), 'md', 'rst', '2.2.1') for i in range(3)]
+        for age, key in enumerate(keys):
+            cache.put(key, 'x' * 10)
+            path = cache._entry_path(key)
+            os.utime(path, (1000 + age, 1000 + age))
+
+        assert cache.evict() == 1
+        assert cache.get(keys[0]) is None
+        assert cache.get(keys[1]) == 'x' * 10
+        assert cache.get(keys[2]) == 'x' * 10
+        assert cache.evictions == 1
+
+    def test_evict_under_limit(self):
+        cache = ConversionCache(self.path, max_size=100)
+        cache.put(cache.key('foo', 'md', 'rst', '2.2.1'), 'x' * 10)
+        assert cache.evict() == 0
+
+    def _recorded_size(self):
+        with open(os.path.join(self.path, '.size')) as f:
+            return int(f.read())
+
+    @mock.patch.object(random, 'random', return_value=0.5)
+    def test_evict_recorded_size(self, random_):
+        cache = ConversionCache(self.path, max_size=100)
+        cache.put(cache.key('a', 'md', 'rst', '2.2.1'), 'x' * 10)
+        assert cache.evict() == 0
+        assert self._recorded_size() == 10
+
+        # While the recorded size is under the limit, the cache is not
+        # listed; nor is it when nothing was written.
+        with mock.patch.object(os, 'walk') as walk:
+            cache.put(cache.key('b', 'md', 'rst', '2.2.1'), u'\xe9' * 5)
+            assert cache.evict() == 0
+            assert cache.evict() == 0
+            walk.assert_not_called()
+        assert self._recorded_size() == 20
+
+        # Once it is over the limit, the cache is listed, and the recorded
+        # size corrected.
+        with open(os.path.join(self.path, '.size'), 'w') as f:
+            f.write('95')
+        cache.put(cache.key('c', 'md', 'rst', '2.2.1'), 'x' * 10)
+        assert cache.evict() == 0
+        assert self._recorded_size() == 30
+
+    def test_evict_rescanned(self):
+        cache = ConversionCache(self.path, max_size=25)
+        with open(os.path.join(self.path, '.size'), 'w') as f:
+            f.write('0')
+        for i in range(3):
+            cache.put(cache.key(str(i), 'md', 'rst', '2.2.1'), 'x' * 10)
+        with mock.patch.object(random, 'random', return_value=0.0):
+            assert cache.evict() == 1
+        assert self._recorded_size() == 20
+
+    def test_evict_unreadable_size(self):
+        cache = ConversionCache(self.path, max_size=25)
+        with open(os.path.join(self.path, '.size'), 'w') as f:
+            f.write('many')
+        for i in range(3):
+            cache.put(cache.key(str(i), 'md', 'rst', '2.2.1'), 'x' * 10)
+        assert cache.evict() == 1
+
+    def test_from_environ(self):
+        assert ConversionCache.from_environ({}) is None
+        cache = ConversionCache.from_environ({
+            'PROTOC_DOCS_CACHE_DIR': self.path,
+            'PROTOC_DOCS_CACHE_MAX_SIZE': '1024',
+        })
+        assert cache.path == self.path
+        assert cache.max_size == 1024
+
+
+class MemoryCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_put(self):
+        cache = MemoryCache()
+        key = cache.key('*foo*', 'md', 'rst', '2.2.1')
+        assert key == ConversionCache.key('*foo*', 'md', 'rst', '2.2.1')
+        assert cache.get(key) is None
+        cache.put(key, u'*foo*\né')
+        cache.put(cache.key('', 'md', 'rst', '2.2.1'), '')
+        assert cache.get(key) == u'*foo*\né'
+        assert cache.get(cache.key('', 'md', 'rst', '2.2.1')) == ''
+        assert cache.evict() == 0
+        assert cache.stats() == {
+            'hits': 2, 'misses': 1, 'writes': 2, 'evictions': 0,
+        }
+
+    def test_evict_least_recently_used(self):
+        cache = MemoryCache(max_size=25)
+        for key in 'abc':
+            cache.put(key, 'x' * 10)
+            cache.get('a')
+        assert len(cache) == 2
+        assert cache.size == 20
+        assert cache.get('a') is not None
+        assert cache.get('b') is None
+        assert cache.get('c') is not None
+        assert cache.stats()['evictions'] == 1
+
+        cache.put('a', 'x' * 5)
+        assert cache.size == 15
+
+    def test_fallback(self):
+        a, b = [MemoryCache.key(text, 'md', 'rst', '2.2.1') for text in 'ab']
+        fallback = ConversionCache(self.path)
+        fallback.put(a, 'A')
+        cache = MemoryCache(fallback=fallback)
+        assert cache.get(a) == 'A'
+        assert cache.get(b) is None
+        cache.put(b, 'B')
+        assert fallback.get(b) == 'B'
+        assert cache.evict() == 0
+
+        # Entries read from the fallback are kept in memory.
+        fallback.hits = 0
+        assert cache.get(a) == 'A'
+        assert fallback.hits == 0
@@ -14,33 +14,55 @@
 
 from __future__ import absolute_import
 
+import textwrap
 import unittest
 
+import pytest
+
 from protoc_docs import code
 
 
 class MessageStructureTests(unittest.TestCase):
     def setUp(self):
-        code.MessageStructure._registry.clear()
+        self.registry = code.MessageStructureRegistry()
 
     def test_get_or_create_same_name(self):
-        a = code.MessageStructure.get_or_create('foo')
-        b = code.MessageStructure.get_or_create('foo')
+        a = self.registry.get_or_create('foo')
+        b = self.registry.get_or_create('foo')
         assert isinstance(a, code.MessageStructure)
         assert isinstance(b, code.MessageStructure)
         assert a is b
 
     def test_get_or_create_different_names(self):
-        a = code.MessageStructure.get_or_create('foo')
-        c = code.MessageStructure.get_or_create('bar')
+        a = self.registry.get_or_create('foo')
+        c = self.registry.get_or_create('bar')
         assert a is not c
 
+    def test_get_or_create_registries_are_separate(self):
+        a = self.registry.get_or_create('foo')
+        b = code.MessageStructureRegistry().get_or_create('foo')
+        assert a is not b
+
+    def test_registry_contents(self):
+        foo = self.registry.get_or_create('foo')
+        assert len(self.registry) == 1
+        assert 'foo' in self.registry
+        assert list(self.registry) == [foo]
+        self.registry.clear()
+        assert len(self.registry) == 0
+        assert self.registry.get_or_create('foo') is not foo
+
+    def test_slots(self):
+        foo = self.registry.get_or_create('foo')
+        with pytest.raises(AttributeError):
+            foo.bar = 'baz'
+
     def test_hash_method(self):
-        foo = code.MessageStructure.get_or_create('foo')
+        foo = self.registry.get_or_create('foo')
         assert hash(foo) == hash('foo')
 
     def test_get_python_docstring(self):
-        foo = code.MessageStructure.get_or_create('foo')
+        foo = self.registry.get_or_create('foo')
         foo.docstring = 'Make a foo.'
         foo.members['bar'] = 'The spam of the eggs.'
         docstring = foo.get_python_docstring()
@@ -50,7 +72,7 @@ class MessageStructureTests(unittest.TestCase):
         assert 'The spam of the eggs.' in docstring
 
     def test_get_python_docstring_no_overall_docstring(self):
-        foo = code.MessageStructure.get_or_create('foo')
+        foo = self.registry.get_or_create('foo')
         foo.members['bar'] = 'The spam of the eggs.'
         docstring = foo.get_python_docstring()
         assert 'foo' not in docstring
@@ -58,9 +80,97 @@ class MessageStructureTests(unittest.TestCase):
         assert 'bar:' in docstring
         assert 'The spam of the eggs.' in docstring
 
+    def test_get_meta_docstring(self):
+        foo = self.registry.get_or_create('foo')
+        foo.members['bar'] = ''
+        foo.members['baz'] = 'The spam.'
+        assert foo.get_docstrings() == ['', 'The spam.']
+        meta_docstring = foo.get_meta_docstring()
+        assert meta_docstring == '\n\n%s1\n\nThe spam.' % foo._BATCH_TOKEN
+
+        # An empty member keeps its place.
+        docstring = foo.get_python_docstring(meta_docstring.upper())
+        assert docstring == (
+            'Attributes:\n    bar:\n\n    baz:\n        THE SPAM.\n')
+
+    def test_get_python_docstring_mangled(self):
+        foo = self.registry.get_or_create('foo')
+        foo.docstring = 'Make a foo.'
+        foo.members['bar'] = 'The spam of the eggs.'
+        mangled = foo.get_meta_docstring().replace(foo._BATCH_TOKEN, '')
+        assert foo.get_python_docstring(mangled.upper()) == \
+            foo.get_python_docstring()
+
     def test_get_python_docstring_no_properties(self):
-        foo = code.MessageStructure.get_or_create('foo')
+        foo = self.registry.get_or_create('foo')
         foo.docstring = 'Make a foo.'
         docstring = foo.get_python_docstring()
         assert 'Make a foo.' in docstring
         assert 'Attributes:' not in docstring
+
+    def test_repr(self):
+        foo = self.registry.get_or_create('foo')
+        foo.docstring = 'Make a foo.'
+        foo.members['bar'] = 'The spam of the eggs.'
+        assert repr(foo) == (
+            'MessageStructure {\n'
+            '    name: foo\n'
+            '    docstring:\n'
+            '        Make a foo.\n'
+            '    members:\n'
+            '        bar:\n'
+            '            The spam of the eggs.\n'
+            '}\n'
+        )
+
+    def test_render_python_docstring(self):
+        foo = self.registry.get_or_create('foo')
+        foo.docstring = 'Make a foo.'
+        foo.members['bar'] = 'The spam of the eggs.'
+        foo.members['baz'] = 'Lovely spam. ' * 10
+        assert foo.render_python_docstring(foo.get_docstrings()) == (
+            'Make a foo.\n'
+            '\n'
+            'Attributes:\n'
+            '    bar:\n'
+            '        The spam of the eggs.\n'
+            '    baz:\n'
+            '        Lovely spam. Lovely spam. Lovely spam. Lovely spam. Lovely\n'
+            '        spam. Lovely spam. Lovely spam. Lovely spam. Lovely spam.\n'
+            '        Lovely spam.\n'
+        )
+
+
+class FillTests(unittest.TestCase):
+    TEXTS = [
+        '',
+        '\n',
+        'One line.\n',
+        'Two\nshort lines.\n',
+        'Two paragraphs.\n\nOf text.\n',
+        '  Indented.\n',
+        'A\ttab.\n',
+        'Trailing space \nhere.\n',
+        ('A line which is exactly as long as the width that it is being '
+         'wrapped\nto.\n'),
+        ('A line which is rather long, and which TextWrapper would wrap for '
+         'certain.\n'),
+        ('A line which is well within the width of a wrapper, followed by a '
+         '\nsplit-up word.\n'),
+        'Lovely spam. ' * 20,
+        '\n'.join(textwrap.wrap('Wonderful spam. ' * 20, 60)),
+        '\n'.join(textwrap.wrap('Wonderful spam. ' * 20, 72)),
+    ]
+
+    def test_fill(self):
+        for indent in (0, 8, 12):
+            wrapper = code._WRAPPERS[indent]
+            for text in self.TEXTS:
+                assert code._fill(text, indent) == \
+                    '\n'.join(wrapper.wrap(text)), (text, indent)
+
+    def test_wrapped(self):
+        assert code._is_wrapped(['Two', 'lines.'], 6, 'Two\nlines.')
+        assert not code._is_wrapped(['Two', 'lines.'], 70, 'Two\nlines.')
+        assert not code._is_wrapped(['Two', 'lines-'], 6, 'Two\nlines-')
+        assert not code._is_wrapped(['Tab\t'], 70, 'Tab\t')
@@ -0,0 +1,144 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import mock
+import pypandoc
+import pytest
+
+from protoc_docs import discovery
+from protoc_docs import runtime
+
+
+class DiscoveryTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.pandoc = os.path.join(self.path, 'bin', 'pandoc')
+        self.cache_path = os.path.join(self.path, 'versions.json')
+        os.mkdir(os.path.dirname(self.pandoc))
+        self._write_pandoc('pandoc 2.2.1\nCompiled with pandoc-types 1.17')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _write_pandoc(self, version_output, path=None):
+        path = path or self.pandoc
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nprintf "%s\\n"\n' % version_output)
+        os.chmod(path, 0o755)
+
+    def test_find_pandoc(self):
+        path = os.pathsep.join([self.path, os.path.dirname(self.pandoc)])
+        newer = os.path.join(self.path, 'newer')
+        older = os.path.join(self.path, 'older')
+        broken = os.path.join(self.path, 'broken')
+        self._write_pandoc('pandoc 2.9.2.1', path=newer)
+        self._write_pandoc('pandoc 1.19.2', path=older)
+        self._write_pandoc('pandoc', path=broken)
+        with mock.patch.object(discovery, '_installed_paths',
+                               return_value=[broken, older, self.cache_path]):
+            assert discovery.find_pandoc(
+                {'PATH': path}, cache_path=self.cache_path) == self.pandoc
+            assert discovery.find_pandoc(
+                {'PATH': self.path}, cache_path=self.cache_path) == older
+        with mock.patch.object(discovery, '_installed_paths',
+                               return_value=[broken]):
+            assert discovery.find_pandoc(
+                {'PATH': self.path}, cache_path=self.cache_path) is None
+        with mock.patch.object(discovery, '_installed_paths',
+                               return_value=[newer]):
+            assert discovery.find_pandoc(
+                {'PATH': path}, cache_path=self.cache_path) == newer
+        assert discovery._installed_paths()[0] == os.path.join(
+            os.path.dirname(os.path.realpath(pypandoc.__file__)),
+            'files', 'pandoc')
+        assert discovery.find_pandoc({
+            'PATH': path,
+            discovery.ENV_PYPANDOC_PANDOC: '/opt/pandoc',
+        }) == '/opt/pandoc'
+        assert discovery.find_pandoc({
+            'PATH': path,
+            discovery.ENV_PYPANDOC_PANDOC: '/opt/pandoc',
+            discovery.ENV_PANDOC: '/usr/local/bin/pandoc',
+        }) == '/usr/local/bin/pandoc'
+
+    def test_get_version(self):
+        with mock.patch.object(subprocess, 'check_output',
+                               wraps=subprocess.check_output) as probe:
+            for _ in range(2):
+                assert discovery.get_version(
+                    self.pandoc, cache_path=self.cache_path) == '2.2.1'
+            assert probe.call_count == 1
+
+            # Another binary is probed again.
+            self._write_pandoc('pandoc 2.9.2.1')
+            os.utime(self.pandoc, (0, 0))
+            assert discovery.get_version(
+                self.pandoc, cache_path=self.cache_path) == '2.9.2.1'
+            assert probe.call_count == 2
+
+    def test_get_version_unreadable(self):
+        for contents in ('{', '[]', '{"%s": "2.2.1"}' % self.pandoc):
+            with open(self.cache_path, 'w') as f:
+                f.write(contents)
+            assert discovery.get_version(
+                self.pandoc, cache_path=self.cache_path) == '2.2.1'
+
+    def test_probe_version(self):
+        assert discovery.probe_version(self.pandoc) == '2.2.1'
+        for output in ('pandoc', ''):
+            self._write_pandoc(output)
+            with pytest.raises(ValueError):
+                discovery.probe_version(self.pandoc)
+
+    def test_get_version_not_private(self):
+        # Versions remembered in a file others can write to are ignored.
+        with open(self.cache_path, 'w') as f:
+            f.write('{}')
+        os.chmod(self.cache_path, 0o666)
+        with mock.patch.object(subprocess, 'check_output',
+                               wraps=subprocess.check_output) as probe:
+            for _ in range(2):
+                assert discovery.get_version(
+                    self.pandoc, cache_path=self.cache_path) == '2.2.1'
+                os.chmod(self.cache_path, 0o666)
+            assert probe.call_count == 2
+
+    def test_default_cache_path(self):
+        assert os.path.dirname(discovery.default_cache_path()) == \
+            runtime.private_dir()
+        with mock.patch.object(discovery, 'default_cache_path',
+                               return_value=self.cache_path):
+            assert discovery.get_version(self.pandoc) == '2.2.1'
+        assert os.path.exists(self.cache_path)
+
+        # Without a private directory, versions are not remembered.
+        with mock.patch.object(runtime, 'private_dir', side_effect=OSError):
+            assert discovery.get_version(self.pandoc) == '2.2.1'
+
+    @mock.patch.object(pypandoc, '__version', None, create=True)
+    @mock.patch.object(pypandoc, '__pandoc_path', None, create=True)
+    def test_use_pandoc(self):
+        discovery.use_pandoc(self.pandoc)
+        assert getattr(pypandoc, '__pandoc_path') == self.pandoc
+        assert getattr(pypandoc, '__version') is None
+        discovery.use_pandoc(self.pandoc, '2.2.1')
+        assert getattr(pypandoc, '__version') == '2.2.1'
@@ -0,0 +1,87 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import unittest
+
+import pypandoc
+
+from protoc_docs import framing
+from protoc_docs.batch import BatchConverter
+from protoc_docs.backends import PandocBackend
+
+
+class FramingTests(unittest.TestCase):
+    def test_round_trip(self):
+        texts = ['a', '', 'b\n\nc\n', '\n']
+        document = framing.frame(texts, 'T')
+        assert document == 'a\n\nT1\n\n\n\nT2\n\nb\n\nc\n\n\nT3\n\n\n'
+        assert framing.unframe(document, 'T', 4) == [
+            'a\n', '\n', 'b\n\nc\n', '\n']
+
+    def test_single(self):
+        assert framing.frame(['a T1'], 'T') == 'a T1'
+        assert framing.unframe('a T1', 'T', 1) == ['a T1\n']
+
+    def test_nothing(self):
+        assert framing.frame([], 'T') == ''
+        assert framing.unframe('', 'T', 0) == []
+
+    def test_mangled(self):
+        for document in (
+                'a\n\nb\n',                      # A sentinel is missing.
+                'a\n\nT1\n\nb\n\nT1\n\nc\n',     # Out of order.
+                'a\n\nT1\n\nb\n\nT3\n\nc\n',     # Out of order.
+                'a\n\n   T1\n\nb\n\nT2\n\nc\n',  # Indented.
+                'a T1\n\nb\n\nT2\n\nc\n',        # Moved into a paragraph.
+                'a\n\nT1x\n\nb\n\nT2\n\nc\n',    # Changed.
+                'a\n\nT1\n\nb\n\nT2\n\nc\n\nT3', # One too many.
+        ):
+            assert framing.unframe(document, 'T', 3) is None, document
+        assert framing.unframe('a\n\nT1\n\nb\n\nT2', 'T', 3) == [
+            'a\n', 'b\n', '\n']
+
+    def test_collides(self):
+        assert framing.collides('a T b', 'T')
+        assert not framing.collides('a b', 'T')
+
+
+class PandocFramingTests(unittest.TestCase):
+    TEXTS = [
+        'A paragraph\nwrapped *over* two lines.',
+        '- A list\n- with `two` items',
+        'Text which\n\n    is indented',
+        '1. A numbered list',
+        '# A heading',
+        '',
+        '```\nAn unclosed fence',
+        'A [link](https://example.com).',
+    ]
+
+    def _convert(self, texts):
+        return [pypandoc.convert_text(text, 'rst', format='commonmark')
+                for text in texts]
+
+    def test_same_as_alone(self):
+        texts = self.TEXTS[:6] + self.TEXTS[7:]
+        converted = PandocBackend().convert(texts, 'rst', 'commonmark', '$#!')
+        assert converted == self._convert(texts)
+
+    def test_unclosed_fence_bisected(self):
+        # The unclosed fence swallows the sentinels after it, so the batch
+        # is bisected until it is converted on its own.
+        converter = BatchConverter('$#!', backend=PandocBackend())
+        assert converter.convert(self.TEXTS) == self._convert(self.TEXTS)
+        assert converter.recorder.counters['batches_bisected'] > 0
@@ -0,0 +1,117 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+import pytest
+
+from protoc_docs import instrumentation
+from protoc_docs.instrumentation import Recorder
+
+
+class RecorderTests(unittest.TestCase):
+    def test_stages(self):
+        recorder = Recorder('tool')
+        for name in ('read', 'convert', 'read'):
+            with recorder.stage(name):
+                pass
+        events = recorder.events()
+        assert [e['event'] for e in events] == ['stage', 'stage', 'run']
+        assert [e['stage'] for e in events[:2]] == ['read', 'convert']
+        assert events[0]['calls'] == 2
+        assert events[1]['calls'] == 1
+        for event in events:
+            assert event['tool'] == 'tool'
+            assert event['wall'] >= 0
+            assert event['cpu'] >= 0
+            assert event['max_rss_kb'] > 0
+
+    def test_stage_error(self):
+        recorder = Recorder('tool')
+        with pytest.raises(ValueError):
+            with recorder.stage('read'):
+                raise ValueError
+        assert recorder.stages['read']['calls'] == 1
+
+    def test_add_threads(self):
+        recorder = Recorder('tool')
+
+        def add():
+            for _ in range(1000):
+                recorder.add('calls')
+                recorder.add('seconds', 0.5)
+        threads = [threading.Thread(target=add) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert recorder.events()[-1]['counters'] == {
+            'calls': 4000, 'seconds': 2000.0}
+
+    def test_write_file(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        target = os.path.join(path, 'stats.jsonl')
+        for _ in range(2):
+            recorder = Recorder('tool')
+            with recorder.stage('read'):
+                pass
+            recorder.write(target)
+        with open(target) as f:
+            events = [json.loads(line) for line in f]
+        assert [e['event'] for e in events] == ['stage', 'run'] * 2
+
+    @mock.patch('sys.stderr', new_callable=io.StringIO)
+    def test_write_stderr(self, stderr):
+        Recorder('tool').write('-')
+        assert json.loads(stderr.getvalue())['event'] == 'run'
+
+    @mock.patch('sys.stderr', new_callable=io.StringIO)
+    def test_write_nowhere(self, stderr):
+        Recorder('tool').write(None)
+        assert stderr.getvalue() == ''
+
+
+class CountingStreamTests(unittest.TestCase):
+    def test_count(self):
+        stream = instrumentation.CountingStream(io.BytesIO(b'abcdef'))
+        assert stream.read(2) == b'ab'
+        assert stream.read() == b'cdef'
+        stream.write(b'gh')
+        stream.flush()
+        assert stream.count == 8
+
+
+class GetTargetTests(unittest.TestCase):
+    def test_parameter(self):
+        environ = {instrumentation.ENV_STATS: 'env.jsonl'}
+        get_target = instrumentation.get_target
+        assert get_target('stats=p.jsonl', environ) == 'p.jsonl'
+        assert get_target('foo=bar, stats = - ', environ) == '-'
+        assert get_target('foo=bar,stats=', environ) == 'env.jsonl'
+        assert get_target('', environ) == 'env.jsonl'
+        assert get_target(None, {}) is None
+
+    @mock.patch.dict(os.environ, {instrumentation.ENV_STATS: '-'})
+    def test_environ(self):
+        assert instrumentation.get_target() == '-'
@@ -0,0 +1,273 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import os
+import re
+import unittest
+
+import pypandoc
+import pytest
+
+from google.protobuf import descriptor_pb2 as desc
+from protoc_docs import markdown
+from protoc_docs.bin.py_desc_converter import CommentsConverter
+
+curdir = os.path.realpath(os.path.dirname(__file__))
+
+_LIST_MARKER_RE = re.compile(r'( *)(-|\d+\.) +(?=\S)')
+
+# Comments which pandoc converts differently than it seems at first sight.
+_EDGE_CASES = (
+    'Title\n-',
+    'Foo\n- ',
+    'Title\n=',
+    '1. 1. http://a.com',
+    '- - a',
+    '- 1. a',
+    '2. * a',
+    u'Non-breaking\xa0space, ' * 5,
+    u'Em\u2003space, ' * 5,
+    u'Ideographic\u3000space, ' * 5,
+    u'Zero\u200bwidth space, ' * 5,
+    u'Form\x0cfeed, ' * 5,
+    u'\u65e5\u672c\u8a9e\u306e\u30c6\u30ad\u30b9\u30c8 ' * 12,
+    u'\uff46\uff55\uff4c\uff4c \uff57\uff49\uff44\uff54\uff48 ' * 10,
+    u'Emoji \U0001f600 ' * 20,
+    u'Combining e\u0301 ' * 10,
+    u'Ambiguous \u03b1\u2192\xb0 ' * 10,
+    u'Caf\xe9 ' * 20,
+)
+
+
+def _lines(rst):
+    """Return the lines of reStructuredText, without list marker padding."""
+    lines = []
+    indent = {}
+    for line in rst.strip('\n').split('\n'):
+        line = line.rstrip()
+        match = _LIST_MARKER_RE.match(line)
+        if match:
+            # Continuation lines are indented to the item's text.
+            indent = {len(match.group(0)):
+                      len(match.group(1)) + len(match.group(2)) + 1}
+            line = '%s%s %s' % (match.group(1), match.group(2),
+                                line[match.end():])
+        elif line:
+            stripped = line.lstrip(' ')
+            width = len(line) - len(stripped)
+            if width in indent:
+                line = ' ' * indent[width] + stripped
+        lines.append(line)
+    return lines
+
+
+class ToRstTests(unittest.TestCase):
+    def test_plain_paragraphs(self):
+        assert markdown.to_rst(' Foo bar\n baz.\n\n Spam.\n') == (
+            'Foo bar baz.\n\nSpam.\n')
+
+    def test_empty(self):
+        assert markdown.to_rst('') == ''
+        assert markdown.to_rst(' \n\n') == ''
+
+    def test_wrap(self):
+        rst = markdown.to_rst('word ' * 30)
+        lines = rst.splitlines()
+        assert len(lines) == 3
+        assert all(len(line) <= markdown.WIDTH for line in lines)
+
+    def test_inline(self):
+        assert markdown.to_rst(
+            'The `name` is *really* **very** _important_, see '
+            '[docs](https://cloud.google.com/foo).'
+        ) == (
+            'The ``name`` is *really* **very** *important*, see\n'
+            '`docs <https://cloud.google.com/foo>`__.\n'
+        )
+
+    def test_code_not_wrapped(self):
+        rst = markdown.to_rst('x ' * 30 + '`a b c d e f`')
+        assert '``a b c d e f``' in rst
+
+    def test_intraword_underscore(self):
+        assert markdown.to_rst('snake_case_name') == 'snake_case_name\n'
+        assert markdown.to_rst('trailing_') is None
+        assert markdown.to_rst('_leading') is None
+
+    def test_bullet_list(self):
+        assert markdown.to_rst(
+            ' Modes:\n\n   - One\n     thing.\n   * Two.\n'
+        ) is None  # Mixed markers start a new list.
+        assert markdown.to_rst(' - One\n   thing.\n\n - Two.\n') == (
+            '- One thing.\n\n- Two.\n')
+
+    def test_ordered_list_numbering(self):
+        assert markdown.to_rst('1. One.\n\n1. Two.\n') == '1. One.\n\n2. Two.\n'
+
+    def test_unsupported(self):
+        for text in ('# Heading', '> quote', '    code', '```\ncode\n```',
+                     'a\n- b', '- a\n  - b', '[Foo][]', '<b>x</b>', 'a \\* b',
+                     'a | b', 'foo`bar`', 'Example::', 'hard  \nbreak',
+                     'A. Lincoln', '10. ten', '1) one', 'tab\there',
+                     'Title\n-', 'Title\n='):
+            assert markdown.to_rst(text) is None, text
+
+    def test_unsupported_chars(self):
+        for text in (u'a\xa0b', u'a\u2003b', u'a\x0cb', u'a\x7fb',
+                     u'a\u200bb', u'\u65e5\u672c', u'\uff46', u'\U0001f600',
+                     u'e\u0301'):
+            assert markdown.to_rst(text) is None, repr(text)
+        assert markdown.to_rst(u'Caf\xe9 \u03b1\u2192') == u'Caf\xe9 \u03b1\u2192\n'
+
+    def test_pandoc_markdown(self):
+        assert markdown.to_rst("don't", format='md') is None
+        assert markdown.to_rst("don't", format='commonmark') == "don't\n"
+        assert markdown.to_rst('e.g. this', format='md') is None
+        assert markdown.to_rst('a -- b', format='md') is None
+        assert markdown.to_rst('$x$', format='md') is None
+        assert markdown.to_rst('plain', format='md') == 'plain\n'
+
+    def test_nested_list(self):
+        for text in ('1. 1. http://a.com', '- - a', '- 1. a', '1. # a'):
+            assert markdown.to_rst(text) is None, text
+
+    def test_unknown_format(self):
+        assert markdown.to_rst('plain', format='html') is None
+
+
+class IsPlainTests(unittest.TestCase):
+    def test_plain(self):
+        for text in ('', 'Foo.', ' Foo bar\n baz.\n\n Spam.\n',
+                     'The snake_case_name.', "don't", '   Indented.'):
+            assert markdown.is_plain(text), text
+
+    def test_markup(self):
+        for text in ('The `name`.', '*a*', '[a](b)', '_a_', 'trailing_',
+                     '- a', '1. a', '# Heading', '    code', 'a\n> b',
+                     'hard  \nbreak', 'tab\there', 'Example::', 'a | b'):
+            assert not markdown.is_plain(text), text
+
+    def test_pandoc_markdown(self):
+        assert not markdown.is_plain("don't", format='md')
+        assert not markdown.is_plain('e.g. this', format='md')
+        assert markdown.is_plain('plain', format='md')
+
+    def test_non_ascii(self):
+        for text in _EDGE_CASES:
+            assert not markdown.is_plain(text), repr(text)
+
+    def test_unknown_format(self):
+        assert not markdown.is_plain('plain', format='html')
+
+
+class DifferentialTests(unittest.TestCase):
+    """Compare the native conversion to pandoc's for real comments."""
+
+    _SEPARATOR = 'E7A4C1B09D2F33'
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            pypandoc.get_pandoc_version()
+        except OSError:
+            pytest.skip('pandoc is not installed')
+
+        desc_set = desc.FileDescriptorSet()
+        with open('%s/data/descriptor_set' % curdir, 'rb') as f:
+            desc_set.ParseFromString(f.read())
+
+        # Pre-process the comments the same way the descriptor converter
+        # does before handing them over.
+        converter = CommentsConverter()
+        comments = set()
+        for file_descriptor_proto in desc_set.file:
+            for location in file_descriptor_proto.source_code_info.location:
+                for comment in ([location.leading_comments,
+                                 location.trailing_comments] +
+                                list(location.leading_detached_comments)):
+                    comment = converter._replace_proto_link(comment)
+                    comments.add(converter._replace_relative_link(comment))
+        cls.comments = sorted(comments)
+
+    def _pandoc(self, texts, format):
+        # Separate comments by a paragraph of their own so that they do not
+        # affect each other's conversion.
+        separator = '\n\n%s\n\n' % self._SEPARATOR
+        converted = pypandoc.convert_text(
+            separator.join(texts), 'rst', format=format,
+        ).split(self._SEPARATOR)
+        if len(converted) != len(texts):  # pragma: NO COVER
+            converted = [pypandoc.convert_text(t, 'rst', format=format)
+                         for t in texts]
+        return converted
+
+    def _check(self, format):
+        native = []
+        for comment in self.comments:
+            rst = markdown.to_rst(comment, format=format)
+            if rst is not None:
+                native.append((comment, rst))
+
+        # The point of the native converter is to handle most comments.
+        assert len(native) > len(self.comments) // 2
+
+        expected = self._pandoc([comment for comment, _ in native], format)
+        for (comment, rst), pandoc_rst in zip(native, expected):
+            # pandoc's list marker padding varies between versions; the
+            # structure and the rest of the whitespace must not.
+            assert _lines(rst) == _lines(pandoc_rst), comment
+
+    def _check_plain(self, format):
+        plain = [c for c in self.comments + list(_EDGE_CASES)
+                 if markdown.is_plain(c, format)]
+        assert plain
+
+        # Plain comments bypass pandoc, so their conversion must be exactly
+        # the same as pandoc's.
+        expected = self._pandoc(plain, format)
+        for comment, pandoc_rst in zip(plain, expected):
+            assert markdown.to_rst(comment, format=format).strip('\n') == \
+                pandoc_rst.strip('\n'), comment
+
+    def _check_edge_cases(self, format):
+        converted = [(comment, markdown.to_rst(comment, format=format))
+                     for comment in _EDGE_CASES]
+        converted = [(comment, rst) for comment, rst in converted
+                     if rst is not None]
+        assert converted
+
+        # Edge cases are compared exactly, since whitespace is their point.
+        expected = self._pandoc([comment for comment, _ in converted], format)
+        for (comment, rst), pandoc_rst in zip(converted, expected):
+            assert rst.strip('\n') == pandoc_rst.strip('\n'), repr(comment)
+
+    def test_commonmark(self):
+        self._check('commonmark')
+
+    def test_edge_cases_commonmark(self):
+        self._check_edge_cases('commonmark')
+
+    def test_edge_cases_pandoc_markdown(self):
+        self._check_edge_cases('md')
+
+    def test_plain_commonmark(self):
+        self._check_plain('commonmark')
+
+    def test_plain_pandoc_markdown(self):
+        self._check_plain('md')
+
+    def test_pandoc_markdown(self):
+        self._check('md')
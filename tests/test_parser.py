@@ -105,6 +105,151 @@ class TestCodeGeneratorParser(unittest.TestCase):
             answer[filename].add(message_structure)
         assert len(answer) == 0
 
+    def test_find_docs_matches_parse_path(self):
+        with io.open('%s/data/input_buffer' % curdir, 'rb') as file_:
+            cgp = parser.CodeGeneratorParser.from_input_file(file_)
+
+        def snapshot(structures):
+            return {ms.name: (ms.docstring, dict(ms.members))
+                    for ms in structures}
+
+        proto_file = cgp._request.proto_file[0]
+        locations = [loc for loc in proto_file.source_code_info.location
+                     if loc.path and loc.path[0] == 4 and
+                     (loc.leading_comments or loc.trailing_comments)]
+
+        # Resolve every comment by walking from the top of the file.
+        cgp.registry.clear()
+        expected = set()
+        for loc in locations:
+            message_structure = cgp.parse_path(
+                proto_file, list(loc.path), 'doc %s' % list(loc.path))
+            if message_structure:
+                expected.add(message_structure)
+        expected = snapshot(expected)
+
+        # The index must resolve every comment the same way.
+        cgp.registry.clear()
+        index = {}
+        actual = set()
+        for loc in locations:
+            path = tuple(loc.path)
+            element = cgp._lookup(
+                proto_file, path if len(path) % 2 == 0 else path[:-1], index)
+            if element is None:
+                continue
+            name, member = element[2]
+            message_structure = cgp.registry.get_or_create(name)
+            if member is None:
+                message_structure.docstring = 'doc %s' % list(loc.path)
+            else:
+                message_structure.members[member] = 'doc %s' % list(loc.path)
+            actual.add(message_structure)
+        assert snapshot(actual) == expected
+
+    def test_lookup_nested(self):
+        request = CodeGeneratorRequest()
+        proto_file = request.proto_file.add(name='foo.proto', package='foo')
+        outer = proto_file.message_type.add(name='Outer')
+        outer.field.add(name='spam')
+        outer.enum_type.add(name='Kind')
+        outer.reserved_range.add(start=1, end=2)
+        inner = outer.nested_type.add(name='Inner')
+        inner.field.add(name='eggs')
+        inner.nested_type.add(name='Innermost')
+        cgp = parser.CodeGeneratorParser(request)
+        index = {}
+
+        def lookup(*path):
+            element = cgp._lookup(proto_file, path, index)
+            return element and element[2]
+        assert lookup(4, 0) == ('foo.Outer', None)
+        assert lookup(4, 0, 2, 0) == ('foo.Outer', 'spam')
+        assert lookup(4, 0, 3, 0) == ('foo.Outer.Inner', None)
+        assert lookup(4, 0, 3, 0, 2, 0) == ('foo.Outer.Inner', 'eggs')
+        assert lookup(4, 0, 3, 0, 3, 0) == ('foo.Outer.Inner.Innermost', None)
+        assert lookup(4, 0, 4, 0) is None
+        assert lookup(4, 0, 9, 0) is None
+        assert lookup(4, 0, 7, 0) is None
+        assert lookup(4, 1) is None
+        assert lookup(4, 1, 2, 0) is None
+        assert lookup() is None
+
+        # Every element is only found once.
+        assert index[(4, 0, 3, 0)][0] is inner
+        assert len(index) == 11
+
+    def test_find_docs_options_comment(self):
+        request = CodeGeneratorRequest(file_to_generate=['foo.proto'])
+        proto_file = request.proto_file.add(name='foo.proto', package='foo')
+        proto_file.message_type.add(name='Bar').field.add(name='baz')
+        locations = proto_file.source_code_info.location
+        locations.add(path=[4, 0, 7], leading_comments=' Options.')
+        locations.add(path=[4, 0, 2, 0, 8], leading_comments=' Field.')
+        locations.add(path=[4, 0, 9, 0], leading_comments=' Reserved.')
+        cgp = parser.CodeGeneratorParser(request)
+        answer = list(cgp.find_docs())
+        assert len(answer) == 2
+        message_structure = answer[0][1]
+        assert message_structure.name == 'foo.Bar'
+        assert message_structure.docstring == 'Options.\n'
+        assert message_structure.members == {'baz': 'Field.\n'}
+
+    def test_find_docs_registry_per_parser(self):
+        with io.open('%s/data/input_buffer' % curdir, 'rb') as file_:
+            data = file_.read()
+        first = parser.CodeGeneratorParser.from_input_file(io.BytesIO(data))
+        second = parser.CodeGeneratorParser.from_input_file(io.BytesIO(data))
+        a = {ms.name: ms for _, ms in first.find_docs()}
+        b = {ms.name: ms for _, ms in second.find_docs()}
+        assert len(first.registry) == len(a) == len(b) == len(second.registry)
+        for name in a:
+            assert a[name] is not b[name]
+            assert a[name].docstring == b[name].docstring
+
+    def test_decode_request_lazy(self):
+        with io.open('%s/data/input_buffer' % curdir, 'rb') as file_:
+            request = CodeGeneratorRequest.FromString(file_.read())
+        request.parameter = 'stats=-'
+        generated = request.proto_file[-1]
+        dependency = request.proto_file.add(name='dep.proto', package='dep')
+        dependency.message_type.add(name='Dep')
+        request.proto_file.add(package='nameless')
+        data = request.SerializeToString()
+
+        eager = parser.decode_request(data)
+        lazy = parser.decode_request(data, lazy=True)
+        assert eager == request
+        assert [f.name for f in lazy.proto_file] == [generated.name]
+        assert lazy.proto_file[0] == generated
+        assert lazy.parameter == request.parameter
+        assert lazy.file_to_generate == request.file_to_generate
+
+        eager_docs = [(fn, ms.name) for fn, ms in
+                      parser.CodeGeneratorParser(eager).find_docs()]
+        lazy_docs = [(fn, ms.name) for fn, ms in
+                     parser.CodeGeneratorParser(lazy).find_docs()]
+        assert lazy_docs == eager_docs
+
+    def test_decode_request_lazy_nothing_skipped(self):
+        request = CodeGeneratorRequest(file_to_generate=['a.proto'])
+        request.proto_file.add(name='a.proto')
+        data = request.SerializeToString()
+        assert parser.decode_request(data, lazy=True) == request
+        assert parser.decode_request(b'', lazy=True) == CodeGeneratorRequest()
+
+    def test_decode_request_lazy_malformed(self):
+        with pytest.raises(ValueError):
+            parser.decode_request(b'\x7a\x05abc', lazy=True)
+
+    def test_from_input_file_lazy(self):
+        request = CodeGeneratorRequest(file_to_generate=['a.proto'])
+        request.proto_file.add(name='a.proto')
+        request.proto_file.add(name='b.proto')
+        cgp = parser.CodeGeneratorParser.from_input_file(
+            io.BytesIO(request.SerializeToString()), lazy=True)
+        assert [f.name for f in cgp._request.proto_file] == ['a.proto']
+
     def test_is_mixed_case(self):
         cgp = parser.CodeGeneratorParser(CodeGeneratorRequest())
         assert cgp._is_mixed_case('foo') is False
@@ -13,31 +13,47 @@
 # limitations under the License.
 
 from __future__ import absolute_import
+import io
+import json
+import shutil
+import tempfile
 import unittest
 import pypandoc
 import mock
+import pytest
 import restructuredtext_lint
 import os
 
 from protoc_docs.bin import py_desc_converter
+from protoc_docs.cache import ConversionCache
+from protoc_docs.instrumentation import ENV_STATS
+from protoc_docs.instrumentation import Recorder
 from google.protobuf import descriptor_pb2 as desc
 
+from helpers import UpperBackend
+
 curdir = os.path.realpath(os.path.dirname(__file__))
 
 
 class PythonDocsConversionTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
     @mock.patch.object(pypandoc, 'convert_text')
     def test_execute(self, convert_text):
         convert_text.return_value = ''
         descriptor_set = '%s/data/descriptor_set' % curdir
-        updated_desciprot_set = '%s/data/descriptor_set_updated_py_docs' % curdir
+        updated_desciprot_set = os.path.join(self.path, 'updated_py_docs')
         py_desc_converter.convert_desc(descriptor_set, updated_desciprot_set)
         convert_text.assert_called()
 
     @unittest.expectedFailure
     def test_valid_rst(self):
         descriptor_set = '%s/data/descriptor_set' % curdir
-        updated_desciprot_set = '%s/data/descriptor_set_updated_py_docs' % curdir
+        updated_desciprot_set = os.path.join(self.path, 'updated_py_docs')
         py_desc_converter.convert_desc(descriptor_set, updated_desciprot_set)
 
         desc_set = desc.FileDescriptorSet()
@@ -103,6 +119,566 @@ class PythonDocsConversionTests(unittest.TestCase):
         pypandoc.pandoc_download.download_pandoc(version='1.19.2')
 
 
+class _CancelledBackend(UpperBackend):
+    def convert(self, texts, to, format, batch_token):
+        if self.calls:
+            raise RuntimeError('Cancelled.')
+        return super(_CancelledBackend, self).convert(
+            texts, to, format, batch_token)
+
+
+class CommentsConverterTests(unittest.TestCase):
+    def _converter(self, recorder=None):
+        return py_desc_converter.CommentsConverter(
+            backend=UpperBackend(), jobs=1, recorder=recorder)
+
+    def test_order(self):
+        comments = ['plain', '', '*a*\nb', 'plain\ntoo', '`c`', '', '_d_',
+                    'e', 'f', '[g]']
+        recorder = Recorder('test')
+        converter = self._converter(recorder)
+        for comment in comments:
+            converter.put_comment(comment)
+        converter.convert()
+        assert [converter.get_next_comment() for _ in comments] == [
+            'plain', '', ' *A*\n B', 'plain\ntoo', ' `C`', '', ' _D_',
+            'e', 'f', ' [G]']
+        assert recorder.counters['comments'] == 10
+        assert recorder.counters['comments_bypassed'] == 6
+        assert recorder.counters['comments_store_bytes'] == \
+            converter.memory_footprint()
+
+    def test_nothing_to_convert(self):
+        converter = self._converter()
+        converter.put_comment('a')
+        converter.put_comment('b')
+        converter.convert()
+        assert converter.get_next_comment() == 'a'
+        assert converter.get_next_comment() == 'b'
+
+    def test_memory_footprint(self):
+        converter = self._converter()
+        empty = converter.memory_footprint()
+        for _ in range(1000):
+            converter.put_comment('abc')
+        # One character, one offset and a bit per comment.
+        assert converter.memory_footprint() == \
+            empty + 1000 * (3 + converter._offsets.itemsize) + 125
+        converter.convert()
+        assert converter.memory_footprint() >= empty + 1000 * 3
+
+
+class FileFilterTests(unittest.TestCase):
+    def test_selects(self):
+        file_filter = py_desc_converter.FileFilter()
+        assert file_filter.selects('google/protobuf/any.proto',
+                                   'google.protobuf')
+
+        file_filter = py_desc_converter.FileFilter(
+            include=['google/spanner/*', 'google.api'],
+            exclude=['*/v1/keys.proto', 'google.protobuf'])
+        assert file_filter.selects('google/spanner/v1/type.proto',
+                                   'google.spanner.v1')
+        assert file_filter.selects('google/api/http.proto', 'google.api')
+        assert not file_filter.selects('google/spanner/v1/keys.proto',
+                                       'google.spanner.v1')
+        assert not file_filter.selects('google/protobuf/any.proto',
+                                       'google.protobuf')
+        assert not file_filter.selects('google/spanner/v1/other.proto',
+                                       'google.protobuf')
+        assert not file_filter.selects('other.proto')
+
+    def test_selects_serialized(self):
+        file_filter = py_desc_converter.FileFilter(exclude=['google.protobuf'])
+        for package, selected in (('google.protobuf', False),
+                                  ('google.api', True)):
+            data = desc.FileDescriptorProto(
+                name='a.proto', package=package, syntax='proto3',
+                message_type=[desc.DescriptorProto(name='A')],
+                public_dependency=[0],
+            ).SerializeToString()
+            assert file_filter.selects_serialized(data) == selected
+
+
+class StreamingConversionTests(unittest.TestCase):
+    def setUp(self):
+        with io.open('%s/data/descriptor_set' % curdir, 'rb') as f:
+            self.data = f.read()
+        self.file_count = len(desc.FileDescriptorSet.FromString(self.data).file)
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _convert(self, data, **kwargs):
+        output = io.BytesIO()
+        py_desc_converter.convert_desc_stream(
+            io.BytesIO(data), output, **kwargs)
+        return output.getvalue()
+
+    def test_groups(self):
+        whole = UpperBackend()
+        expected = self._convert(self.data, backend=whole)
+        assert len(whole.calls) == 1
+
+        grouped = UpperBackend()
+        assert self._convert(self.data, backend=grouped,
+                             memory_budget=1) == expected
+        assert len(grouped.calls) == self.file_count
+        assert sum(grouped.calls) == whole.calls[0]
+
+        converted = desc.FileDescriptorSet.FromString(expected)
+        assert len(converted.file) == self.file_count
+        comments = [location.leading_comments
+                     for f in converted.file
+                     for location in f.source_code_info.location
+                     if '`' in location.leading_comments]
+        assert comments
+        assert all(c == c.upper() for c in comments)
+
+    def test_memory_budget_from_environ(self):
+        backend = UpperBackend()
+        environ = {py_desc_converter.ENV_MEMORY_BUDGET: str(len(self.data))}
+        with mock.patch.dict(os.environ, environ):
+            self._convert(self.data + self.data, backend=backend)
+        assert len(backend.calls) == 2
+
+    def test_negative_memory_budget(self):
+        with pytest.raises(ValueError):
+            self._convert(self.data, backend=UpperBackend(), memory_budget=-1)
+
+    def test_other_fields_preserved(self):
+        data = b'\x10\x01' + self.data + b'\x10\x02'
+        backend = UpperBackend()
+        output = self._convert(data, backend=backend, memory_budget=1)
+        assert output.startswith(b'\x10\x01')
+        assert output.endswith(b'\x10\x02')
+        assert output[2:-2] == self._convert(self.data,
+                                             backend=UpperBackend())
+
+    def test_convert_desc_paths(self):
+        source = os.path.join(self.path, 'source')
+        dest = os.path.join(self.path, 'dest')
+        with open(source, 'wb') as f:
+            f.write(self.data)
+        cache = ConversionCache(os.path.join(self.path, 'cache'))
+        for _ in range(2):
+            backend = UpperBackend()
+            py_desc_converter.convert_desc(source, dest, cache=cache,
+                                           backend=backend)
+            with open(dest, 'rb') as f:
+                assert f.read() == self._convert(self.data,
+                                                 backend=UpperBackend())
+
+        # The second run was served from the cache.
+        assert backend.calls == []
+
+    def test_convert_desc_atomic(self):
+        source = os.path.join(self.path, 'source')
+        dest = os.path.join(self.path, 'dest')
+        with open(source, 'wb') as f:
+            f.write(self.data)
+        with open(dest, 'wb') as f:
+            f.write(b'earlier')
+
+        # The first group is written out before the run fails, but not to
+        # dest.
+        backend = _CancelledBackend()
+        with pytest.raises(RuntimeError):
+            py_desc_converter.convert_desc(source, dest, backend=backend,
+                                           memory_budget=1)
+        assert len(backend.calls) == 1
+        with open(dest, 'rb') as f:
+            assert f.read() == b'earlier'
+        assert sorted(os.listdir(self.path)) == ['dest', 'source']
+
+        py_desc_converter.convert_desc(source, dest, backend=UpperBackend())
+        with open(dest, 'rb') as f:
+            assert f.read() == self._convert(self.data,
+                                             backend=UpperBackend())
+        assert sorted(os.listdir(self.path)) == ['dest', 'source']
+
+    def test_stats(self):
+        target = os.path.join(self.path, 'stats.jsonl')
+        with mock.patch.dict(os.environ, {ENV_STATS: target}):
+            output = self._convert(self.data, backend=UpperBackend(),
+                                   memory_budget=1)
+        with open(target) as f:
+            events = [json.loads(line) for line in f]
+        stages = {e['stage']: e for e in events if e['event'] == 'stage'}
+        assert stages['read']['calls'] == self.file_count + 1
+        assert stages['convert']['calls'] == self.file_count
+        assert stages['write']['calls'] == self.file_count
+        counters = events[-1]['counters']
+        assert counters['files'] == self.file_count
+        assert counters['bytes_in'] == len(self.data)
+        assert counters['bytes_out'] == len(output)
+        assert counters['comments'] == len(
+            list(gather_comments_from_desc_set(
+                desc.FileDescriptorSet.FromString(self.data))))
+        assert counters['comments'] > counters['comments_bypassed'] > 0
+        assert counters['conversion_calls'] == self.file_count
+
+    def test_stats_recorder(self):
+        recorder = Recorder('py_desc_converter')
+        with mock.patch.dict(os.environ, {ENV_STATS: '-'}), \
+                mock.patch.object(Recorder, 'write') as write:
+            self._convert(self.data, backend=UpperBackend(),
+                          recorder=recorder)
+        write.assert_called_once_with(None)
+        assert recorder.counters['bytes_in'] == len(self.data)
+
+    def test_file_filter(self):
+        original = desc.FileDescriptorSet.FromString(self.data)
+        converted = desc.FileDescriptorSet.FromString(
+            self._convert(self.data, backend=UpperBackend()))
+        file_filter = py_desc_converter.FileFilter(
+            exclude=['*/spanner.proto', 'google.protobuf'])
+        recorder = Recorder('test')
+        output = desc.FileDescriptorSet.FromString(self._convert(
+            self.data, backend=UpperBackend(), memory_budget=1,
+            recorder=recorder, file_filter=file_filter))
+        assert output.file[:-1] == converted.file[:-1]
+        assert output.file[-1] == original.file[-1]
+        assert recorder.counters['files'] == self.file_count - 1
+        assert recorder.counters['files_excluded'] == 1
+
+        file_filter.drop = True
+        output = desc.FileDescriptorSet.FromString(self._convert(
+            self.data, backend=UpperBackend(), file_filter=file_filter))
+        assert output.file[:] == converted.file[:-1]
+
+    @mock.patch.object(py_desc_converter, 'get_backend',
+                       side_effect=UpperBackend)
+    def test_main_file_filter(self, get_backend):
+        stdin = mock.Mock(buffer=io.BytesIO(self.data))
+        stdout = mock.Mock(buffer=io.BytesIO())
+        with mock.patch('sys.stdin', stdin), mock.patch('sys.stdout', stdout):
+            py_desc_converter.main(['--include', 'google.spanner.*',
+                                    '--exclude', '*/spanner.proto',
+                                    '--drop-excluded', '-', '-'])
+        output = desc.FileDescriptorSet.FromString(stdout.buffer.getvalue())
+        assert [f.name for f in output.file] == [
+            f.name for f in desc.FileDescriptorSet.FromString(
+                self.data).file[:-1]]
+
+        with pytest.raises(SystemExit):
+            py_desc_converter.main(['--drop-excluded', '-', '-'])
+
+    @mock.patch.object(py_desc_converter, 'get_backend',
+                       side_effect=UpperBackend)
+    def test_main_stdin_stdout(self, get_backend):
+        stdin = mock.Mock(buffer=io.BytesIO(self.data))
+        stdout = mock.Mock(buffer=io.BytesIO())
+        with mock.patch('sys.stdin', stdin), mock.patch('sys.stdout', stdout):
+            py_desc_converter.main(['--memory-budget', '1', '-', '-'])
+        assert stdout.buffer.getvalue() == self._convert(
+            self.data, backend=UpperBackend())
+
+
+class MultipleConversionTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        with io.open('%s/data/descriptor_set' % curdir, 'rb') as f:
+            data = f.read()
+        desc_set = desc.FileDescriptorSet.FromString(data)
+        self.pairs = []
+        # Each set shares some of its files, and so its comments, with the
+        # next one.
+        for i in range(3):
+            source = os.path.join(self.path, 'source%d' % i)
+            with open(source, 'wb') as f:
+                f.write(b'\x10\x01')
+                f.write(desc.FileDescriptorSet(
+                    file=desc_set.file[i:i + 2]).SerializeToString())
+            self.pairs.append((source, os.path.join(self.path, 'dest%d' % i)))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _expected(self, source):
+        output = io.BytesIO()
+        with open(source, 'rb') as f:
+            py_desc_converter.convert_desc_stream(f, output,
+                                                  backend=UpperBackend())
+        return output.getvalue()
+
+    def _check_outputs(self):
+        for source, dest in self.pairs:
+            with open(dest, 'rb') as f:
+                assert f.read() == self._expected(source)
+
+    def test_convert_descs(self):
+        backend = UpperBackend()
+        target = os.path.join(self.path, 'stats.jsonl')
+        with mock.patch.dict(os.environ, {ENV_STATS: target}):
+            py_desc_converter.convert_descs(self.pairs, backend=backend)
+        self._check_outputs()
+        assert len(backend.calls) == 1
+
+        with open(target) as f:
+            counters = [json.loads(line) for line in f][-1]['counters']
+        assert counters['inputs'] == 3
+        assert counters['files'] == 6
+        assert counters['texts_duplicate'] > 0
+        assert counters['texts_converted'] == backend.calls[0]
+
+    def test_memory_budget(self):
+        backend = UpperBackend()
+        py_desc_converter.convert_descs(self.pairs, backend=backend,
+                                        memory_budget=1)
+        self._check_outputs()
+        assert len(backend.calls) == 3
+        with pytest.raises(ValueError):
+            py_desc_converter.convert_descs(self.pairs, backend=backend,
+                                            memory_budget=-1)
+
+    def test_stdin_stdout(self):
+        with open(self.pairs[0][0], 'rb') as f:
+            stdin = mock.Mock(buffer=io.BytesIO(f.read()))
+        stdout = mock.Mock(buffer=io.BytesIO())
+        with mock.patch('sys.stdin', stdin), mock.patch('sys.stdout', stdout):
+            py_desc_converter.convert_descs(
+                [('-', '-'), self.pairs[1]], backend=UpperBackend(),
+                cache=ConversionCache(os.path.join(self.path, 'cache')))
+        assert stdout.buffer.getvalue() == self._expected(self.pairs[0][0])
+
+    def test_read_manifest(self):
+        manifest = os.path.join(self.path, 'manifest')
+        with open(manifest, 'w') as f:
+            f.write('# Sets to convert.\n\n a  b \nc\td\n')
+        assert py_desc_converter.read_manifest(manifest) == [
+            ('a', 'b'), ('c', 'd')]
+
+        with open(manifest, 'w') as f:
+            f.write('a b\nc\n')
+        with pytest.raises(ValueError) as e:
+            py_desc_converter.read_manifest(manifest)
+        assert ':2:' in str(e.value)
+
+    @mock.patch.object(py_desc_converter, 'get_backend',
+                       side_effect=UpperBackend)
+    def test_main(self, get_backend):
+        manifest = os.path.join(self.path, 'manifest')
+        with open(manifest, 'w') as f:
+            for pair in self.pairs[1:]:
+                f.write('%s %s\n' % pair)
+        with mock.patch.object(py_desc_converter, 'convert_descs',
+                               wraps=py_desc_converter.convert_descs) as c:
+            py_desc_converter.main(list(self.pairs[0]) +
+                                   ['--manifest', manifest])
+        c.assert_called_once_with(self.pairs, cache=None, backend=None,
+                                  memory_budget=None, file_filter=None)
+        self._check_outputs()
+
+    def test_main_errors(self):
+        for argv in ([], ['a'], ['a', 'b', 'c', 'd', '--previous-source',
+                                 'e', '--previous-dest', 'f']):
+            with pytest.raises(SystemExit):
+                py_desc_converter.main(argv)
+
+
+class IncrementalConversionTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.source = os.path.join(self.path, 'source')
+        self.previous_source = os.path.join(self.path, 'previous_source')
+        self.dest = os.path.join(self.path, 'dest')
+        shutil.copyfile('%s/data/descriptor_set' % curdir, self.previous_source)
+        py_desc_converter.convert_desc(self.previous_source, self.dest,
+                                       backend=UpperBackend())
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _edit(self, comment):
+        with open(self.previous_source, 'rb') as f:
+            desc_set = desc.FileDescriptorSet.FromString(f.read())
+        location = desc_set.file[-1].source_code_info.location[-1]
+        location.leading_comments = comment
+        with open(self.source, 'wb') as f:
+            f.write(desc_set.SerializeToString())
+
+    def _convert(self, backend, dest=None):
+        py_desc_converter.convert_desc(
+            self.source, dest or self.dest, backend=backend,
+            previous_source=self.previous_source, previous_dest=self.dest)
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_changed_comment(self):
+        self._edit('An `edited` comment.')
+        backend = UpperBackend()
+        expected = os.path.join(self.path, 'expected')
+        py_desc_converter.convert_desc(self.source, expected,
+                                       backend=UpperBackend())
+        self._convert(backend)
+
+        # Only the edited comment was converted.
+        assert backend.calls == [1]
+        assert self._read(self.dest) == self._read(expected)
+
+    def test_new_dest(self):
+        # Fields other than files are ignored in the earlier sets.
+        for path in (self.previous_source, self.dest):
+            data = self._read(path)
+            with open(path, 'wb') as f:
+                f.write(b'\x10\x01' + data)
+        self._edit('An `edited` comment.')
+        other = os.path.join(self.path, 'other')
+        backend = UpperBackend()
+        self._convert(backend, dest=other)
+        assert backend.calls == [1]
+        assert desc.FileDescriptorSet.FromString(self._read(other)).file[-1] \
+            .source_code_info.location[-1].leading_comments == \
+            ' AN `EDITED` COMMENT.'
+
+    def test_unchanged_output_not_rewritten(self):
+        # An edit which does not change the output.
+        with open(self.previous_source, 'rb') as f:
+            self._edit(desc.FileDescriptorSet.FromString(f.read()).file[-1]
+                       .source_code_info.location[-1].leading_comments)
+        mtime = os.stat(self.dest).st_mtime
+        os.utime(self.dest, (mtime - 100, mtime - 100))
+        backend = UpperBackend()
+        self._convert(backend)
+        assert backend.calls == []
+        assert os.stat(self.dest).st_mtime == mtime - 100
+        assert sorted(os.listdir(self.path)) == [
+            'dest', 'previous_source', 'source']
+
+    def test_unchanged_input(self):
+        shutil.copyfile(self.previous_source, self.source)
+        backend = UpperBackend()
+        with mock.patch.object(shutil, 'copyfile') as copyfile:
+            self._convert(backend)
+        assert backend.calls == []
+        copyfile.assert_not_called()
+
+    def test_unchanged_input_new_dest(self):
+        shutil.copyfile(self.previous_source, self.source)
+        other = os.path.join(self.path, 'other')
+        self._convert(UpperBackend(), dest=other)
+        assert self._read(other) == self._read(self.dest)
+
+    def test_stdin_stdout(self):
+        self._edit('An `edited` comment.')
+        expected = os.path.join(self.path, 'expected')
+        py_desc_converter.convert_desc(self.source, expected,
+                                       backend=UpperBackend())
+        for source in (self.source, self.previous_source):
+            stdin = mock.Mock(buffer=io.BytesIO(self._read(source)))
+            stdout = mock.Mock(buffer=io.BytesIO())
+            with mock.patch('sys.stdin', stdin), \
+                    mock.patch('sys.stdout', stdout), \
+                    mock.patch.object(py_desc_converter, 'get_backend',
+                                      side_effect=UpperBackend):
+                py_desc_converter.main([
+                    '--previous-source', self.previous_source,
+                    '--previous-dest', self.dest, '-', '-'])
+            if source == self.source:
+                assert stdout.buffer.getvalue() == self._read(expected)
+            else:
+                assert stdout.buffer.getvalue() == self._read(self.dest)
+
+    def test_unchanged_input_stdout(self):
+        shutil.copyfile(self.previous_source, self.source)
+        stdout = mock.Mock(buffer=io.BytesIO())
+        with mock.patch('sys.stdout', stdout):
+            self._convert(UpperBackend(), dest='-')
+        assert stdout.buffer.getvalue() == self._read(self.dest)
+
+    def test_reused_recorded(self):
+        self._edit('An `edited` comment.')
+        recorder = Recorder('test')
+        with open(self.source, 'rb') as f:
+            py_desc_converter.convert_desc_stream(
+                f, io.BytesIO(), backend=UpperBackend(),
+                recorder=recorder,
+                previous=py_desc_converter.load_previous(
+                    self.previous_source, self.dest))
+        locations = sum(len(f.source_code_info.location) for f in
+                        desc.FileDescriptorSet.FromString(
+                            self._read(self.source)).file)
+        assert recorder.counters['locations_reused'] == locations - 1
+
+    def test_not_the_output(self):
+        with open(self.previous_source, 'rb') as f:
+            desc_set = desc.FileDescriptorSet.FromString(f.read())
+        other = os.path.join(self.path, 'other')
+        for files in (desc_set.file[:-1], list(desc_set.file) * 2):
+            with open(other, 'wb') as f:
+                f.write(desc.FileDescriptorSet(
+                    file=files).SerializeToString())
+            with pytest.raises(ValueError):
+                py_desc_converter.load_previous(self.previous_source, other)
+
+    def test_file_filter(self):
+        # The earlier output left the edited file out, so only the filter
+        # pairs it up with the earlier input.
+        file_filter = py_desc_converter.FileFilter(
+            exclude=['*/spanner.proto'], drop=True)
+        py_desc_converter.convert_desc(self.previous_source, self.dest,
+                                       backend=UpperBackend(),
+                                       file_filter=file_filter)
+        self._edit('An `edited` comment.')
+        backend = UpperBackend()
+        py_desc_converter.convert_desc(
+            self.source, self.dest, backend=backend,
+            previous_source=self.previous_source, previous_dest=self.dest,
+            file_filter=file_filter)
+        assert backend.calls == []
+        with pytest.raises(ValueError):
+            py_desc_converter.load_previous(self.previous_source, self.dest)
+
+    def test_previous_missing(self):
+        self._edit('An `edited` comment.')
+        expected = os.path.join(self.path, 'expected')
+        py_desc_converter.convert_desc(self.source, expected,
+                                       backend=UpperBackend())
+        missing = os.path.join(self.path, 'missing')
+        for previous_source, previous_dest in (
+                (missing, self.dest), (self.previous_source, missing),
+                (self.source, missing)):
+            other = os.path.join(self.path, 'other')
+            backend = UpperBackend()
+            py_desc_converter.convert_desc(
+                self.source, other, backend=backend,
+                previous_source=previous_source, previous_dest=previous_dest)
+            assert backend.calls
+            assert self._read(other) == self._read(expected)
+            os.remove(other)
+
+    def test_previous_unreadable(self):
+        # A first run, with the output as the earlier output.
+        self._edit('An `edited` comment.')
+        expected = os.path.join(self.path, 'expected')
+        py_desc_converter.convert_desc(self.source, expected,
+                                       backend=UpperBackend())
+        other = os.path.join(self.path, 'other')
+        py_desc_converter.convert_desc(
+            self.source, other, backend=UpperBackend(),
+            previous_source=self.previous_source, previous_dest=other)
+        assert self._read(other) == self._read(expected)
+
+        with mock.patch.object(py_desc_converter, 'load_previous',
+                               side_effect=IOError('Permission denied')):
+            backend = UpperBackend()
+            self._convert(backend)
+        assert backend.calls
+        assert self._read(self.dest) == self._read(expected)
+
+    def test_previous_given_together(self):
+        with pytest.raises(ValueError):
+            py_desc_converter.convert_desc(self.source, self.dest,
+                                           previous_source=self.source)
+        with pytest.raises(SystemExit):
+            py_desc_converter.main(['--previous-dest', self.dest,
+                                    self.source, self.dest])
+
+
 def gather_comments_from_desc_set(desc_set):
     for file_descriptor_proto in desc_set.file:
         if not file_descriptor_proto.source_code_info:
@@ -15,12 +15,24 @@
 from __future__ import absolute_import
 
 import io
+import json
+import multiprocessing
 import os
+import shutil
+import tempfile
 import unittest
+from multiprocessing.pool import ThreadPool
 
 import mock
+import pypandoc
+import pytest
 
+from protoc_docs import batch
 from protoc_docs.bin import py_docstring
+from protoc_docs.cache import ConversionCache
+from protoc_docs.instrumentation import Recorder
+from protoc_docs.parser import CodeGeneratorParser
+from google.protobuf.compiler.plugin_pb2 import CodeGeneratorResponse
 
 
 class PyDocstringTests(unittest.TestCase):
@@ -62,6 +74,157 @@ class PyDocstringTests(unittest.TestCase):
         assert size > 25000
         assert size < 26000
 
+    @mock.patch.object(pypandoc, 'get_pandoc_version', return_value='2.2.1')
+    @mock.patch.object(pypandoc, 'convert_text', side_effect=lambda s, *a, **k: s)
+    def test_cached_input_file(self, convert_text, get_pandoc_version):
+        curdir = os.path.realpath(os.path.dirname(__file__))
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        outputs = []
+        for _ in range(2):
+            output_file = io.BytesIO()
+            with io.open('%s/data/input_buffer' % curdir, 'rb') as file_:
+                py_docstring.main(input_file=file_, output_file=output_file,
+                                  cache=ConversionCache(cache_dir))
+            outputs.append(output_file.getvalue())
+
+        # The second run is served entirely from the cache.
+        convert_text.assert_called_once()
+        assert len(outputs[0]) == len(outputs[1])
+
+    @mock.patch.object(pypandoc, 'convert_text', side_effect=lambda s, *a, **k: s)
+    def test_stats_parameter(self, convert_text):
+        from google.protobuf.compiler.plugin_pb2 import CodeGeneratorRequest
+
+        curdir = os.path.realpath(os.path.dirname(__file__))
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        with io.open('%s/data/input_buffer' % curdir, 'rb') as file_:
+            request = CodeGeneratorRequest.FromString(file_.read())
+        request.parameter = 'stats=%s' % os.path.join(path, 'stats.jsonl')
+
+        output_file = io.BytesIO()
+        py_docstring.main(
+            input_file=io.BytesIO(request.SerializeToString()),
+            output_file=output_file,
+        )
+
+        with open(os.path.join(path, 'stats.jsonl')) as f:
+            events = [json.loads(line) for line in f]
+        assert [e.get('stage') for e in events] == [
+            'parse_request', 'find_docs', 'batch_assembly', 'convert',
+            'render', 'serialize', None,
+        ]
+        counters = events[-1]['counters']
+        assert counters['bytes_in'] == request.ByteSize()
+        assert counters['bytes_out'] == len(output_file.getvalue())
+        assert counters['messages'] == 24
+        assert counters['conversion_calls'] == 1
+
+    def test_stats_recorder(self):
+        recorder = Recorder('py_docstring')
+        with mock.patch.object(Recorder, 'write') as write:
+            py_docstring.main(input_file=io.BytesIO(),
+                              output_file=io.BytesIO(), recorder=recorder)
+        write.assert_not_called()
+        assert 'serialize' in recorder.stages
+
+    @mock.patch.object(pypandoc, 'convert_text',
+                       side_effect=lambda s, *a, **k: s.upper())
+    def test_pipelined(self, convert_text):
+        from google.protobuf.compiler.plugin_pb2 import CodeGeneratorRequest
+
+        curdir = os.path.realpath(os.path.dirname(__file__))
+        with io.open('%s/data/input_buffer' % curdir, 'rb') as file_:
+            request = CodeGeneratorRequest.FromString(file_.read())
+        proto_file = request.proto_file[-1]
+        for index in range(2):
+            copy = request.proto_file.add()
+            copy.CopyFrom(proto_file)
+            copy.name = 'copy%d/%s' % (index, proto_file.name)
+            copy.package = 'copy%d.%s' % (index, proto_file.package)
+            request.file_to_generate.append(copy.name)
+        data = request.SerializeToString()
+
+        outputs = []
+        recorders = []
+        for chunk_size in (0, 1, 10 ** 9):
+            output_file = io.BytesIO()
+            recorder = Recorder('py_docstring')
+            py_docstring.main(input_file=io.BytesIO(data),
+                              output_file=output_file, recorder=recorder,
+                              chunk_size=chunk_size)
+            outputs.append(output_file.getvalue())
+            recorders.append(recorder)
+
+        # Each file was converted on its own, or all of them together, and
+        # the response is the same.
+        assert outputs[0] == outputs[1] == outputs[2]
+        assert recorders[0].stages['convert']['calls'] == 1
+        assert recorders[1].stages['convert']['calls'] == 3
+        assert recorders[2].stages['convert']['calls'] == 1
+        assert recorders[1].counters['messages'] == \
+            recorders[0].counters['messages']
+
+    @mock.patch.object(pypandoc, 'convert_text',
+                       side_effect=lambda s, *a, **k: s.upper())
+    def test_processes(self, convert_text):
+        from google.protobuf.compiler.plugin_pb2 import CodeGeneratorRequest
+
+        curdir = os.path.realpath(os.path.dirname(__file__))
+        with io.open('%s/data/input_buffer' % curdir, 'rb') as file_:
+            request = CodeGeneratorRequest.FromString(file_.read())
+        # A file without docs is skipped, as when it is parsed here.
+        request.proto_file.add(name='empty/empty.proto')
+        request.file_to_generate.append('empty/empty.proto')
+        data = request.SerializeToString()
+
+        # Threads stand in for processes in the last run, so that what runs
+        # in the pool is covered.
+        outputs = []
+        for processes, chunk_size, pool in ((1, 0, multiprocessing.Pool),
+                                            (2, 0, multiprocessing.Pool),
+                                            (2, 1, ThreadPool)):
+            output_file = io.BytesIO()
+            recorder = Recorder('py_docstring')
+            with mock.patch.object(multiprocessing, 'Pool', pool):
+                py_docstring.main(input_file=io.BytesIO(data),
+                                  output_file=output_file, recorder=recorder,
+                                  chunk_size=chunk_size, processes=processes)
+            outputs.append(output_file.getvalue())
+        assert outputs[0] == outputs[1] == outputs[2]
+        assert recorder.counters['messages'] == 24
+
+        # The messages are rendered in the order their docs are found, so
+        # the response does not depend on how their names hash.
+        expected = []
+        for _, struct in CodeGeneratorParser(request).find_docs():
+            if 'class_scope:' + struct.name not in expected:
+                expected.append('class_scope:' + struct.name)
+        assert [f.insertion_point for f in
+                CodeGeneratorResponse.FromString(outputs[0]).file
+                if f.insertion_point] == expected
+
+    def test_processes_count(self):
+        assert py_docstring._get_processes(None, environ={}) == 1
+        assert py_docstring._get_processes(
+            None, environ={py_docstring.ENV_PROCESSES: '3'}) == 3
+        with mock.patch.object(batch, '_cpu_count', return_value=8):
+            assert py_docstring._get_processes(
+                None, environ={py_docstring.ENV_PROCESSES: 'auto'}) == 8
+            assert py_docstring._get_processes(0) == 8
+        with pytest.raises(ValueError):
+            py_docstring._get_processes(-1)
+
+    def test_chunk_size(self):
+        assert py_docstring._get_chunk_size(None, environ={}) == 0
+        assert py_docstring._get_chunk_size(
+            None, environ={py_docstring.ENV_CHUNK_SIZE: '4096'}) == 4096
+        assert py_docstring._get_chunk_size(10) == 10
+        with pytest.raises(ValueError):
+            py_docstring._get_chunk_size(-1)
+
     def test_init_files(self):
         files = ['foo.proto', '/bar.proto', 'baz/qux/corge.proto']
         expected = {'__init__.py', 'baz/qux/__init__.py'}
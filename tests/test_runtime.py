@@ -0,0 +1,88 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import mock
+import pytest
+
+from protoc_docs import runtime
+
+
+class PrivateDirTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_runtime_dir(self):
+        path = runtime.private_dir({runtime.ENV_RUNTIME_DIR: self.path})
+        assert path == os.path.join(self.path, 'protoc-docs')
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+        assert runtime.private_dir({runtime.ENV_RUNTIME_DIR: self.path}) == \
+            path
+
+    @mock.patch.object(tempfile, 'gettempdir')
+    def test_temporary_dir(self, gettempdir):
+        gettempdir.return_value = self.path
+        expected = os.path.join(self.path, 'protoc-docs-%d' % os.getuid())
+        assert runtime.private_dir({}) == expected
+
+        # A runtime directory others can use is not used.
+        shared = os.path.join(self.path, 'shared')
+        os.mkdir(shared)
+        os.chmod(shared, 0o777)
+        assert runtime.private_dir({runtime.ENV_RUNTIME_DIR: shared}) == \
+            expected
+
+    @mock.patch.object(tempfile, 'gettempdir')
+    def test_not_private(self, gettempdir):
+        gettempdir.return_value = self.path
+        planted = os.path.join(self.path, 'protoc-docs-%d' % os.getuid())
+        os.mkdir(planted)
+        os.chmod(planted, 0o755)
+        with pytest.raises(OSError):
+            runtime.private_dir({})
+
+        # Nor is a symbolic link to a private directory.
+        os.rmdir(planted)
+        os.symlink(tempfile.mkdtemp(dir=self.path), planted)
+        with pytest.raises(OSError):
+            runtime.private_dir({})
+
+    @mock.patch.object(tempfile, 'gettempdir')
+    def test_cannot_create(self, gettempdir):
+        gettempdir.return_value = os.path.join(self.path, 'missing')
+        with pytest.raises(OSError):
+            runtime.private_dir({})
+
+    def test_is_private(self):
+        path = os.path.join(self.path, 'state.json')
+        assert not runtime.is_private(path)
+        with open(path, 'w') as f:
+            f.write('{}')
+        os.chmod(path, 0o644)
+        assert runtime.is_private(path)
+        os.chmod(path, 0o664)
+        assert not runtime.is_private(path)
+        os.chmod(path, 0o644)
+        with mock.patch.object(os, 'getuid', return_value=os.getuid() + 1):
+            assert not runtime.is_private(path)
@@ -0,0 +1,324 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+import pytest
+
+from protoc_docs import backends
+from protoc_docs import runtime
+from protoc_docs import server
+
+# A stand-in for `pandoc server`, speaking the same HTTP JSON API. It
+# "converts" text by upper-casing it (without adding a final newline, like
+# the real server), and fails to convert from "bogus".
+STAND_IN = r'''
+import json
+import sys
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/version':
+            return self.send_error(404)
+        self._respond(b'9.9.9')
+
+    def do_POST(self):
+        if self.path != '/batch':
+            return self.send_error(404)
+        length = int(self.headers['Content-Length'])
+        params = json.loads(self.rfile.read(length).decode('utf-8'))
+        results = []
+        for p in params:
+            if p['from'] == 'bogus':
+                results.append({'error': 'Unknown input format bogus'})
+            else:
+                results.append({'output': p['text'].upper(), 'base64': False,
+                                'messages': []})
+        self._respond(json.dumps(results).encode('utf-8'))
+
+    def _respond(self, body):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_server(port):
+    return HTTPServer(('127.0.0.1', port), Handler)
+
+
+if __name__ == '__main__':
+    make_server(int(sys.argv[1])).serve_forever()
+'''
+
+# A stand-in for a `pandoc server` which cannot answer any request.
+BROKEN_STAND_IN = r'''
+import socket
+import sys
+
+sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+sock.bind(('127.0.0.1', int(sys.argv[1])))
+sock.listen(5)
+while True:
+    sock.accept()[0].close()
+'''
+
+
+def _load_stand_in():
+    namespace = {'__name__': 'stand_in'}
+    exec(STAND_IN, namespace)
+    return namespace
+
+
+class _StandInTestCase(unittest.TestCase):
+    """Runs the stand-in server in a thread of the test process."""
+
+    def setUp(self):
+        self.httpd = _load_stand_in()['make_server'](0)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class ServerClientTests(_StandInTestCase):
+    def test_version(self):
+        client = server.ServerClient(self.url)
+        assert client.version() == '9.9.9'
+        assert client.alive()
+
+    def test_convert(self):
+        client = server.ServerClient(self.url)
+        assert client.convert(['a', 'b'], 'rst', 'markdown') == ['A', 'B']
+        assert client.convert(['a'], 'rst', 'bogus') == [None]
+
+    def test_unreachable(self):
+        client = server.ServerClient('http://127.0.0.1:%d' % server._free_port(),
+                                     timeout=1)
+        assert not client.alive()
+        with pytest.raises(server.ServerError):
+            client.convert(['a'], 'rst', 'markdown')
+
+
+class ServerBackendTests(_StandInTestCase):
+    def test_convert(self):
+        fallback = mock.Mock(spec=backends.PandocBackend)
+        backend = backends.ServerBackend(url=self.url, fallback=fallback)
+        assert backend.convert(['a', 'b'], 'rst', 'md', 'XYZ') == \
+            ['A\n', 'B\n']
+        assert backend.version == 'server+9.9.9'
+        fallback.convert.assert_not_called()
+
+    def test_convert_normalized(self):
+        # Like the pandoc CLI's, each output ends in a single newline.
+        backend = backends.ServerBackend(url=self.url)
+        assert backend.convert(['a', 'b\n\n\n', '\nc\n'], 'rst', 'md',
+                               'XYZ') == ['A\n', 'B\n', 'C\n']
+
+    def test_convert_failed_text(self):
+        fallback = mock.Mock(spec=backends.PandocBackend)
+        fallback.convert.return_value = ['from pandoc']
+        backend = backends.ServerBackend(url=self.url, fallback=fallback)
+        assert backend.convert(['a'], 'rst', 'bogus', 'XYZ') == ['from pandoc']
+
+    def test_fallback_when_unreachable(self):
+        fallback = mock.Mock(spec=backends.PandocBackend)
+        fallback.convert.return_value = ['a', 'b']
+        fallback.version = '2.2.1'
+        url = 'http://127.0.0.1:%d' % server._free_port()
+        backend = backends.ServerBackend(url=url, fallback=fallback)
+
+        assert backend.convert(['a', 'b'], 'rst', 'md', 'XYZ') == ['a', 'b']
+        fallback.convert.assert_called_once_with(['a', 'b'], 'rst', 'md', 'XYZ')
+        assert backend.version == '2.2.1'
+        assert backend.client is None
+
+    @mock.patch.object(server, 'ensure_server',
+                       side_effect=server.ServerError('nope'))
+    def test_fallback_when_not_started(self, ensure_server):
+        fallback = mock.Mock(spec=backends.PandocBackend)
+        fallback.version = '2.2.1'
+        backend = backends.ServerBackend(fallback=fallback, environ={})
+        assert backend.version == '2.2.1'
+        assert backend.version == '2.2.1'
+        ensure_server.assert_called_once_with()
+
+    def test_url_from_environ(self):
+        backend = backends.ServerBackend(
+            environ={'PROTOC_DOCS_PANDOC_SERVER': self.url})
+        assert backend.client.url == self.url
+
+
+class EnsureServerTests(unittest.TestCase):
+    """Start, reuse and stop real supervisor processes."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        stand_in = os.path.join(self.tmpdir, 'stand_in.py')
+        with open(stand_in, 'w') as f:
+            f.write(STAND_IN)
+        self.command = [sys.executable, stand_in, '{port}']
+        self.state_path = os.path.join(self.tmpdir, 'state.json')
+
+    def tearDown(self):
+        server.stop_server(self.state_path)
+        shutil.rmtree(self.tmpdir)
+
+    def _wait_until_stopped(self, timeout=10):
+        deadline = time.time() + timeout
+        while os.path.exists(self.state_path) and time.time() < deadline:
+            time.sleep(0.1)
+        return not os.path.exists(self.state_path)
+
+    def test_start_reuse_stop(self):
+        url = server.ensure_server(self.command, self.state_path,
+                                   idle_timeout=60)
+        assert server.ServerClient(url).version() == '9.9.9'
+
+        # A second client reuses the running server.
+        assert server.ensure_server(self.command, self.state_path) == url
+
+        assert server.stop_server(self.state_path)
+        assert self._wait_until_stopped()
+        assert not server.ServerClient(url, timeout=1).alive()
+        assert not server.stop_server(self.state_path)
+
+    def test_idle_shutdown(self):
+        url = server.ensure_server(self.command, self.state_path,
+                                   idle_timeout=1)
+        assert self._wait_until_stopped()
+        assert not server.ServerClient(url, timeout=1).alive()
+
+    def test_start_failure(self):
+        # The supervisor exits as soon as the server does, without waiting
+        # for the start timeout.
+        command = [sys.executable, '-c', 'pass']
+        start = time.time()
+        with pytest.raises(server.ServerError):
+            server.ensure_server(command, self.state_path, start_timeout=30)
+        assert time.time() - start < 15
+
+        # Later clients do not try again for a while.
+        with mock.patch.object(server, '_spawn_supervisor') as spawn:
+            start = time.time()
+            with pytest.raises(server.ServerError):
+                server.ensure_server(command, self.state_path)
+            assert time.time() - start < 1
+            spawn.assert_not_called()
+
+            # Unless the failure is old, or was recorded by someone else.
+            failure_path = self.state_path + '.failed'
+            os.utime(failure_path, (time.time() - 600, time.time() - 600))
+            with pytest.raises(server.ServerError):
+                server.ensure_server(command, self.state_path,
+                                     start_timeout=0.1)
+            os.chmod(failure_path, 0o666)
+            with pytest.raises(server.ServerError):
+                server.ensure_server(command, self.state_path,
+                                     start_timeout=0.1)
+            assert spawn.call_count == 2
+
+    def test_start_broken(self):
+        # A server which listens but drops every request, as pandoc does
+        # when built without the threaded runtime.
+        broken = os.path.join(self.tmpdir, 'broken.py')
+        with open(broken, 'w') as f:
+            f.write(BROKEN_STAND_IN)
+        start = time.time()
+        with pytest.raises(server.ServerError):
+            server.ensure_server([sys.executable, broken, '{port}'],
+                                 self.state_path, start_timeout=30)
+        assert time.time() - start < 15
+
+    def test_start_timeout(self):
+        command = [sys.executable, '-c', 'import time; time.sleep(5)']
+        with pytest.raises(server.ServerError):
+            server.ensure_server(command, self.state_path, start_timeout=0.5)
+        assert os.path.exists(self.state_path + '.failed')
+
+    def test_start_failure_fallback(self):
+        fallback = mock.Mock(spec=backends.PandocBackend)
+        fallback.convert.return_value = ['a\n']
+        with mock.patch.object(server, 'default_command',
+                               return_value=[sys.executable, '-c', 'pass']), \
+                mock.patch.object(server, 'default_state_path',
+                                  return_value=self.state_path):
+            for _ in range(2):
+                start = time.time()
+                backend = backends.ServerBackend(fallback=fallback,
+                                                 environ={})
+                assert backend.convert(['a'], 'rst', 'md', 'XYZ') == ['a\n']
+                elapsed = time.time() - start
+            # The second run falls back straight away.
+            assert elapsed < 1
+
+    def test_start_failure_waiting(self):
+        # A client waiting for another to start the server stops waiting
+        # once that fails.
+        with open(self.state_path + '.lock', 'w'):
+            pass
+        timer = threading.Timer(0.2, server._write_state,
+                                (self.state_path + '.failed', {}))
+        timer.start()
+        start = time.time()
+        with pytest.raises(server.ServerError):
+            server.ensure_server(self.command, self.state_path,
+                                 start_timeout=30)
+        timer.join()
+        assert time.time() - start < 5
+
+    def test_start_after_failure(self):
+        server._write_state(self.state_path + '.failed', {})
+        with mock.patch.object(server, 'ensure_server',
+                               return_value='http://127.0.0.1:1'):
+            assert server.main(['start', '--state', self.state_path]) == 0
+        assert not os.path.exists(self.state_path + '.failed')
+
+    def test_default_state_path(self):
+        path = server.default_state_path(self.command)
+        assert path == server.default_state_path(self.command)
+        assert path != server.default_state_path(['pandoc', 'server'])
+        assert os.path.dirname(path) == runtime.private_dir()
+
+    @mock.patch.object(os, 'kill')
+    def test_state_not_private(self, kill):
+        # A state file others can write to is not trusted.
+        with open(self.state_path, 'w') as f:
+            json.dump({'url': 'http://127.0.0.1:1', 'pid': 1}, f)
+        os.chmod(self.state_path, 0o666)
+        assert not server.stop_server(self.state_path)
+        kill.assert_not_called()
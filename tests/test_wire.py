@@ -0,0 +1,126 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import io
+import os
+import unittest
+
+import pytest
+
+from google.protobuf import descriptor_pb2 as desc
+
+from protoc_docs import wire
+
+curdir = os.path.realpath(os.path.dirname(__file__))
+
+
+class _TrickleStream(io.BytesIO):
+    """A stream which returns at most two bytes per read."""
+    def read(self, size=-1):
+        return io.BytesIO.read(self, min(size, 2) if size >= 0 else 2)
+
+
+class WireTests(unittest.TestCase):
+    def test_encode_varint(self):
+        assert wire.encode_varint(0) == b'\x00'
+        assert wire.encode_varint(1) == b'\x01'
+        assert wire.encode_varint(300) == b'\xac\x02'
+
+    def test_decode_varint(self):
+        assert wire.decode_varint(b'\xac\x02') == 300
+        with pytest.raises(ValueError):
+            wire.decode_varint(b'\xac')
+
+    def test_delimited(self):
+        output = io.BytesIO()
+        wire.write_delimited(output, b'abc')
+        wire.write_delimited(output, b'')
+        stream = _TrickleStream(output.getvalue())
+        assert wire.read_delimited(stream) == b'abc'
+        assert wire.read_delimited(stream) == b''
+        assert wire.read_delimited(stream) is None
+        with pytest.raises(ValueError):
+            wire.read_delimited(io.BytesIO(b'\x05ab'))
+
+    def test_round_trip(self):
+        with io.open('%s/data/descriptor_set' % curdir, 'rb') as f:
+            data = f.read()
+        fields = list(wire.iter_fields(io.BytesIO(data)))
+        assert len(fields) == len(desc.FileDescriptorSet.FromString(data).file)
+        assert {(n, t) for n, t, _ in fields} == {(1, wire.LENGTH_DELIMITED)}
+
+        output = io.BytesIO()
+        for field in fields:
+            wire.write_field(output, *field)
+        assert output.getvalue() == data
+
+    def test_all_wire_types(self):
+        message = desc.FieldOptions(ctype=desc.FieldOptions.CORD)
+        message.uninterpreted_option.add(positive_int_value=300,
+                                         double_value=1.5,
+                                         identifier_value='x')
+        data = message.SerializeToString() + b'\x7d\x01\x02\x03\x04'
+        fields = list(wire.iter_fields(_TrickleStream(data)))
+        assert [(n, t) for n, t, _ in fields] == [
+            (1, wire.VARINT), (999, wire.LENGTH_DELIMITED), (15, wire.FIXED32),
+        ]
+        nested = list(wire.iter_fields(io.BytesIO(fields[1][2])))
+        assert (4, wire.VARINT, b'\xac\x02') in nested
+        assert (6, wire.FIXED64, b'\x00\x00\x00\x00\x00\x00\xf8?') in nested
+
+        output = io.BytesIO()
+        for field in fields:
+            wire.write_field(output, *field)
+        assert output.getvalue() == data
+
+    def test_truncated(self):
+        with pytest.raises(ValueError):
+            list(wire.iter_fields(io.BytesIO(b'\x0a')))
+        with pytest.raises(ValueError):
+            list(wire.iter_fields(io.BytesIO(b'\x0a\x05abc')))
+
+    def test_malformed(self):
+        with pytest.raises(ValueError):
+            list(wire.iter_fields(io.BytesIO(b'\x0b')))
+        with pytest.raises(ValueError):
+            list(wire.iter_fields(io.BytesIO(b'\x08' + b'\xff' * 10)))
+
+    def test_iter_field_spans(self):
+        message = desc.FieldOptions(ctype=desc.FieldOptions.CORD)
+        message.uninterpreted_option.add(positive_int_value=300,
+                                         double_value=1.5,
+                                         identifier_value='x')
+        data = b'xx' + message.SerializeToString() + b'\x7d\x01\x02\x03\x04'
+        spans = list(wire.iter_field_spans(data, 2))
+        assert [(n, t) for n, t, _, _, _ in spans] == [
+            (1, wire.VARINT), (999, wire.LENGTH_DELIMITED), (15, wire.FIXED32),
+        ]
+        assert [(n, t, data[v:e]) for n, t, _, v, e in spans] == [
+            (n, t, v) for n, t, v in wire.iter_fields(io.BytesIO(data[2:]))]
+        assert spans[0][2] == 2
+        assert spans[-1][-1] == len(data)
+
+        # The value of a length-delimited field may be scanned in turn.
+        _, _, _, start, end = spans[1]
+        nested = list(wire.iter_field_spans(data, start, end))
+        assert (6, wire.FIXED64) in [(n, t) for n, t, _, _, _ in nested]
+        assert nested[-1][-1] == end
+
+    def test_iter_field_spans_malformed(self):
+        for data in (b'\x0a', b'\x0a\x05abc', b'\x0b', b'\x0d\x01',
+                     b'\x08' + b'\xff' * 10):
+            with pytest.raises(ValueError):
+                list(wire.iter_field_spans(data))
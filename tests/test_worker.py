@@ -0,0 +1,237 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mock
+import pytest
+
+from protoc_docs import wire
+from protoc_docs import worker
+from protoc_docs.bin import py_desc_converter
+from protoc_docs.bin import py_docstring
+from protoc_docs.cache import ConversionCache
+from protoc_docs.cache import MemoryCache
+
+from helpers import UpperBackend
+
+curdir = os.path.realpath(os.path.dirname(__file__))
+
+
+def _tool(arguments, cache=None, backend=None):
+    if not arguments:
+        return None
+    print('running %s' % ' '.join(arguments))
+    if arguments == ['fail']:
+        raise RuntimeError('failed')
+    if arguments == ['usage']:
+        sys.exit('usage: tool')
+    if arguments == ['exit']:
+        sys.exit(3)
+    return 0
+
+
+def _proto_request(arguments, request_id=0, cancel=False):
+    payload = io.BytesIO()
+    for arg in arguments:
+        wire.write_field(payload, 1, wire.LENGTH_DELIMITED,
+                         arg.encode('utf-8'))
+    # An input, which is ignored.
+    wire.write_field(payload, 2, wire.LENGTH_DELIMITED, b'\x0a\x01a')
+    if request_id:
+        wire.write_field(payload, 3, wire.VARINT,
+                         wire.encode_varint(request_id))
+    if cancel:
+        wire.write_field(payload, 4, wire.VARINT, b'\x01')
+    output = io.BytesIO()
+    wire.write_delimited(output, payload.getvalue())
+    return output.getvalue()
+
+
+def _proto_responses(data):
+    stream = io.BytesIO(data)
+    responses = []
+    while True:
+        payload = wire.read_delimited(stream)
+        if payload is None:
+            return responses
+        response = {'exit_code': 0, 'output': '', 'request_id': 0}
+        for number, _, value in wire.iter_fields(io.BytesIO(payload)):
+            if number == 1:
+                response['exit_code'] = wire.decode_varint(value)
+            elif number == 2:
+                response['output'] = value.decode('utf-8')
+            else:
+                response['request_id'] = wire.decode_varint(value)
+        responses.append(response)
+
+
+class WorkerTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_proto(self):
+        requests = (_proto_request(['a', 'b'], request_id=1) +
+                    _proto_request(['fail'], request_id=2) +
+                    _proto_request(['x'], request_id=3, cancel=True) +
+                    _proto_request(['exit']) +
+                    _proto_request([]))
+        output = io.BytesIO()
+        stdout = sys.stdout
+        worker.Worker(_tool, backend=UpperBackend()).serve(
+            io.BytesIO(requests), output)
+        assert sys.stdout is stdout
+
+        responses = _proto_responses(output.getvalue())
+        assert [r['request_id'] for r in responses] == [1, 2, 0, 0]
+        assert [r['exit_code'] for r in responses] == [0, 1, 3, 0]
+        assert responses[3]['output'] == ''
+        assert responses[0]['output'] == 'running a b\n'
+        assert 'RuntimeError: failed' in responses[1]['output']
+
+    def test_json(self):
+        requests = (
+            b'{"arguments": ["a"], "requestId": 1}\n'
+            b'\n'
+            b'{\n  "arguments": ["usage"],\n  "request_id": 2\n}\n'
+            b'{"cancel": true, "requestId": 3}\n'
+            b'{}'
+        )
+        output = io.BytesIO()
+        worker.Worker(_tool, protocol='json', backend=UpperBackend()).serve(
+            io.BytesIO(requests), output)
+        responses = [json.loads(line)
+                     for line in output.getvalue().decode('utf-8').splitlines()]
+        assert responses == [
+            {'exitCode': 0, 'output': 'running a\n', 'requestId': 1},
+            {'exitCode': 1, 'output': 'running usage\nusage: tool\n',
+             'requestId': 2},
+            {'exitCode': 0, 'output': '', 'requestId': 0},
+        ]
+
+    def test_json_truncated(self):
+        with pytest.raises(ValueError):
+            worker.Worker(_tool, protocol='json', backend=UpperBackend()) \
+                .serve(io.BytesIO(b'{"arguments": '), io.BytesIO())
+
+    def test_unknown_protocol(self):
+        with pytest.raises(ValueError):
+            worker.Worker(_tool, protocol='xml')
+
+    @mock.patch.dict(os.environ, {ConversionCache.ENV_DIR: ''})
+    def test_default_cache(self):
+        instance = worker.Worker(_tool, backend=UpperBackend())
+        assert isinstance(instance.cache, MemoryCache)
+        assert instance.cache.fallback is None
+
+        cache = MemoryCache()
+        assert worker.Worker(_tool, cache=cache).cache is cache
+
+    def test_expand_arguments(self):
+        params = os.path.join(self.path, 'params')
+        with io.open(params, 'w', encoding='utf-8') as f:
+            f.write(u'a b\nc\n')
+        assert worker.expand_arguments(['x', '@' + params]) == [
+            'x', 'a b', 'c']
+
+    def test_main_once(self):
+        params = os.path.join(self.path, 'params')
+        with open(params, 'w') as f:
+            f.write('exit\n')
+        tool = mock.Mock(wraps=_tool)
+        assert worker.main(tool, ['--worker_protocol=json', '@' + params]) == 3
+        tool.assert_called_once_with(['exit'])
+
+    @mock.patch.object(worker, 'get_backend', side_effect=UpperBackend)
+    def test_main_persistent(self, get_backend):
+        stdin = mock.Mock(buffer=io.BytesIO(b'{"arguments": ["a"]}\n'))
+        stdout = mock.Mock(buffer=io.BytesIO())
+        with mock.patch('sys.stdin', stdin), mock.patch('sys.stdout', stdout):
+            assert worker.main(_tool, ['--persistent_worker',
+                                       '--worker_protocol=json']) == 0
+        assert json.loads(stdout.buffer.getvalue().decode('utf-8'))[
+            'output'] == 'running a\n'
+
+
+class ToolWorkerTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.backend = UpperBackend()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _serve(self, tool, requests):
+        output = io.BytesIO()
+        worker.Worker(tool, protocol='json', backend=self.backend).serve(
+            io.BytesIO(b''.join(json.dumps({'arguments': arguments})
+                                .encode('utf-8') + b'\n'
+                                for arguments in requests)),
+            output)
+        return [json.loads(line)
+                for line in output.getvalue().decode('utf-8').splitlines()]
+
+    def test_desc_converter(self):
+        source = '%s/data/descriptor_set' % curdir
+        dests = [os.path.join(self.path, 'dest%d' % i) for i in range(2)]
+        responses = self._serve(py_desc_converter.main,
+                                [[source, dest] for dest in dests])
+        assert [r['exitCode'] for r in responses] == [0, 0]
+
+        # The second request was served from the shared in-memory cache.
+        assert len(self.backend.calls) == 1
+        with open(dests[0], 'rb') as first, open(dests[1], 'rb') as second:
+            assert first.read() == second.read()
+
+    def test_desc_converter_std_streams(self):
+        # stdin and stdout carry the requests and responses, so they cannot
+        # be used for descriptor sets; later requests are unaffected.
+        source = '%s/data/descriptor_set' % curdir
+        dest = os.path.join(self.path, 'dest')
+        stdin, stdout = sys.stdin, sys.stdout
+        responses = self._serve(py_desc_converter.main,
+                                [[source, '-'], ['-', dest], [source, dest]])
+        assert [r['exitCode'] for r in responses] == [1, 1, 0]
+        assert responses[0]['output'] == (
+            'stdout carries the work responses of a persistent worker; '
+            'write to a file instead of -\n')
+        assert responses[1]['output'].startswith('stdin carries')
+        assert os.path.exists(dest)
+        assert (sys.stdin, sys.stdout) == (stdin, stdout)
+
+    def test_plugin(self):
+        request = '%s/data/input_buffer' % curdir
+        responses = [os.path.join(self.path, 'response%d' % i)
+                     for i in range(2)]
+        results = self._serve(py_docstring.run,
+                              [[request, response] for response in responses] +
+                              [[request]])
+        assert [r['exitCode'] for r in results] == [0, 0, 2]
+        assert 'usage' in results[2]['output']
+        assert len(self.backend.calls) == 1
+        with open(responses[0], 'rb') as first, \
+                open(responses[1], 'rb') as second:
+            assert first.read() == second.read()